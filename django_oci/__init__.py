@@ -1,2 +1,2 @@
-__version__ = "0.0.17"
+__version__ = "0.0.18"
 default_app_config = "django_oci.apps.DjangoOciConfig"
@@ -179,8 +179,10 @@ def validate_jwt(request, repository, must_be_owner):
             return False, None
 
         # TODO: any validation needed for access type?
+        # A repository not yet created (e.g., on first pull of a proxied one) is a name
         requested_name = decoded.get("access", [{}])[0].get("name")
-        if isinstance(repository, Repository) and repository.name != requested_name:
+        name = getattr(repository, "name", repository)
+        if name is not None and name != requested_name:
             print("Repository name is not equal to requested name.")
             return False, None
 
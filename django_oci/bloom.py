@@ -0,0 +1,134 @@
+"""
+
+Copyright (c) 2020-2023, Vanessa Sochat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import hashlib
+import math
+import threading
+import uuid
+from datetime import timedelta
+
+from django.middleware import cache
+from django.utils import timezone
+
+from django_oci import settings
+from django_oci.models import Blob
+
+# The shared key that changes whenever a blob is added or removed
+VERSION_KEY = "blob-filter/version"
+
+# Blobs modified this long before a refresh are read again, for clock skew
+REFRESH_OVERLAP = timedelta(seconds=60)
+
+
+class BloomFilter:
+    """A Bloom filter answers if an item might be in a set (with a false
+    positive rate) or is definitely not. Items can be added but not removed.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = max(capacity, 1)
+        self.size = int(-self.capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(int(self.size / self.capacity * math.log(2)), 1)
+        self.bits = bytearray(self.size // 8 + 1)
+        self.count = 0
+
+    def get_positions(self, item):
+        """Derive the bit positions for an item from two halves of one hash"""
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "big")
+        second = int.from_bytes(digest[8:], "big")
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for position in self.get_positions(item):
+            self.bits[position // 8] |= 1 << (position % 8)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(
+            self.bits[position // 8] & (1 << (position % 8))
+            for position in self.get_positions(item)
+        )
+
+
+class BlobFilter:
+    """A per-process Bloom filter of the digests of all blobs, so a lookup for
+    a blob that definitely does not exist (e.g., most HEAD requests during a
+    push) doesn't need the database. The filter is loaded on first use, and
+    blobs finished in this process are added right away. Other processes are
+    followed with a version kept in the shared cache: when it changes, blobs
+    modified since the last refresh are added. Deleted blobs stay in the
+    filter (they are only a false positive) until it is rebuilt when full.
+    """
+
+    def __init__(self):
+        self.bloom = None
+        self.version = None
+        self.refreshed = None
+        self.lock = threading.Lock()
+
+    def get_version(self):
+        return cache.caches["django_oci_upload"].get(VERSION_KEY)
+
+    def changed(self):
+        """Tell other processes that blobs changed, and should be refreshed"""
+        cache.caches["django_oci_upload"].set(VERSION_KEY, str(uuid.uuid4()), None)
+
+    def load(self, version):
+        """Build the filter from all blobs, with room to grow"""
+        count = Blob.objects.count()
+        capacity = max(settings.BLOB_FILTER_CAPACITY, count * 2)
+        self.bloom = BloomFilter(capacity)
+        self.refreshed = timezone.now()
+        for digest in Blob.objects.values_list("digest", flat=True).iterator():
+            self.bloom.add(digest)
+        self.version = version
+
+    def refresh(self, version):
+        """Add blobs modified since the last refresh (finished in other processes)"""
+        since = self.refreshed - REFRESH_OVERLAP
+        self.refreshed = timezone.now()
+        blobs = Blob.objects.filter(modify_date__gte=since)
+        for digest in blobs.values_list("digest", flat=True).iterator():
+            self.bloom.add(digest)
+        self.version = version
+
+        # A full filter has a high false positive rate, so rebuild it
+        if self.bloom.count > self.bloom.capacity:
+            self.load(version)
+
+    def add(self, digest):
+        """Add a blob finished in this process"""
+        with self.lock:
+            if self.bloom is not None:
+                self.bloom.add(digest)
+
+    def might_contain(self, digest):
+        """Return False if a blob with the digest definitely does not exist"""
+        if not settings.BLOB_FILTER_CAPACITY:
+            return True
+        with self.lock:
+            version = self.get_version()
+            if self.bloom is None:
+                self.load(version)
+            elif version != self.version:
+                self.refresh(version)
+            return digest in self.bloom
+
+
+blob_filter = BlobFilter()
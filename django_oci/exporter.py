@@ -0,0 +1,213 @@
+"""
+
+Copyright (c) 2020-2023, Vanessa Sochat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import json
+import logging
+import os
+import tarfile
+import time
+
+from django_oci import settings
+from django_oci.models import Blob, ChildManifest
+from django_oci.storage import storage
+
+logger = logging.getLogger(__name__)
+
+# The annotation that names (tags) a manifest in index.json
+REF_NAME = "org.opencontainers.image.ref.name"
+
+INDEX_MEDIA_TYPE = "application/vnd.oci.image.index.v1+json"
+
+
+class ExportError(Exception):
+    pass
+
+
+def get_blob_name(digest):
+    return "blobs/%s" % digest.replace(":", "/", 1)
+
+
+class LayoutExport:
+    """The export of a repository (or some of its tags) as the tar of an OCI
+    image layout: oci-layout, index.json (with the tags as ref names) and
+    the manifests and blobs under blobs/<algorithm>/<hex>. The tar is
+    streamed: blobs are read from storage in chunks, and each is written
+    once however many manifests share it.
+    """
+
+    def __init__(self, repository, tags=None, read_ahead=None):
+        self.repository = repository
+        self.tags = tags
+        if read_ahead is None:
+            read_ahead = settings.EXPORT_READ_AHEAD
+        self.read_ahead = read_ahead
+        self.mtime = int(time.time())
+        self.offset = 0
+
+    def plan(self):
+        """Look up the manifests (and children of image indexes) and blobs to
+        export, and write index.json. Raises a ValueError for unknown tags,
+        and an ExportError if a blob is quarantined or its file is missing.
+        """
+        tags = self.repository.tag_set.select_related("image").order_by("name")
+        if self.tags:
+            tags = tags.filter(name__in=self.tags)
+            missing = set(self.tags) - set(x.name for x in tags)
+            if missing:
+                raise ValueError("Unknown tags: %s" % ", ".join(sorted(missing)))
+
+        images = self.repository.image_set.defer("manifest").order_by("version")
+        if self.tags:
+            selected = {tag.image.version for tag in tags}
+            pending = list(selected)
+            while pending:
+                children = ChildManifest.objects.filter(
+                    index__repository=self.repository, index__version__in=pending
+                ).values_list("digest", flat=True)
+                pending = [x for x in children if x not in selected]
+                selected.update(pending)
+            images = images.filter(version__in=selected)
+        self.images = list(images)
+
+        # Untagged manifests are listed too, unless an index lists them
+        descriptors = []
+        for tag in tags:
+            descriptors.append(self.get_descriptor(tag.image, {REF_NAME: tag.name}))
+        if not self.tags:
+            tagged = {tag.image_id for tag in tags}
+            children = set(
+                ChildManifest.objects.filter(
+                    index__repository=self.repository
+                ).values_list("digest", flat=True)
+            )
+            for image in self.images:
+                if image.id not in tagged and image.version not in children:
+                    descriptors.append(self.get_descriptor(image))
+
+        self.index = json.dumps(
+            {
+                "schemaVersion": 2,
+                "mediaType": INDEX_MEDIA_TYPE,
+                "manifests": descriptors,
+            },
+            indent=2,
+        ).encode("utf-8")
+        self.blobs = list(
+            Blob.objects.filter(image__in=self.images).distinct().order_by("digest")
+        )
+
+        # A layout without every blob is not valid, so we fail before streaming
+        quarantined = [blob.digest for blob in self.blobs if blob.quarantine_date]
+        if quarantined:
+            raise ExportError("Quarantined blobs: %s" % ", ".join(quarantined))
+        self.paths = [storage.locate_blob(blob) for blob in self.blobs]
+        missing = [
+            blob.digest for blob, path in zip(self.blobs, self.paths) if not path
+        ]
+        if missing:
+            raise ExportError("Missing blob files: %s" % ", ".join(missing))
+        return self
+
+    def get_descriptor(self, image, annotations=None):
+        # Manifests pushed before sizes were recorded need to be read
+        size = image.size
+        if size is None:
+            size = len(image.get_manifest())
+        descriptor = {
+            "mediaType": image.media_type or settings.IMAGE_MANIFEST_CONTENT_TYPE,
+            "digest": image.version,
+            "size": size,
+        }
+        if annotations:
+            descriptor["annotations"] = annotations
+        return descriptor
+
+    def write(self, data):
+        self.offset += len(data)
+        return data
+
+    def write_header(self, name, size):
+        """Return the tar header of a file, and the padding that follows it"""
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = self.mtime
+        info.mode = 0o644
+        return self.write(info.tobuf(format=tarfile.PAX_FORMAT))
+
+    def write_padding(self, size):
+        return self.write(b"\0" * (-size % tarfile.BLOCKSIZE))
+
+    def write_file(self, name, data):
+        yield self.write_header(name, len(data))
+        yield self.write(data)
+        yield self.write_padding(len(data))
+
+    def advise(self, paths):
+        """Ask the kernel to start reading files (in parallel, into the page
+        cache) so the next blobs are ready when the stream gets to them.
+        """
+        if not hasattr(os, "posix_fadvise"):
+            return
+        for path in paths:
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+
+    def stream(self):
+        """Yield the tar in chunks, reading each blob from storage. A blob file
+        that goes missing once streaming has started raises an ExportError,
+        aborting the stream rather than writing an incomplete layout.
+        """
+        yield from self.write_file(
+            "oci-layout", json.dumps({"imageLayoutVersion": "1.0.0"}).encode("utf-8")
+        )
+        yield from self.write_file("index.json", self.index)
+
+        # The first blobs are read ahead together, and then one as each is written
+        paths = self.paths
+        for i, (blob, path) in enumerate(zip(self.blobs, paths)):
+            if self.read_ahead:
+                ahead = i + self.read_ahead
+                window = paths[: ahead + 1] if i == 0 else paths[ahead : ahead + 1]
+                self.advise(window)
+            try:
+                fh = open(path, "rb")
+            except OSError as exc:
+                logger.error(f"Aborting export, blob {blob.digest} is missing.")
+                raise ExportError("Missing blob file: %s" % blob.digest) from exc
+
+            # The size is taken from the file, so the header always matches it
+            size = os.fstat(fh.fileno()).st_size
+            yield self.write_header(get_blob_name(blob.digest), size)
+            for chunk in storage.read_blob(fh, 0, size - 1):
+                yield self.write(chunk)
+            yield self.write_padding(size)
+
+        for image in self.images:
+            yield from self.write_file(
+                get_blob_name(image.version), bytes(image.get_manifest())
+            )
+
+        # The end of the archive is two empty blocks, padded to a whole record
+        end = tarfile.BLOCKSIZE * 2
+        yield self.write(b"\0" * (end + (-(self.offset + end) % tarfile.RECORDSIZE)))
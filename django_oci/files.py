@@ -23,19 +23,28 @@ from datetime import timezone
 from django.core.files.base import ContentFile
 from django.core.files.uploadedfile import UploadedFile
 from django.db import models
+from django.middleware import cache
 
+from django_oci import settings
 from django_oci.settings import MEDIA_ROOT
 
 
+def get_session_dir():
+    """Upload sessions are kept in the blob store, so that finishing a blob is
+    a rename on the same filesystem. A chunked upload only gives its digest
+    (and so its storage root) at the end, so with STORAGE_ROOTS on another
+    filesystem it is copied instead.
+    """
+    return os.path.join(MEDIA_ROOT, "blobs", ".sessions")
+
+
 class ChunkedUpload(models.Model):
     """We can use an abstract class to interact with a chunked upload without
     saving anything to the database.
     """
 
     session_id = models.CharField(max_length=255)
-    file = models.FileField(
-        max_length=255, upload_to=os.path.join(MEDIA_ROOT, "sessions")
-    )
+    file = models.FileField(max_length=255, upload_to=get_session_dir())
     offset = models.BigIntegerField(default=0)
 
     @property
@@ -75,8 +84,8 @@ class ChunkedUpload(models.Model):
 
     def write_chunk(self, chunk, chunk_start):
         """Append a chunk to the file, or write the file if it doesn't exist yet.
-        This is done to a temporary storage location in images/sessions until
-        the blob is finalized.
+        This is done to a temporary storage location in images/blobs/.sessions
+        until the blob is finalized.
         """
         self.file.close()
 
@@ -106,3 +115,82 @@ class ChunkedUpload(models.Model):
         self.file.close()
         self.file.open(mode="rb")  # mode = read+binary
         return UploadedFile(file=self.file, name=self.filename, size=self.offset)
+
+
+class RangeMap:
+    """A compact map of the byte ranges received for an upload session, kept
+    as a sorted list of non-overlapping [start, end) ranges, with adjacent
+    ranges merged. A complete upload is a single range starting at 0.
+    """
+
+    def __init__(self, ranges=None):
+        self.ranges = [list(x) for x in ranges or []]
+
+    def overlaps(self, start, end):
+        return any(start < x_end and x_start < end for x_start, x_end in self.ranges)
+
+    def add(self, start, end):
+        """Add a range [start, end), merging it with any it touches"""
+        merged = []
+        for x_start, x_end in self.ranges:
+            if x_end < start or x_start > end:
+                merged.append([x_start, x_end])
+            else:
+                start, end = min(start, x_start), max(end, x_end)
+        merged.append([start, end])
+        self.ranges = sorted(merged)
+
+    @property
+    def size(self):
+        """The size of the upload, the end of the last range received"""
+        return self.ranges[-1][1] if self.ranges else 0
+
+    @property
+    def offset(self):
+        """The number of contiguous bytes received from the start"""
+        if self.ranges and self.ranges[0][0] == 0:
+            return self.ranges[0][1]
+        return 0
+
+    @property
+    def complete(self):
+        return len(self.ranges) == 1 and self.ranges[0][0] == 0
+
+
+def get_upload_session(session_id):
+    """Get the metadata for an upload session, or None if it has expired"""
+    filecache = cache.caches["django_oci_upload"]
+    return filecache.get(session_id)
+
+
+def update_upload_session(session_id, **metadata):
+    """Update the metadata for an upload session that has not expired, which
+    also renews it for another SESSION_EXPIRES_SECONDS.
+    """
+    filecache = cache.caches["django_oci_upload"]
+    session = filecache.get(session_id)
+    if not session:
+        return
+    session.update(metadata)
+    filecache.set(session_id, session, timeout=settings.SESSION_EXPIRES_SECONDS)
+
+
+def get_upload_ranges(session_id):
+    """Get the range map of bytes received for an upload session"""
+    filecache = cache.caches["django_oci_upload"]
+    return RangeMap(filecache.get("%s/ranges" % session_id))
+
+
+def set_upload_ranges(session_id, ranges):
+    """Save the range map of bytes received for an upload session"""
+    filecache = cache.caches["django_oci_upload"]
+    filecache.set(
+        "%s/ranges" % session_id,
+        ranges.ranges,
+        timeout=settings.SESSION_EXPIRES_SECONDS,
+    )
+
+
+def delete_upload_ranges(session_id):
+    filecache = cache.caches["django_oci_upload"]
+    filecache.delete("%s/ranges" % session_id)
@@ -0,0 +1,449 @@
+"""
+
+Copyright (c) 2020-2023, Vanessa Sochat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+from django.db import transaction
+
+from django_oci import settings
+from django_oci.bloom import blob_filter
+from django_oci.models import (
+    Annotation,
+    Blob,
+    ChildManifest,
+    Image,
+    Repository,
+    Tag,
+    calculate_digest,
+    forget_image,
+    get_manifest_fields,
+    upsert_rows,
+)
+from django_oci.storage import storage
+from django_oci.usage import reconcile
+from django_oci.utils import TAG_REGEX
+
+logger = logging.getLogger(__name__)
+
+# The number of rows written in one transaction
+BATCH_SIZE = 1000
+
+# The ioctl to share the extents of one file with another (Linux)
+FICLONE = 0x40049409
+
+
+class OciLayout:
+    """An OCI image layout: an index.json of manifests (tagged with the
+    org.opencontainers.image.ref.name annotation) and blobs/<algorithm>/<hex>.
+    A layout holds one repository, so it is imported under a given name.
+    """
+
+    def __init__(self, path, name):
+        self.path = path
+        self.name = name
+
+    @classmethod
+    def detect(cls, path):
+        return os.path.exists(os.path.join(path, "oci-layout"))
+
+    def get_blob_path(self, digest):
+        return os.path.join(self.path, "blobs", *digest.split(":", 1))
+
+    def get_repositories(self):
+        """Yield the repository name, its manifest digests, tags and blobs"""
+        with open(os.path.join(self.path, "index.json")) as fd:
+            index = json.load(fd)
+
+        tags = {}
+        for descriptor in index.get("manifests", []):
+            tag = descriptor.get("annotations", {}).get(
+                "org.opencontainers.image.ref.name"
+            )
+            if tag and TAG_REGEX.match(tag):
+                tags[tag] = descriptor["digest"]
+            elif tag:
+                logger.warning(f"Skipping tag {tag}, it isn't a valid tag.")
+
+        # The blobs of a layout are those its manifests reference
+        manifests = [x["digest"] for x in index.get("manifests", [])]
+        yield self.name, manifests, tags, []
+
+
+class RegistryTree:
+    """The filesystem tree of a Docker registry (distribution) v2 storage
+    driver: blobs by digest under blobs/, and per repository links to its
+    manifests (_manifests/revisions), tags (_manifests/tags) and layers.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        nested = os.path.join(path, "docker", "registry", "v2")
+        if os.path.isdir(nested):
+            self.path = nested
+
+    @classmethod
+    def detect(cls, path):
+        return os.path.isdir(
+            os.path.join(path, "docker", "registry", "v2", "repositories")
+        ) or os.path.isdir(os.path.join(path, "repositories"))
+
+    def get_blob_path(self, digest):
+        algorithm, hexdigest = digest.split(":", 1)
+        return os.path.join(
+            self.path, "blobs", algorithm, hexdigest[:2], hexdigest, "data"
+        )
+
+    def get_links(self, path):
+        """Return the digests linked under a directory of <algorithm>/<hex>/link"""
+        digests = []
+        if not os.path.isdir(path):
+            return digests
+        for algorithm in sorted(os.listdir(path)):
+            for hexdigest in sorted(os.listdir(os.path.join(path, algorithm))):
+                if os.path.exists(os.path.join(path, algorithm, hexdigest, "link")):
+                    digests.append("%s:%s" % (algorithm, hexdigest))
+        return digests
+
+    def get_repositories(self):
+        """Yield the repository name, its manifest digests, tags and blobs for
+        every directory with a _manifests directory (names can be nested).
+        """
+        repositories = os.path.join(self.path, "repositories")
+        for root, dirs, _ in os.walk(repositories):
+            dirs.sort()
+            if "_manifests" not in dirs:
+                continue
+            name = os.path.relpath(root, repositories)
+            manifests = self.get_links(os.path.join(root, "_manifests", "revisions"))
+
+            tags = {}
+            tags_dir = os.path.join(root, "_manifests", "tags")
+            for tag in sorted(os.listdir(tags_dir)) if os.path.isdir(tags_dir) else []:
+                link = os.path.join(tags_dir, tag, "current", "link")
+                if os.path.exists(link):
+                    with open(link) as fd:
+                        tags[tag] = fd.read().strip()
+
+            blobs = self.get_links(os.path.join(root, "_layers"))
+            dirs[:] = [x for x in dirs if not x.startswith("_")]
+            yield name, manifests, tags, blobs
+
+
+def get_source(path, name=None):
+    """Return the source to import from a path: an OCI image layout (which
+    needs a repository name) or a registry v2 storage tree.
+    """
+    if OciLayout.detect(path):
+        if not name:
+            raise ValueError("An OCI image layout needs a repository name.")
+        return OciLayout(path, name)
+    if RegistryTree.detect(path):
+        return RegistryTree(path)
+    raise ValueError(f"{path} is not an OCI image layout or registry v2 tree.")
+
+
+def reflink(source, destination):
+    """Make destination a copy of source that shares its extents (on btrfs,
+    XFS and others), so it is as fast as a link but a separate file.
+    """
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def link_blob(source, destination):
+    """Put a file in place as a hardlink to the source, or a reflink, or a copy
+    (e.g., across filesystems), under a temporary name and then renamed.
+    """
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    tmp = "%s.tmp-%s" % (destination, uuid.uuid4())
+    try:
+        os.link(source, tmp)
+    except OSError:
+        try:
+            reflink(source, tmp)
+        except OSError:
+            shutil.copyfile(source, tmp)
+    os.replace(tmp, destination)
+
+
+def import_blob(digest, source, destination):
+    """Check a source blob against its digest and link it into storage (in a
+    worker process). Returns the digest, and its size, or None if the
+    source is missing or doesn't match.
+    """
+    algorithm, expected = digest.split(":", 1)
+    try:
+        hasher = hashlib.new(algorithm)
+        with open(source, "rb") as fd:
+            for chunk in iter(lambda: fd.read(1024 * 1024), b""):
+                hasher.update(chunk)
+    except (OSError, ValueError):
+        return digest, None
+    if hasher.hexdigest() != expected:
+        return digest, None
+    link_blob(source, destination)
+    return digest, os.path.getsize(destination)
+
+
+def get_batches(items, size=BATCH_SIZE):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
+class RepositoryImport:
+    """The import of one repository from a source. Blobs and manifests that
+    the repository already has are skipped, and rows are written in batches
+    with one transaction each, so an import that stops can be run again.
+    """
+
+    def __init__(self, source, name, manifests, tags, blobs):
+        self.source = source
+        self.name = name
+        self.manifest_digests = manifests
+        self.tags = tags
+        self.blob_digests = set(blobs)
+        self.manifests = {}
+        self.counts = {"blobs": 0, "manifests": 0, "tags": 0, "failed": 0}
+
+    def __str__(self):
+        return "%s: %s" % (
+            self.name,
+            ", ".join("%s %s" % (value, key) for key, value in self.counts.items()),
+        )
+
+    def read_manifests(self):
+        """Read the manifests (and the children of image indexes), collecting
+        the blobs they reference.
+        """
+        pending = list(self.manifest_digests) + list(self.tags.values())
+        while pending:
+            digest = pending.pop()
+            if digest in self.manifests:
+                continue
+            try:
+                with open(self.source.get_blob_path(digest), "rb") as fd:
+                    body = fd.read()
+            except OSError:
+                logger.warning(
+                    f"Skipping manifest {self.name}@{digest}, it is missing."
+                )
+                self.counts["failed"] += 1
+                continue
+            if "sha256:%s" % calculate_digest(body) != digest:
+                logger.warning(
+                    f"Skipping manifest {self.name}@{digest}, it doesn't match."
+                )
+                self.counts["failed"] += 1
+                continue
+
+            self.manifests[digest] = body
+            manifest = json.loads(body)
+            pending += [x["digest"] for x in manifest.get("manifests", [])]
+            if manifest.get("config", {}).get("digest"):
+                self.blob_digests.add(manifest["config"]["digest"])
+            self.blob_digests.update(x["digest"] for x in manifest.get("layers", []))
+
+    def import_blobs(self, executor):
+        """Hash and link the blobs the repository doesn't have yet with the
+        pool of worker processes, and write their rows.
+        """
+        existing = set(
+            Blob.objects.filter(
+                repository=self.repository,
+                digest__in=self.blob_digests,
+                size__isnull=False,
+                quarantine_date__isnull=True,
+            ).values_list("digest", flat=True)
+        )
+        digests = sorted(self.blob_digests - existing)
+        for batch in get_batches(digests):
+            sources = [self.source.get_blob_path(x) for x in batch]
+            destinations = [storage.get_blob_path(self.repository, x) for x in batch]
+            blobs = []
+            for digest, size in executor.map(
+                import_blob, batch, sources, destinations, chunksize=16
+            ):
+                if size is None:
+                    logger.warning(
+                        f"Skipping blob {self.name}@{digest}, it is missing or doesn't match."
+                    )
+                    self.counts["failed"] += 1
+                    continue
+                blob = Blob(
+                    repository=self.repository,
+                    digest=digest,
+                    content_type=settings.DEFAULT_CONTENT_TYPE,
+                )
+                blob.datafile.name = storage.get_blob_path(self.repository, digest)
+                storage.set_blob_metadata(blob, digest, size=size)
+                blobs.append(blob)
+
+            with transaction.atomic():
+                upsert_rows(
+                    Blob,
+                    blobs,
+                    unique_fields=["repository", "digest"],
+                    update_fields=[
+                        "datafile",
+                        "size",
+                        "algorithm",
+                        "storage_key",
+                        "verify_date",
+                        "quarantine_date",
+                        "modify_date",
+                    ],
+                )
+            self.counts["blobs"] += len(blobs)
+
+    def import_manifests(self):
+        """Write the images the repository doesn't have yet, with their child
+        manifests and annotations, in the same transaction. Blob links are
+        written for every image, so a blob imported after its image (e.g.,
+        on a second run) is linked to it.
+        """
+        existing = set(
+            Image.objects.filter(
+                repository=self.repository, version__in=list(self.manifests)
+            ).values_list("version", flat=True)
+        )
+        blob_ids = dict(
+            Blob.objects.filter(
+                repository=self.repository, digest__in=self.blob_digests
+            ).values_list("digest", "id")
+        )
+        for batch in get_batches(sorted(self.manifests)):
+            created = [x for x in batch if x not in existing]
+            with transaction.atomic():
+                images = []
+                for digest in created:
+                    body = self.manifests[digest]
+                    images.append(
+                        Image(
+                            repository=self.repository,
+                            version=digest,
+                            size=len(body),
+                            media_type=json.loads(body).get("mediaType")
+                            or settings.IMAGE_MANIFEST_CONTENT_TYPE,
+                            **get_manifest_fields(body),
+                        )
+                    )
+                Image.objects.bulk_create(images)
+
+                # Not all databases return the ids of inserted rows
+                image_ids = dict(
+                    Image.objects.filter(
+                        repository=self.repository, version__in=batch
+                    ).values_list("version", "id")
+                )
+                links, children, annotations = [], [], []
+                for digest in batch:
+                    image_id = image_ids[digest]
+                    manifest = json.loads(self.manifests[digest])
+                    layers = [manifest.get("config", {})] + manifest.get("layers", [])
+                    for layer in layers:
+                        if layer.get("digest") in blob_ids:
+                            links.append(
+                                Image.blobs.through(
+                                    image_id=image_id, blob_id=blob_ids[layer["digest"]]
+                                )
+                            )
+                    if digest in existing:
+                        continue
+                    for child in manifest.get("manifests", []):
+                        platform = child.get("platform", {})
+                        children.append(
+                            ChildManifest(
+                                index_id=image_id,
+                                digest=child.get("digest"),
+                                media_type=child.get("mediaType"),
+                                size=child.get("size"),
+                                os=platform.get("os"),
+                                architecture=platform.get("architecture"),
+                                variant=platform.get("variant"),
+                            )
+                        )
+                    for key, value in manifest.get("annotations", {}).items():
+                        annotations.append(
+                            Annotation(image_id=image_id, key=key, value=value)
+                        )
+                Image.blobs.through.objects.bulk_create(links, ignore_conflicts=True)
+                ChildManifest.objects.bulk_create(children)
+                Annotation.objects.bulk_create(annotations, ignore_conflicts=True)
+            self.counts["manifests"] += len(created)
+
+    def import_tags(self):
+        """Point the tags at their manifests (moving any that the repository
+        has at another), and forget the lookups of them.
+        """
+        image_ids = dict(
+            Image.objects.filter(
+                repository=self.repository, version__in=list(self.tags.values())
+            ).values_list("version", "id")
+        )
+        tags = [
+            Tag(
+                repository=self.repository,
+                name=tag,
+                image_id=image_ids[digest],
+                digest=digest,
+            )
+            for tag, digest in sorted(self.tags.items())
+            if digest in image_ids
+        ]
+        for batch in get_batches(tags):
+            upsert_rows(
+                Tag,
+                batch,
+                unique_fields=["repository", "name"],
+                update_fields=["image", "digest"],
+            )
+        for tag in tags:
+            forget_image(self.name, tag.digest, tag.name)
+        self.counts["tags"] = len(tags)
+
+    def run(self, executor):
+        self.repository, _ = Repository.objects.get_or_create(name=self.name)
+        self.read_manifests()
+        self.import_blobs(executor)
+        self.import_manifests()
+        self.import_tags()
+
+        # Rows written in bulk skip the usage counters, so count them again
+        reconcile(self.repository)
+        blob_filter.changed()
+
+
+def import_registry(path, name=None, workers=4):
+    """Import the repositories of an OCI image layout (as name) or a registry
+    v2 storage tree, hashing and linking blobs with a pool of worker
+    processes. Yields each repository import as it finishes.
+    """
+    source = get_source(path, name)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for repository in source.get_repositories():
+            job = RepositoryImport(source, *repository)
+            job.run(executor)
+            yield job
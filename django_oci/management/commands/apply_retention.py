@@ -0,0 +1,56 @@
+"""
+
+Copyright (c) 2020-2023, Vanessa Sochat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+from django.core.management.base import BaseCommand
+
+from django_oci.models import Repository
+from django_oci.retention import RetentionPlan, get_rule
+
+
+class Command(BaseCommand):
+    help = "Delete the tags, manifests and blobs that RETENTION_RULES don't keep"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--repository", help="only apply the rules to this repository"
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="only report what would be deleted (and the bytes reclaimed)",
+        )
+
+    def handle(self, *args, **options):
+        repositories = Repository.objects.order_by("name")
+        if options["repository"]:
+            repositories = repositories.filter(name=options["repository"])
+
+        total = 0
+        action = "Would delete" if options["dry_run"] else "Deleted"
+        for repository in repositories.iterator():
+            rule = get_rule(repository.name)
+            if not rule:
+                continue
+            plan = RetentionPlan(repository, rule)
+            if not plan.tags and not plan.images:
+                continue
+            if not options["dry_run"]:
+                plan.apply()
+            total += plan.size
+            self.stdout.write(f"{action} {plan}")
+        self.stdout.write(f"{action} {total} bytes in total.")
@@ -0,0 +1,83 @@
+"""
+
+Copyright (c) 2020-2023, Vanessa Sochat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from django_oci.models import Blob
+from django_oci.storage import storage
+
+
+def stat_blob(blob):
+    """Return the size of a blob file, or None if it is missing"""
+    try:
+        return os.stat(blob.datafile.name).st_size
+    except OSError:
+        return None
+
+
+class Command(BaseCommand):
+    help = "Record the size, digest algorithm and storage key of existing blobs"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers", type=int, default=16, help="files to stat in parallel"
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=500, help="blobs to update at once"
+        )
+        parser.add_argument(
+            "--all", action="store_true", help="include blobs that have a size"
+        )
+
+    def handle(self, *args, **options):
+        blobs = Blob.objects.exclude(datafile="").only("id", "digest", "datafile")
+        if not options["all"]:
+            blobs = blobs.filter(size__isnull=True)
+
+        updated = missing = 0
+        batch_size = options["batch_size"]
+        with ThreadPoolExecutor(max_workers=options["workers"]) as executor:
+            batch = []
+            for blob in blobs.iterator(chunk_size=batch_size):
+                batch.append(blob)
+                if len(batch) == batch_size:
+                    count = self.update(executor, batch)
+                    updated += count
+                    missing += len(batch) - count
+                    batch = []
+            if batch:
+                count = self.update(executor, batch)
+                updated += count
+                missing += len(batch) - count
+
+        self.stdout.write(f"Updated {updated} blobs, {missing} with missing files.")
+
+    def update(self, executor, batch):
+        """Stat a batch of blobs in parallel and save them in one query"""
+        found = []
+        for blob, size in zip(batch, executor.map(stat_blob, batch)):
+            if size is None:
+                self.stderr.write(f"{blob.digest} is missing {blob.datafile.name}")
+                continue
+            storage.set_blob_metadata(blob, blob.digest, size=size)
+            found.append(blob)
+        Blob.objects.bulk_update(found, ["size", "algorithm", "storage_key"])
+        return len(found)
@@ -0,0 +1,76 @@
+"""
+
+Copyright (c) 2020-2023, Vanessa Sochat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import os
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from django_oci.exporter import ExportError, LayoutExport
+from django_oci.models import Repository
+
+
+class Command(BaseCommand):
+    help = "Write a repository (or some of its tags) as an OCI image layout tar"
+
+    def add_arguments(self, parser):
+        parser.add_argument("repository", help="the repository to export")
+        parser.add_argument("output", help="the tar file to write (- for stdout)")
+        parser.add_argument(
+            "--tag", action="append", help="a tag to export (can be repeated)"
+        )
+        parser.add_argument(
+            "--read-ahead",
+            type=int,
+            help="blobs to read ahead (defaults to EXPORT_READ_AHEAD)",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            repository = Repository.objects.get(name=options["repository"])
+        except Repository.DoesNotExist:
+            raise CommandError(f"There is no repository {options['repository']}.")
+
+        try:
+            export = LayoutExport(
+                repository, tags=options["tag"], read_ahead=options["read_ahead"]
+            ).plan()
+        except (ValueError, ExportError) as exc:
+            raise CommandError(str(exc))
+
+        # An export that fails part of the way does not leave a partial tar
+        output = options["output"]
+        fd = sys.stdout.buffer if output == "-" else open(output, "wb")
+        try:
+            for chunk in export.stream():
+                fd.write(chunk)
+        except ExportError as exc:
+            if fd is not sys.stdout.buffer:
+                fd.close()
+                os.remove(output)
+            raise CommandError(str(exc))
+        finally:
+            if fd is not sys.stdout.buffer:
+                fd.close()
+
+        # Keep stdout for the tar
+        if output != "-":
+            self.stdout.write(
+                f"Exported {len(export.images)} manifests and {len(export.blobs)} "
+                f"blobs ({export.offset} bytes) to {output}."
+            )
@@ -0,0 +1,49 @@
+"""
+
+Copyright (c) 2020-2023, Vanessa Sochat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from django_oci.importer import import_registry
+
+
+class Command(BaseCommand):
+    help = (
+        "Import the repositories of an OCI image layout or a registry v2 storage tree"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "path",
+            help="an OCI image layout, or the root of a registry (docker/registry/v2)",
+        )
+        parser.add_argument(
+            "--repository", help="the repository to import an OCI image layout as"
+        )
+        parser.add_argument(
+            "--workers", type=int, default=4, help="processes to hash blobs with"
+        )
+
+    def handle(self, *args, **options):
+        try:
+            imports = import_registry(
+                options["path"], options["repository"], options["workers"]
+            )
+            for job in imports:
+                self.stdout.write(f"Imported {job}.")
+        except ValueError as exc:
+            raise CommandError(str(exc))
@@ -0,0 +1,71 @@
+"""
+
+Copyright (c) 2020-2023, Vanessa Sochat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from django_oci.models import Blob
+from django_oci.storage import storage
+
+
+def relocate_blob(blob):
+    """Move one blob (in a worker thread) to the root it hashes to"""
+    try:
+        return storage.relocate_blob(blob)
+    finally:
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = "Move blobs to the storage root they hash to, e.g., after adding one to STORAGE_ROOTS"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers", type=int, default=4, help="blobs to move in parallel"
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="only report the blobs (and bytes) that would move",
+        )
+
+    def handle(self, *args, **options):
+        # Upload sessions are finished into the right root already
+        blobs = (
+            Blob.objects.exclude(datafile="")
+            .exclude(digest__startswith="session-")
+            .select_related("repository")
+        )
+
+        # Only files that are not on the root they hash to need to move, and
+        # a file shared by mounted blobs is moved once (with all of its rows)
+        misplaced = {}
+        for blob in blobs.iterator(chunk_size=500):
+            if blob.datafile.name not in misplaced and storage.is_misplaced(blob):
+                misplaced[blob.datafile.name] = blob
+        size = sum(blob.size or 0 for blob in misplaced.values())
+
+        if options["dry_run"]:
+            self.stdout.write(f"Would move {len(misplaced)} blobs ({size} bytes).")
+            return
+
+        with ThreadPoolExecutor(max_workers=options["workers"]) as executor:
+            moved = sum(executor.map(relocate_blob, misplaced.values()))
+        self.stdout.write(f"Moved {moved} of {len(misplaced)} blobs ({size} bytes).")
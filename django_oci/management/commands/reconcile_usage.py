@@ -0,0 +1,68 @@
+"""
+
+Copyright (c) 2020-2023, Vanessa Sochat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from django_oci.models import Repository, RepositoryUsage
+from django_oci.usage import reconcile
+
+
+def reconcile_repository(repository):
+    """Recompute the usage of one repository (in a worker thread), returning
+    the usage before and after.
+    """
+    try:
+        before = (
+            RepositoryUsage.objects.filter(repository=repository)
+            .values("blob_count", "blob_bytes", "manifest_count")
+            .first()
+        )
+        return repository, before, reconcile(repository)
+    finally:
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = "Recompute the storage used by each repository from its blobs and manifests"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers", type=int, default=8, help="repositories to count in parallel"
+        )
+        parser.add_argument(
+            "--repository", help="only recompute the usage of this repository"
+        )
+
+    def handle(self, *args, **options):
+        repositories = Repository.objects.order_by("name")
+        if options["repository"]:
+            repositories = repositories.filter(name=options["repository"])
+
+        corrected = 0
+        with ThreadPoolExecutor(max_workers=options["workers"]) as executor:
+            for repository, before, after in executor.map(
+                reconcile_repository, repositories.iterator()
+            ):
+                counts = {key: after[key] for key in before or {}}
+                if before != counts:
+                    corrected += 1
+                    self.stdout.write(f"{repository.name}: {before} -> {after}")
+        self.stdout.write(f"Corrected the usage of {corrected} repositories.")
@@ -0,0 +1,67 @@
+"""
+
+Copyright (c) 2020-2023, Vanessa Sochat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from django_oci.models import ReplicationEvent
+from django_oci.replication import replicate
+
+
+class Command(BaseCommand):
+    help = "Replicate pushed blobs and manifests to REPLICATION_TARGETS"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers", type=int, default=4, help="events to deliver in parallel"
+        )
+        parser.add_argument(
+            "--every",
+            type=int,
+            help="keep running, looking for events every N seconds",
+        )
+        parser.add_argument(
+            "--retry-failed",
+            action="store_true",
+            help="retry the events that were given up on",
+        )
+
+    def handle(self, *args, **options):
+        if options["retry_failed"]:
+            retried = ReplicationEvent.objects.filter(next_attempt__isnull=True).update(
+                next_attempt=timezone.now(), attempts=0
+            )
+            self.stdout.write(f"Retrying {retried} events.")
+
+        while True:
+            total_delivered, total_failed = 0, 0
+            while True:
+                delivered, failed = replicate(workers=options["workers"])
+                total_delivered += delivered
+                total_failed += failed
+                if not delivered + failed:
+                    break
+            if total_delivered or total_failed or not options["every"]:
+                self.stdout.write(
+                    f"Delivered {total_delivered} events, {total_failed} failed."
+                )
+            if not options["every"]:
+                return
+            time.sleep(options["every"])
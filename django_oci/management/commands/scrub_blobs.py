@@ -0,0 +1,75 @@
+"""
+
+Copyright (c) 2020-2023, Vanessa Sochat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from django_oci.scrub import CORRUPT, MISSING, OK, scrub
+
+
+class Command(BaseCommand):
+    help = "Check that blob files match their digests, and quarantine those that don't"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers", type=int, default=4, help="blobs to check in parallel"
+        )
+        parser.add_argument(
+            "--rate",
+            type=int,
+            help="bytes per second to read (defaults to SCRUB_BYTES_PER_SECOND)",
+        )
+        parser.add_argument(
+            "--interval-days",
+            type=int,
+            help="days before a blob is checked again (defaults to SCRUB_INTERVAL_DAYS)",
+        )
+        parser.add_argument(
+            "--every",
+            type=int,
+            help="keep running, starting a scrub every N seconds",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="only report the blobs that don't match",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            results = scrub(
+                workers=options["workers"],
+                rate=options["rate"],
+                interval_days=options["interval_days"],
+                dry_run=options["dry_run"],
+            )
+            action = "Would quarantine" if options["dry_run"] else "Quarantined"
+            for result in [CORRUPT, MISSING]:
+                for blob in results[result]:
+                    self.stdout.write(
+                        f"{action} {blob.repository.name}@{blob.digest} ({result})"
+                    )
+            self.stdout.write(
+                f"Checked {sum(len(x) for x in results.values())} blobs, "
+                f"{len(results[OK])} ok, {len(results[CORRUPT])} corrupt, "
+                f"{len(results[MISSING])} missing."
+            )
+            if not options["every"]:
+                return
+            time.sleep(options["every"])
@@ -0,0 +1,50 @@
+"""
+
+Copyright (c) 2020-2023, Vanessa Sochat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+from django.core.management.base import BaseCommand
+
+from django_oci.models import Image, calculate_digest
+from django_oci.storage import storage
+
+
+class Command(BaseCommand):
+    help = "Move manifests kept in the database to the storage backend"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size", type=int, default=100, help="manifests to move at once"
+        )
+
+    def handle(self, *args, **options):
+        images = Image.objects.filter(manifest_key__isnull=True).only("id", "manifest")
+
+        moved = 0
+        batch = []
+        for image in images.iterator(chunk_size=options["batch_size"]):
+            body = bytes(image.manifest)
+            digest = "sha256:%s" % calculate_digest(body)
+            image.manifest_key = storage.save_manifest(digest, body)
+            image.manifest = b""
+            batch.append(image)
+            if len(batch) == options["batch_size"]:
+                Image.objects.bulk_update(batch, ["manifest", "manifest_key"])
+                moved += len(batch)
+                batch = []
+        Image.objects.bulk_update(batch, ["manifest", "manifest_key"])
+        moved += len(batch)
+        self.stdout.write(f"Moved {moved} manifests to storage.")
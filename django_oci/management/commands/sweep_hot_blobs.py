@@ -0,0 +1,48 @@
+"""
+
+Copyright (c) 2020-2023, Vanessa Sochat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+from django.core.management.base import BaseCommand
+
+from django_oci import settings
+from django_oci.tiers import sweep
+
+
+class Command(BaseCommand):
+    help = "Demote blobs from the hot storage tier until it is under its budget"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--budget",
+            type=int,
+            default=None,
+            help="bytes the hot tier may hold (defaults to HOT_STORAGE_BYTES)",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="only report the blobs (and bytes) that would be demoted",
+        )
+
+    def handle(self, *args, **options):
+        if not settings.HOT_STORAGE_ROOT:
+            self.stdout.write("HOT_STORAGE_ROOT is not set.")
+            return
+        demoted = sweep(budget=options["budget"], dry_run=options["dry_run"])
+        size = sum(x.size for x in demoted)
+        action = "Would demote" if options["dry_run"] else "Demoted"
+        self.stdout.write(f"{action} {len(demoted)} blobs ({size} bytes).")
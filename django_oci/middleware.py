@@ -0,0 +1,66 @@
+"""
+
+Copyright (c) 2020-2023, Vanessa Sochat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import hashlib
+
+from django.middleware import cache
+
+from django_oci import settings
+from django_oci.routers import get_replica, reading_from
+
+# Requests that read, and can be sent to a replica
+SAFE_METHODS = ["GET", "HEAD", "OPTIONS"]
+
+
+def get_pin_key(request):
+    """A client is known by its token (or credentials), or its address without one"""
+    client = request.META.get("HTTP_AUTHORIZATION") or request.META.get(
+        "REMOTE_ADDR", ""
+    )
+    return "replica-pin/%s" % hashlib.sha256(client.encode("utf-8")).hexdigest()
+
+
+class ReplicaMiddleware:
+    """Send the reads of GET and HEAD requests to one of DATABASE_REPLICAS
+    (with the ReplicaRouter). A replica can lag behind the primary, so after a
+    client writes (e.g., pushes a manifest), its requests are pinned to the
+    primary for DATABASE_REPLICA_PIN_SECONDS, and a pull right after a push
+    sees it. Pins are kept in the shared cache, for all processes.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not settings.DATABASE_REPLICAS:
+            return self.get_response(request)
+
+        filecache = cache.caches["django_oci_upload"]
+        key = get_pin_key(request)
+        replica = None
+        if request.method in SAFE_METHODS and not filecache.get(key):
+            replica = get_replica()
+
+        with reading_from(replica):
+            response = self.get_response(request)
+
+        # Only writes the client asked for pin it, and not the bookkeeping of a
+        # pull (e.g., caching a proxied manifest), so pulls keep using replicas
+        if request.method not in SAFE_METHODS and response.status_code < 400:
+            filecache.set(key, 1, timeout=settings.DATABASE_REPLICA_PIN_SECONDS)
+        return response
@@ -23,11 +23,14 @@ import re
 
 from django.contrib.auth.models import User
 from django.core.files.storage import FileSystemStorage
-from django.db import models
+from django.db import IntegrityError, connections, models, router, transaction
 from django.middleware import cache
 from django.urls import reverse
+from django.utils import timezone
 
 from django_oci import settings
+from django_oci.singleflight import SingleFlight
+from django_oci.utils import parse_platform
 
 PRIVACY_CHOICES = (
     (False, "Public (The collection will be accessible by anyone)"),
@@ -35,6 +38,20 @@ PRIVACY_CHOICES = (
 )
 
 
+# Coalesce concurrent identical image lookups
+image_lookups = SingleFlight("image")
+
+# The columns of an image that describe its manifest, without the manifest
+IMAGE_METADATA_FIELDS = [
+    "id",
+    "repository_id",
+    "version",
+    "media_type",
+    "size",
+    "manifest_key",
+]
+
+
 def get_privacy_default():
     return settings.PRIVATE_ONLY
 
@@ -73,34 +90,22 @@ def get_upload_folder(instance, filename):
     return filename
 
 
-def get_image_by_tag(name, reference, tag, create=False, body=None):
-    """given the name of a repository and a reference, look up the image
-    based on the reference. By default we use the reference to look for
-    a tag or digest. A return of None indicates that the image is not found,
-    and the view should deal with this (e.g., create the image) or raise
-    Http404.
-
-    Parameters
-    ==========
-    name (str): the name of the repository to lookup
-    reference (str): an image version string
-    tag (str): a tag that doesn't match as a version string
-    create (bool): if does not exist, create the image (new manifest push)
-    body (bytes): if we need to create, we must have a digest from the body
+def find_image(name, reference, tag):
+    """Look up the repository and image for a reference (digest) or tag,
+    returning None for either that does not exist.
     """
     # Ensure the repository exists
     try:
         repository = Repository.objects.get(name=name)
     except Repository.DoesNotExist:
-        return None
+        return None, None
 
     # reference can be a tag (more likely) or digest
     image = None
     if tag:
-        try:
-            image = repository.image_set.get(tag__name=tag)
-        except Image.DoesNotExist:
-            pass
+        found = repository.tag_set.select_related("image").filter(name=tag).first()
+        if found:
+            image = found.image
 
     elif reference:
         try:
@@ -108,19 +113,213 @@ def get_image_by_tag(name, reference, tag, create=False, body=None):
         except Image.DoesNotExist:
             pass
 
-    if not image and create:
-        if not reference and body:
-            reference = "sha256:%s" % calculate_digest(body)
-        image, _ = Image.objects.get_or_create(
-            repository=repository, version=reference, manifest=body
+    return repository, image
+
+
+def get_manifest_fields(body):
+    """Return the fields to save the bytes of a manifest. By default they are
+    kept in the database, and with a MANIFEST_STORAGE of "storage" they are
+    saved by digest with the blobs, and only the key is kept.
+    """
+    if settings.MANIFEST_STORAGE != "storage":
+        return {"manifest": body}
+    from django_oci.storage import storage
+
+    digest = "sha256:%s" % calculate_digest(body)
+    return {"manifest": b"", "manifest_key": storage.save_manifest(digest, body)}
+
+
+def find_image_metadata(name, reference, tag):
+    """Look up an image for a reference (digest) or tag in one query, loading
+    only the columns that describe the manifest (and not the manifest itself).
+    """
+    # A tag is one probe of the unique (repository, name) index
+    if tag:
+        found = (
+            Tag.objects.select_related("image")
+            .only("image", *["image__%s" % x for x in IMAGE_METADATA_FIELDS])
+            .filter(repository__name=name, name=tag)
+            .first()
         )
-        if tag:
-            tag, _ = Tag.objects.get_or_create(image=image, name=tag)
-            tag.image = image
-            tag.save()
+        return found.image if found else None
+
+    images = Image.objects.filter(repository__name=name).only(*IMAGE_METADATA_FIELDS)
+    if reference:
+        images = images.filter(version=reference)
+    else:
+        return None
+    return images.first()
+
+
+def forget_image(name, reference=None, tag=None):
+    """Forget any shared lookup of an image after it changes"""
+    for prefix in ["", "metadata/"]:
+        image_lookups.forget("%s%s/%s/%s" % (prefix, name, reference, tag))
+        image_lookups.forget("%s%s/%s/%s" % (prefix, name, None, tag))
+        image_lookups.forget("%s%s/%s/%s" % (prefix, name, reference, None))
+
+
+def get_image_metadata(name, reference, tag):
+    """Given the name of a repository and a reference or tag, return the image
+    with only its digest, media type and size loaded (e.g., for a HEAD request
+    or a client polling a tag), or None if it is not found.
+    """
+    key = "metadata/%s/%s/%s" % (name, reference, tag)
+    return image_lookups.do(key, lambda: find_image_metadata(name, reference, tag))
+
+
+def resolve_platform(name, reference, tag, platform):
+    """Given the name of a repository, a reference (digest) or tag for an image
+    index, and a platform (os/architecture[/variant]), return the digest of the
+    child manifest for the platform, or None. This is one indexed query.
+    """
+    try:
+        os_name, architecture, variant = parse_platform(platform)
+    except ValueError:
+        return None
+
+    children = ChildManifest.objects.filter(
+        index__repository__name=name, os=os_name, architecture=architecture
+    )
+    if tag:
+        children = children.filter(
+            index__tag__name=tag, index__tag__repository__name=name
+        )
+    elif reference:
+        children = children.filter(index__version=reference)
+    else:
+        return None
+
+    # Without a variant, any will do (but prefer one without)
+    if variant:
+        children = children.filter(variant=variant)
+    return (
+        children.order_by(models.F("variant").asc(nulls_first=True))
+        .values_list("digest", flat=True)
+        .first()
+    )
+
+
+def upsert_rows(model, rows, unique_fields, update_fields):
+    """Insert rows, or update the rows they conflict with on unique_fields, in
+    one statement (INSERT ... ON CONFLICT). Databases that can't name the
+    conflict (e.g., MySQL) get an update, or else an insert, for each row.
+    """
+    connection = connections[router.db_for_write(model)]
+    if connection.features.supports_update_conflicts_with_target:
+        return model.objects.bulk_create(
+            rows,
+            update_conflicts=True,
+            unique_fields=unique_fields,
+            update_fields=update_fields,
+        )
+
+    for row in rows:
+        fields = [model._meta.get_field(x) for x in unique_fields]
+        lookup = {x.attname: getattr(row, x.attname) for x in fields}
+        fields = [model._meta.get_field(x) for x in update_fields]
+        values = {x.attname: x.pre_save(row, False) for x in fields}
+        existing = model.objects.filter(**lookup)
+        if not existing.update(**values):
+            try:
+                with transaction.atomic():
+                    model.objects.bulk_create([row])
+            except IntegrityError:
+                existing.update(**values)
 
-        # This saves annotations and layer (blob) associations
-        image.update_manifest(body)
+        # An update (or an insert, on some databases) doesn't set the id
+        if row.pk is None:
+            row.pk = existing.values_list("pk", flat=True).first()
+    return rows
+
+
+def upsert_image(repository, reference, body):
+    """Insert the image for a manifest digest in a repository, or update it if
+    it exists, in one statement (INSERT ... ON CONFLICT), so concurrent pushes
+    of a manifest can't collide.
+    """
+    from django_oci.usage import add_image_usage
+
+    fields = get_manifest_fields(body)
+    fields["size"] = len(body)
+    image = Image(repository=repository, version=reference, **fields)
+
+    # Writing the repository row first serializes pushes to it, so a concurrent
+    # push of the same manifest sees this one and its usage is counted once
+    # (and a sqlite transaction that writes first can wait on another writer)
+    with transaction.atomic():
+        Repository.objects.filter(pk=repository.pk).update(modify_date=timezone.now())
+        existing = (
+            Image.objects.filter(repository=repository, version=reference)
+            .values_list("id", "size")
+            .first()
+        )
+        upsert_rows(Image, [image], ["repository", "version"], list(fields))
+        add_image_usage(image, previous=(existing[1] or 0) if existing else None)
+
+    # Not all databases return the id of an upserted row
+    if image.pk is None:
+        image = Image.objects.get(repository=repository, version=reference)
+    return image
+
+
+def set_tags(image, tags):
+    """Point tags in the repository of an image to it (creating them, or moving
+    them from another image) in one statement.
+    """
+    upsert_rows(
+        Tag,
+        [
+            Tag(
+                repository_id=image.repository_id,
+                image=image,
+                digest=image.version,
+                name=tag,
+            )
+            for tag in tags
+        ],
+        unique_fields=["repository", "name"],
+        update_fields=["image", "digest"],
+    )
+
+
+def get_image_by_tag(name, reference, tag, create=False, body=None, media_type=None):
+    """given the name of a repository and a reference, look up the image
+    based on the reference. By default we use the reference to look for
+    a tag or digest. A return of None indicates that the image is not found,
+    and the view should deal with this (e.g., create the image) or raise
+    Http404.
+
+    Parameters
+    ==========
+    name (str): the name of the repository to lookup
+    reference (str): an image version string
+    tag (str): a tag that doesn't match as a version string
+    create (bool): if does not exist, create the image (new manifest push)
+    body (bytes): if we need to create, we must have a digest from the body
+    media_type (str): the content type the manifest was pushed with
+    """
+    # Concurrent identical lookups (e.g., a rollout pulling one tag) share one
+    if not create:
+        key = "%s/%s/%s" % (name, reference, tag)
+        return image_lookups.do(key, lambda: find_image(name, reference, tag))[1]
+
+    repository, image = find_image(name, reference, tag)
+    if not repository:
+        return None
+
+    # A push to an existing tag with a new manifest moves the tag
+    if create and body:
+        if not reference:
+            reference = "sha256:%s" % calculate_digest(body)
+        if not image or image.version != reference:
+            image = upsert_image(repository, reference, body)
+
+            # This saves annotations and layer (blob) associations
+            image.update_manifest(body, media_type=media_type)
+        if tag:
+            set_tags(image, [tag])
+        forget_image(name, reference, tag)
 
     return image
 
@@ -181,11 +380,38 @@ class Repository(models.Model):
         app_label = "django_oci"
 
 
+class RepositoryUsage(models.Model):
+    """The storage used by a repository, kept up to date as blobs and
+    manifests are added and deleted (see django_oci.usage). Shared bytes
+    are for blobs mounted from another repository, which are stored once
+    (with it), and the quota (if not set, REPOSITORY_QUOTA_BYTES) applies
+    to the bytes that are not shared.
+    """
+
+    repository = models.OneToOneField(
+        Repository, primary_key=True, on_delete=models.CASCADE
+    )
+    blob_count = models.BigIntegerField(default=0)
+    blob_bytes = models.BigIntegerField(default=0)
+    shared_bytes = models.BigIntegerField(default=0)
+    manifest_count = models.BigIntegerField(default=0)
+    manifest_bytes = models.BigIntegerField(default=0)
+    quota_bytes = models.BigIntegerField(null=True, blank=True)
+    modify_date = models.DateTimeField("date modified", auto_now=True)
+
+    @property
+    def unique_bytes(self):
+        return self.blob_bytes - self.shared_bytes
+
+    class Meta:
+        app_label = "django_oci"
+
+
 class Blob(models.Model):
     """a blob, which can be a binary or archive to be extracted."""
 
     add_date = models.DateTimeField("date added", auto_now_add=True)
-    modify_date = models.DateTimeField("date modified", auto_now=True)
+    modify_date = models.DateTimeField("date modified", auto_now=True, db_index=True)
     content_type = models.CharField(max_length=250, null=False)
     digest = models.CharField(max_length=250, null=True, blank=True)
     datafile = models.FileField(
@@ -193,6 +419,15 @@ class Blob(models.Model):
     )
     remotefile = models.CharField(max_length=500, null=True, blank=True)
 
+    # Recorded when the blob is finished, so serving it doesn't stat the file
+    size = models.BigIntegerField(null=True, blank=True)
+    algorithm = models.CharField(max_length=50, null=True, blank=True)
+    storage_key = models.CharField(max_length=500, null=True, blank=True)
+
+    # When the file was last checked against the digest, and if it didn't match
+    verify_date = models.DateTimeField(null=True, blank=True)
+    quarantine_date = models.DateTimeField(null=True, blank=True)
+
     # When a repository is deleted, so are the blobs
     repository = models.ForeignKey(
         Repository,
@@ -220,8 +455,10 @@ class Blob(models.Model):
         # Get the django oci upload cache, and generate an expiring session upload id
         filecache = cache.caches["django_oci_upload"]
 
-        # Expires in default 10 seconds
-        filecache.set(self.session_id, 1, timeout=settings.SESSION_EXPIRES_SECONDS)
+        # Expires in default 10 minutes, the offset is the number of bytes received
+        filecache.set(
+            self.session_id, {"offset": 0}, timeout=settings.SESSION_EXPIRES_SECONDS
+        )
         return reverse("django_oci:blob_upload", kwargs={"session_id": self.session_id})
 
     @property
@@ -241,6 +478,87 @@ class Blob(models.Model):
         )
 
 
+class UploadClaim(models.Model):
+    """A claim on the upload of a digest to a repository. The first monolithic
+    upload of a digest creates one (the unique constraint makes this safe
+    across workers), and concurrent uploads of the same digest wait for it
+    to finish, and then use its blob.
+    """
+
+    repository = models.ForeignKey(Repository, on_delete=models.CASCADE)
+    digest = models.CharField(max_length=250, null=False, blank=False)
+    add_date = models.DateTimeField("date added", auto_now_add=True)
+
+    class Meta:
+        app_label = "django_oci"
+        unique_together = (
+            (
+                "repository",
+                "digest",
+            ),
+        )
+
+
+class HotBlob(models.Model):
+    """A copy of a blob in the hot storage tier (by digest, as it is shared
+    between repositories), with its reads to choose which copy to evict.
+    """
+
+    digest = models.CharField(max_length=250, unique=True)
+    size = models.BigIntegerField(default=0)
+    hits = models.BigIntegerField(default=0)
+    last_access = models.DateTimeField(db_index=True)
+    add_date = models.DateTimeField("date added", auto_now_add=True)
+
+    class Meta:
+        app_label = "django_oci"
+
+
+class PullStat(models.Model):
+    """The number of pulls of a manifest or blob (by digest) in a repository,
+    and when it was last pulled. Pulls are counted in memory, and added to
+    these rows in bulk (see django_oci.stats).
+    """
+
+    repository = models.ForeignKey(Repository, on_delete=models.CASCADE)
+    digest = models.CharField(max_length=250, null=False, blank=False)
+    pulls = models.BigIntegerField(default=0)
+    last_pulled = models.DateTimeField(db_index=True)
+
+    class Meta:
+        app_label = "django_oci"
+        unique_together = (
+            (
+                "repository",
+                "digest",
+            ),
+        )
+
+
+class ReplicationEvent(models.Model):
+    """A push of a blob or manifest (with a tag) to replicate to a target.
+    Events are written in the transaction of the push (an outbox), deleted
+    once delivered, and retried with a backoff until then. An event that is
+    given up on has no next attempt. The repository is kept by name, as it
+    can be deleted before an event is delivered.
+    """
+
+    target = models.CharField(max_length=250)
+    repository = models.CharField(max_length=500)
+    kind = models.CharField(
+        max_length=20, choices=[("blob", "blob"), ("manifest", "manifest")]
+    )
+    digest = models.CharField(max_length=250)
+    tag = models.CharField(max_length=250, null=True, blank=True)
+    attempts = models.IntegerField(default=0)
+    next_attempt = models.DateTimeField(null=True, blank=True, db_index=True)
+    error = models.TextField(null=True, blank=True)
+    add_date = models.DateTimeField("date added", auto_now_add=True)
+
+    class Meta:
+        app_label = "django_oci"
+
+
 class Image(models.Model):
     """An image (manifest) holds a set of layers (blobs) for a repository.
     Blobs can be shared between manifests, and are deleted if they are
@@ -263,11 +581,22 @@ class Image(models.Model):
     # The text of the manifest (added at the end)
     manifest = models.BinaryField(null=False, blank=False, default=b"{}")
 
+    # Or, the storage key for the manifest if it is kept with the blobs
+    manifest_key = models.CharField(max_length=500, null=True, blank=True)
+
     # The version (digest) of the manifest
     version = models.CharField(max_length=250, null=True, blank=True)
 
+    # Recorded with the manifest, so a HEAD doesn't need to read it
+    media_type = models.CharField(max_length=250, null=True, blank=True)
+    size = models.BigIntegerField(null=True, blank=True)
+
     # Manifest functions to get, save, and return download url
     def get_manifest(self):
+        if self.manifest_key:
+            from django_oci.storage import storage
+
+            return storage.read_manifest(self.manifest_key)
         return self.manifest
 
     def add_blob(self, digest):
@@ -319,16 +648,48 @@ class Image(models.Model):
             annotation.value = value
             annotation.save()
 
-    def update_manifest(self, manifest):
+    def update_child_manifests(self, manifest):
+        """An image index lists child manifests, each (usually) for a platform.
+        We keep one row per child with its platform, so a pull for a platform
+        can be resolved without reading the index.
+        """
+        self.childmanifest_set.all().delete()
+        children = []
+        for child in manifest.get("manifests", []):
+            platform = child.get("platform", {})
+            children.append(
+                ChildManifest(
+                    index=self,
+                    digest=child.get("digest"),
+                    media_type=child.get("mediaType"),
+                    size=child.get("size"),
+                    os=platform.get("os"),
+                    architecture=platform.get("architecture"),
+                    variant=platform.get("variant"),
+                )
+            )
+        ChildManifest.objects.bulk_create(children)
+
+    def update_manifest(self, manifest, media_type=None):
         """Loading a manifest (after save) means creating an association between blobs and
-        annotations
+        annotations (or child manifests, for an image index)
         """
         # Load a derivation to get blob links and annotations
+        if isinstance(manifest, (bytes, str)):
+            self.size = len(manifest)
         if not isinstance(manifest, str):
             manifest = manifest.decode("utf-8")
         if not isinstance(manifest, dict):
             manifest = json.loads(manifest)
+
+        # The mediaType in the manifest is optional, so fall back to the push
+        self.media_type = (
+            manifest.get("mediaType")
+            or media_type
+            or settings.IMAGE_MANIFEST_CONTENT_TYPE
+        )
         self.update_blob_links(manifest)
+        self.update_child_manifests(manifest)
         self.update_annotations(manifest)
         self.save()
 
@@ -378,9 +739,18 @@ class Image(models.Model):
 
 
 class Tag(models.Model):
-    """A tag is a reference for one or more manifests"""
+    """A tag is a name for a manifest, unique in a repository. The repository
+    and manifest digest are kept with the tag, so resolving a tag (or listing
+    the tags of a repository) only needs the tag table.
+    """
 
     name = models.CharField(max_length=250, null=False, blank=False)
+    repository = models.ForeignKey(
+        Repository,
+        null=False,
+        blank=False,
+        on_delete=models.CASCADE,
+    )
     image = models.ForeignKey(
         Image,
         null=False,
@@ -388,10 +758,53 @@ class Tag(models.Model):
         # When a manifest is deleted, any associated tags are too
         on_delete=models.CASCADE,
     )
+    digest = models.CharField(max_length=250, null=True, blank=True)
 
     def __str__(self):
         return "<tag:%s>" % self.name
 
+    class Meta:
+        app_label = "django_oci"
+        unique_together = (
+            (
+                "repository",
+                "name",
+            ),
+        )
+
+
+class ChildManifest(models.Model):
+    """A child manifest listed in an image index, with the platform it is for.
+    The child is referenced by digest, as it may be pushed after the index.
+    """
+
+    index = models.ForeignKey(
+        Image,
+        null=False,
+        blank=False,
+        # When an index is deleted, so are the references to its children
+        on_delete=models.CASCADE,
+    )
+    digest = models.CharField(max_length=250, null=False, blank=False)
+    media_type = models.CharField(max_length=250, null=True, blank=True)
+    size = models.BigIntegerField(null=True, blank=True)
+    os = models.CharField(max_length=50, null=True, blank=True)
+    architecture = models.CharField(max_length=50, null=True, blank=True)
+    variant = models.CharField(max_length=50, null=True, blank=True)
+
+    def __str__(self):
+        return "<child:%s>" % self.digest
+
+    def get_label(self):
+        return "child_manifest"
+
+    class Meta:
+        app_label = "django_oci"
+        indexes = [
+            models.Index(fields=["index", "os", "architecture", "variant"]),
+            models.Index(fields=["digest"]),
+        ]
+
 
 class Annotation(models.Model):
     """An annotation is a key/value pair to describe an image.
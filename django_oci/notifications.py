@@ -0,0 +1,242 @@
+"""
+
+Copyright (c) 2020-2023, Vanessa Sochat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import atexit
+import collections
+import fnmatch
+import json
+import logging
+import threading
+import time
+import uuid
+
+import requests
+from django.utils import timezone
+
+from django_oci import settings
+
+logger = logging.getLogger(__name__)
+
+# The media type of a batch of events, as sent by the Docker registry
+EVENTS_MEDIA_TYPE = "application/vnd.docker.distribution.events.v1+json"
+
+# Events waiting for an endpoint past this are dropped, oldest first
+MAX_PENDING = 10000
+
+# A failed batch is never retried more than this many seconds later
+MAX_RETRY_SECONDS = 300
+
+# The number of seconds an endpoint has to answer
+TIMEOUT_SECONDS = 10
+
+ACTIONS = ["push", "pull", "delete", "mount"]
+
+
+class Endpoint:
+    """An endpoint that is sent events in batches of NOTIFICATION_BATCH_SIZE,
+    by a background thread. A batch is sent when it is full, or when its first
+    event has waited NOTIFICATION_FLUSH_SECONDS. A batch that fails is retried
+    (in order, holding back later events) with a backoff, and dropped after
+    NOTIFICATION_MAX_ATTEMPTS. Events are kept in memory, so events not yet
+    sent when a process dies are lost.
+    """
+
+    def __init__(self, name, config):
+        self.name = name
+        self.config = config
+        self.url = config["url"]
+        self.headers = dict(config.get("headers") or {})
+        self.headers["Content-Type"] = EVENTS_MEDIA_TYPE
+        self.actions = config.get("actions") or ACTIONS
+        self.repositories = config.get("repositories", "*")
+        self.queue = collections.deque()
+        self.condition = threading.Condition()
+        self.session = requests.Session()
+        self.thread = None
+        self.closed = False
+        self.dropped = 0
+
+    def accepts(self, event):
+        """Determine if the endpoint wants an event"""
+        return event["action"] in self.actions and fnmatch.fnmatch(
+            event["target"]["repository"], self.repositories
+        )
+
+    def put(self, event):
+        """Queue an event, starting the thread that sends them if needed"""
+        with self.condition:
+            if len(self.queue) >= MAX_PENDING:
+                if not self.dropped:
+                    logger.warning(f"Events for {self.name} are being dropped")
+                self.dropped += 1
+                self.queue.popleft()
+            self.queue.append(event)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            if len(self.queue) in [1, settings.NOTIFICATION_BATCH_SIZE]:
+                self.condition.notify()
+
+    def close(self):
+        """Stop the thread once the events queued are sent"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+    def get_batch(self, wait=True):
+        """Take the next batch, waiting for it to fill up or be due"""
+        with self.condition:
+            while wait and not self.queue and not self.closed:
+                self.condition.wait()
+            due = time.time() + settings.NOTIFICATION_FLUSH_SECONDS
+            while (
+                wait
+                and len(self.queue) < settings.NOTIFICATION_BATCH_SIZE
+                and not self.closed
+                and time.time() < due
+            ):
+                self.condition.wait(due - time.time())
+            count = min(len(self.queue), settings.NOTIFICATION_BATCH_SIZE)
+            return [self.queue.popleft() for _ in range(count)]
+
+    def run(self):
+        while True:
+            batch = self.get_batch()
+            if not batch:
+                return
+            self.send(batch)
+
+    def send(self, events, attempts=None):
+        """Post a batch of events, retrying with a backoff. Return True if the
+        endpoint accepted them.
+        """
+        body = json.dumps({"events": events})
+        attempts = attempts or settings.NOTIFICATION_MAX_ATTEMPTS
+        error = None
+        for attempt in range(attempts):
+            if attempt:
+                time.sleep(
+                    min(
+                        settings.NOTIFICATION_RETRY_SECONDS * 2 ** (attempt - 1),
+                        MAX_RETRY_SECONDS,
+                    )
+                )
+            try:
+                response = self.session.post(
+                    self.url, data=body, headers=self.headers, timeout=TIMEOUT_SECONDS
+                )
+                if 200 <= response.status_code < 300:
+                    if self.dropped:
+                        logger.warning(f"Dropped {self.dropped} events for {self.name}")
+                        self.dropped = 0
+                    return True
+                error = "status %s" % response.status_code
+            except requests.RequestException as exc:
+                error = exc
+        logger.warning(
+            f"Sending {len(events)} events to {self.name} failed after {attempts} attempts: {error}"
+        )
+        return False
+
+    def flush(self):
+        """Send the events queued now, once each, in this thread"""
+        while True:
+            batch = self.get_batch(wait=False)
+            if not batch:
+                return
+            self.send(batch, attempts=1)
+
+
+class Notifier:
+    """Queue events for the endpoints in NOTIFICATION_ENDPOINTS, a lookup of
+    names to a url, or to a dictionary with a url, and optionally headers to
+    send, the actions (push, pull, delete, mount) and a pattern of repository
+    names wanted. Recording an event only adds it to a queue, so a request
+    doesn't wait for an endpoint. Each process has its own queues.
+    """
+
+    def __init__(self):
+        self.endpoints = {}
+        self.lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def get_endpoints(self):
+        """Return the endpoints, replacing any with a changed configuration"""
+        with self.lock:
+            for name, config in settings.NOTIFICATION_ENDPOINTS.items():
+                if isinstance(config, str):
+                    config = {"url": config}
+                endpoint = self.endpoints.get(name)
+                if not endpoint or endpoint.config != config:
+                    if endpoint:
+                        endpoint.close()
+                    self.endpoints[name] = Endpoint(name, config)
+            for name in set(self.endpoints) - set(settings.NOTIFICATION_ENDPOINTS):
+                self.endpoints.pop(name).close()
+            return list(self.endpoints.values())
+
+    def notify(
+        self,
+        request,
+        action,
+        name,
+        digest,
+        media_type=None,
+        size=None,
+        tag=None,
+        url=None,
+        user=None,
+        from_repository=None,
+    ):
+        """Record an event for a request, for the endpoints that want it"""
+        if not settings.NOTIFICATION_ENDPOINTS:
+            return
+        event = {
+            "id": str(uuid.uuid4()),
+            "timestamp": timezone.now().isoformat(),
+            "action": action,
+            "target": {
+                "mediaType": media_type,
+                "digest": digest,
+                "size": size,
+                "repository": name,
+                "url": request.build_absolute_uri(url),
+                "tag": tag,
+            },
+            "request": {
+                "id": request.META.get("HTTP_X_REQUEST_ID"),
+                "addr": request.META.get("REMOTE_ADDR"),
+                "host": request.get_host(),
+                "method": request.method,
+                "useragent": request.META.get("HTTP_USER_AGENT"),
+            },
+            "actor": {"name": getattr(user, "username", None)},
+        }
+        if from_repository:
+            event["target"]["fromRepository"] = from_repository
+        for endpoint in self.get_endpoints():
+            if endpoint.accepts(event):
+                endpoint.put(event)
+
+    def flush(self):
+        """Send the events queued, e.g., when the process exits"""
+        for endpoint in list(self.endpoints.values()):
+            endpoint.flush()
+
+
+notifier = Notifier()
@@ -0,0 +1,421 @@
+"""
+
+Copyright (c) 2020-2023, Vanessa Sochat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import hashlib
+import logging
+import os
+import re
+import threading
+import uuid
+
+import requests
+from django.db import connection
+from django.http import HttpResponse, StreamingHttpResponse
+from django.middleware import cache
+
+from django_oci import settings
+from django_oci.files import get_session_dir
+from django_oci.models import (
+    Blob,
+    Repository,
+    forget_image,
+    get_image_by_tag,
+    set_tags,
+)
+
+logger = logging.getLogger(__name__)
+
+# Media types we are willing to accept for a proxied manifest
+MANIFEST_MEDIA_TYPES = [
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+]
+
+# Size of chunks read from the upstream and streamed to the client
+CHUNK_SIZE = 1024 * 1024
+
+# Number of locks that manifest requests are striped across
+MANIFEST_LOCK_STRIPES = 64
+
+# Upstream clients (one per url) and in flight blob fetches (one per blob)
+_upstreams = {}
+_inflight = {}
+_manifest_locks = [threading.Lock() for _ in range(MANIFEST_LOCK_STRIPES)]
+_lock = threading.Lock()
+
+
+class UpstreamRegistry:
+    """An upstream registry client that knows how to answer a bearer token
+    challenge (anonymous or with basic credentials) and fetch manifests and
+    blobs for a remote repository name.
+    """
+
+    # The actions a token is requested for
+    actions = "pull"
+
+    def __init__(self, url, username=None, password=None):
+        self.url = url.rstrip("/")
+        self.username = username
+        self.password = password
+        self.session = requests.Session()
+        self.tokens = {}
+
+    def get_token(self, challenge, name):
+        """Given a Www-Authenticate challenge, request a pull token"""
+        matches = dict(re.findall('(\\w+)="([^"]+)"', challenge))
+        if "realm" not in matches:
+            return None
+        params = {"scope": "repository:%s:%s" % (name, self.actions)}
+        if "service" in matches:
+            params["service"] = matches["service"]
+        auth = None
+        if self.username and self.password:
+            auth = (self.username, self.password)
+        response = self.session.get(
+            matches["realm"],
+            params=params,
+            auth=auth,
+            timeout=settings.PROXY_TIMEOUT_SECONDS,
+        )
+        if response.status_code != 200:
+            return None
+        body = response.json()
+        return body.get("token") or body.get("access_token")
+
+    def request(self, method, name, path, headers=None, stream=False, **kwargs):
+        """Issue a request for a remote repository name (or to a url, e.g., an
+        upload location), answering a bearer challenge once if the upstream
+        asks for it. Other arguments (e.g., params or data) go to requests.
+        """
+        url = "%s/v2/%s/%s" % (self.url, name, path)
+        if path.startswith(("http://", "https://")):
+            url = path
+        headers = headers or {}
+        if name in self.tokens:
+            headers["Authorization"] = "Bearer %s" % self.tokens[name]
+        response = self.session.request(
+            method,
+            url,
+            headers=headers,
+            stream=stream,
+            timeout=settings.PROXY_TIMEOUT_SECONDS,
+            **kwargs,
+        )
+        challenge = response.headers.get("Www-Authenticate", "")
+        if response.status_code == 401 and challenge.lower().startswith("bearer"):
+            token = self.get_token(challenge, name)
+            if not token:
+                return response
+            self.tokens[name] = token
+            headers["Authorization"] = "Bearer %s" % token
+
+            # A file being sent is read again from the start
+            if hasattr(kwargs.get("data"), "seek"):
+                kwargs["data"].seek(0)
+            response = self.session.request(
+                method,
+                url,
+                headers=headers,
+                stream=stream,
+                timeout=settings.PROXY_TIMEOUT_SECONDS,
+                **kwargs,
+            )
+        return response
+
+    def head_manifest(self, name, reference):
+        """Return the upstream digest for a manifest reference, or None"""
+        headers = {"Accept": ",".join(MANIFEST_MEDIA_TYPES)}
+        response = self.request("HEAD", name, "manifests/%s" % reference, headers)
+        if response.status_code != 200:
+            return None
+        return response.headers.get("Docker-Content-Digest")
+
+    def get_manifest(self, name, reference):
+        """Return the manifest body and digest for a reference, or None"""
+        headers = {"Accept": ",".join(MANIFEST_MEDIA_TYPES)}
+        response = self.request("GET", name, "manifests/%s" % reference, headers)
+        if response.status_code != 200:
+            return None, None
+        body = response.content
+        digest = "sha256:%s" % hashlib.sha256(body).hexdigest()
+        return body, digest
+
+    def head_blob(self, name, digest):
+        """Return the response to a HEAD request for a blob"""
+        return self.request("HEAD", name, "blobs/%s" % digest)
+
+    def get_blob(self, name, digest):
+        """Return a streaming response for a blob"""
+        return self.request("GET", name, "blobs/%s" % digest, stream=True)
+
+
+def get_upstream(name):
+    """Given a local repository name, return the upstream registry client and
+    the remote repository name, or (None, None) if the name is not proxied.
+    Upstreams are defined in PROXY_UPSTREAMS as a lookup of a namespace to
+    either an upstream url, or a dictionary with a url, and optionally a
+    remote namespace, username, and password. The longest namespace wins.
+    """
+    match = None
+    for namespace in settings.PROXY_UPSTREAMS:
+        prefix = namespace.strip("/")
+        if name == prefix or name.startswith(prefix + "/"):
+            if not match or len(prefix) > len(match.strip("/")):
+                match = namespace
+    if match is None:
+        return None, None
+
+    upstream = settings.PROXY_UPSTREAMS[match]
+    if isinstance(upstream, str):
+        upstream = {"url": upstream}
+
+    # Swap the local namespace for the remote one, if defined
+    prefix = match.strip("/")
+    remote_name = name
+    if upstream.get("namespace") is not None:
+        remote_name = (upstream["namespace"].strip("/") + name[len(prefix) :]).strip(
+            "/"
+        )
+
+    with _lock:
+        if upstream["url"] not in _upstreams:
+            _upstreams[upstream["url"]] = UpstreamRegistry(
+                upstream["url"], upstream.get("username"), upstream.get("password")
+            )
+        return _upstreams[upstream["url"]], remote_name
+
+
+def is_proxied(name):
+    """Determine if a repository name is served from an upstream registry"""
+    return get_upstream(name)[0] is not None
+
+
+def get_repository(name):
+    """Get or create the local repository that mirrors an upstream. Mirrored
+    repositories are public, as their content is already public upstream.
+    An existing repository is read first, as get_or_create reads for a write
+    (from the primary, and not a replica).
+    """
+    repository = Repository.objects.filter(name=name).first()
+    if repository:
+        return repository
+    repository, _ = Repository.objects.get_or_create(
+        name=name, defaults={"private": False}
+    )
+    return repository
+
+
+def get_manifest(name, reference=None, tag=None):
+    """Retrieve a manifest for a proxied repository. A manifest referenced by
+    digest is immutable, so it is only fetched on a miss. A tag is considered
+    fresh for PROXY_MANIFEST_TTL_SECONDS, after which we ask the upstream for
+    the current digest (HEAD requests are cheap and typically not rate limited)
+    and only fetch the manifest if it changed. If the upstream cannot be reached
+    we serve a stale manifest rather than nothing.
+    """
+    upstream, remote_name = get_upstream(name)
+    filecache = cache.caches["django_oci_upload"]
+    fresh_key = "proxy/%s/%s" % (name, tag)
+
+    # Concurrent requests for the same manifest wait for the first one
+    lock = _manifest_locks[hash((name, reference or tag)) % MANIFEST_LOCK_STRIPES]
+    with lock:
+        image = get_image_by_tag(name, reference=reference, tag=tag)
+        if image and (reference or filecache.get(fresh_key)):
+            return image
+
+        try:
+            if image and image.version == upstream.head_manifest(remote_name, tag):
+                filecache.set(fresh_key, 1, timeout=settings.PROXY_MANIFEST_TTL_SECONDS)
+                return image
+            body, digest = upstream.get_manifest(remote_name, reference or tag)
+        except requests.RequestException as exc:
+            logger.warning(f"Upstream manifest request for {name} failed: {exc}")
+            return image
+
+        # A manifest requested by digest must match it
+        if not body or (reference and digest != reference):
+            return image
+
+        get_repository(name)
+        image = get_image_by_tag(
+            name, reference=digest, tag=None, create=True, body=body
+        )
+        if tag:
+            set_tags(image, [tag])
+            forget_image(name, tag=tag)
+            filecache.set(fresh_key, 1, timeout=settings.PROXY_MANIFEST_TTL_SECONDS)
+        return image
+
+
+class BlobFetch:
+    """A single fetch of a blob from an upstream. The upstream is read in a
+    background thread and written to a session file, and any number of
+    clients can stream the file as it grows. When the fetch is complete and
+    the digest verified, the file is finalized into storage as a blob.
+    """
+
+    def __init__(self, name, digest, upstream, remote_name):
+        self.name = name
+        self.digest = digest
+        self.upstream = upstream
+        self.remote_name = remote_name
+        self.path = os.path.join(get_session_dir(), "proxy-%s" % uuid.uuid4())
+        self.session_path = self.path
+        self.size = None
+        self.content_type = settings.DEFAULT_CONTENT_TYPE
+        self.written = 0
+        self.done = False
+        self.error = None
+        self.ready = threading.Event()
+        self.condition = threading.Condition()
+
+    def start(self):
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+
+    def run(self):
+        try:
+            self.fetch()
+            self.finalize()
+        except Exception as exc:
+            logger.warning(f"Upstream fetch of {self.name}@{self.digest} failed: {exc}")
+            self.error = exc
+        finally:
+            # A failed fetch leaves nothing behind in the session directory
+            if self.error:
+                try:
+                    os.remove(self.session_path)
+                except FileNotFoundError:
+                    pass
+            with self.condition:
+                self.done = True
+                self.condition.notify_all()
+            self.ready.set()
+            with _lock:
+                _inflight.pop((self.name, self.digest), None)
+            connection.close()
+
+    def fetch(self):
+        """Read the upstream response into the session file"""
+        response = self.upstream.get_blob(self.remote_name, self.digest)
+        if response.status_code != 200:
+            raise ValueError("upstream returned %s" % response.status_code)
+
+        if "Content-Length" in response.headers:
+            self.size = int(response.headers["Content-Length"])
+        self.content_type = response.headers.get("Content-Type", self.content_type)
+
+        algorithm, expected = self.digest.split(":", 1)
+        hasher = hashlib.new(algorithm)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "wb") as fd:
+            self.ready.set()
+            for chunk in response.iter_content(CHUNK_SIZE):
+                fd.write(chunk)
+                fd.flush()
+                hasher.update(chunk)
+                with self.condition:
+                    self.written += len(chunk)
+                    self.condition.notify_all()
+
+        if hasher.hexdigest() != expected:
+            raise ValueError("digest mismatch")
+
+    def finalize(self):
+        """Move the verified session file into storage as a blob"""
+        from django_oci.storage import storage
+
+        repository = get_repository(self.name)
+        blob = Blob.objects.create(
+            digest="session-%s" % uuid.uuid4(),
+            repository=repository,
+            content_type=self.content_type,
+        )
+        blob.datafile.name = self.path
+
+        # Clients that have yet to open the file should use the final path
+        with self.condition:
+            storage.finish_blob(blob, self.digest)
+            self.path = blob.datafile.name
+
+    def stream(self):
+        """Yield the blob as it is written, waiting for more until done"""
+        with self.condition:
+            fd = open(self.path, "rb")
+        with fd:
+            while True:
+                chunk = fd.read(CHUNK_SIZE)
+                if chunk:
+                    yield chunk
+                    continue
+                with self.condition:
+                    if self.done and fd.tell() >= self.written:
+                        return
+                    if fd.tell() >= self.written:
+                        self.condition.wait(timeout=1)
+
+
+def head_blob(name, digest):
+    """Ask the upstream if it has a blob for a proxied repository, returning a
+    response with its size without fetching it, or None if it does not.
+    """
+    upstream, remote_name = get_upstream(name)
+    try:
+        upstream_response = upstream.head_blob(remote_name, digest)
+    except requests.RequestException as exc:
+        logger.warning(f"Upstream blob request for {name} failed: {exc}")
+        return None
+    if upstream_response.status_code != 200:
+        return None
+
+    content_type = upstream_response.headers.get(
+        "Content-Type", settings.DEFAULT_CONTENT_TYPE
+    )
+    response = HttpResponse(status=200, content_type=content_type)
+    response["Docker-Content-Digest"] = digest
+    if "Content-Length" in upstream_response.headers:
+        response["Content-Length"] = upstream_response.headers["Content-Length"]
+    return response
+
+
+def get_blob(name, digest):
+    """Fetch a blob for a proxied repository, returning a streaming response,
+    or None if the upstream does not have it. Concurrent requests for the same
+    blob share one upstream fetch.
+    """
+    upstream, remote_name = get_upstream(name)
+    with _lock:
+        fetch = _inflight.get((name, digest))
+        if not fetch:
+            fetch = BlobFetch(name, digest, upstream, remote_name)
+            _inflight[(name, digest)] = fetch
+            fetch.start()
+
+    # Wait for the upstream to answer before we commit to a response
+    fetch.ready.wait(timeout=settings.PROXY_TIMEOUT_SECONDS)
+    if fetch.error or not os.path.exists(fetch.path):
+        return None
+
+    response = StreamingHttpResponse(fetch.stream(), content_type=fetch.content_type)
+    response["Docker-Content-Digest"] = digest
+    if fetch.size is not None:
+        response["Content-Length"] = fetch.size
+    return response
@@ -0,0 +1,302 @@
+"""
+
+Copyright (c) 2020-2023, Vanessa Sochat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import fnmatch
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import timedelta
+from urllib.parse import urljoin
+
+import requests
+from django.db import connection, transaction
+from django.utils import timezone
+
+from django_oci import settings
+from django_oci.models import Blob, Image, ReplicationEvent, Tag
+from django_oci.proxy import UpstreamRegistry
+
+logger = logging.getLogger(__name__)
+
+# The number of seconds a worker holds an event (if it dies, it is retried after)
+CLAIM_SECONDS = 600
+
+# The most seconds between retries of an event
+MAX_RETRY_SECONDS = 3600
+
+# Target clients (one per target)
+_targets = {}
+_lock = threading.Lock()
+
+
+class ReplicationError(Exception):
+    pass
+
+
+class ReplicaRegistry(UpstreamRegistry):
+    """A registry client that pushes blobs and manifests to a target"""
+
+    actions = "pull,push"
+
+    def has_blob(self, name, digest):
+        response = self.request("HEAD", name, "blobs/%s" % digest)
+        return response.status_code == 200
+
+    def has_manifest(self, name, reference):
+        response = self.request("HEAD", name, "manifests/%s" % reference)
+        return response.status_code == 200
+
+    def push_blob(self, name, digest, path):
+        """Push a blob in one request (POST with the digest) or, if the target
+        asks for it, with a PUT to the upload session it returns.
+        """
+        headers = {"Content-Type": "application/octet-stream"}
+        with open(path, "rb") as fd:
+            response = self.request(
+                "POST",
+                name,
+                "blobs/uploads/",
+                headers=headers,
+                params={"digest": digest},
+                data=fd,
+            )
+        if response.status_code == 202 and "Location" in response.headers:
+            location = urljoin(self.url + "/", response.headers["Location"])
+            with open(path, "rb") as fd:
+                response = self.request(
+                    "PUT",
+                    name,
+                    location,
+                    headers=headers,
+                    params={"digest": digest},
+                    data=fd,
+                )
+        if response.status_code != 201:
+            raise ReplicationError(
+                f"Push of blob {name}@{digest} returned {response.status_code}"
+            )
+
+    def push_manifest(self, name, reference, body, media_type):
+        response = self.request(
+            "PUT",
+            name,
+            "manifests/%s" % reference,
+            headers={"Content-Type": media_type},
+            data=body,
+        )
+        if response.status_code != 201:
+            raise ReplicationError(
+                f"Push of manifest {name}:{reference} returned {response.status_code}"
+            )
+
+
+def get_targets(name):
+    """Return the names of the targets that a repository is replicated to.
+    A target is a url, or a dictionary with a url, and optionally a username
+    and password, a namespace to push under, and a pattern of repositories
+    to replicate (by default, all of them).
+    """
+    targets = []
+    for target, config in settings.REPLICATION_TARGETS.items():
+        pattern = "*" if isinstance(config, str) else config.get("repositories", "*")
+        if fnmatch.fnmatch(name, pattern):
+            targets.append(target)
+    return targets
+
+
+def get_target(target):
+    """Return the client for a target, or None if it is no longer defined"""
+    config = settings.REPLICATION_TARGETS.get(target)
+    if config is None:
+        return None
+    if isinstance(config, str):
+        config = {"url": config}
+    with _lock:
+        if target not in _targets or _targets[target].url != config["url"].rstrip("/"):
+            _targets[target] = ReplicaRegistry(
+                config["url"], config.get("username"), config.get("password")
+            )
+        return _targets[target]
+
+
+def get_remote_name(target, name):
+    config = settings.REPLICATION_TARGETS.get(target)
+    namespace = None if isinstance(config, str) else config.get("namespace")
+    if namespace:
+        return "%s/%s" % (namespace.strip("/"), name)
+    return name
+
+
+def add_events(name, kind, digest, tags=None):
+    """Record a push to replicate to each target (and for each tag). This is
+    called in the transaction of the push, so an event is recorded if and
+    only if the push is.
+    """
+    now = timezone.now()
+    ReplicationEvent.objects.bulk_create(
+        [
+            ReplicationEvent(
+                target=target,
+                repository=name,
+                kind=kind,
+                digest=digest,
+                tag=tag,
+                next_attempt=now,
+            )
+            for target in get_targets(name)
+            for tag in tags or [None]
+        ]
+    )
+
+
+@contextmanager
+def replicated(name, kind, digest, tags=None):
+    """Run the writes of a push in a transaction with its events. The events
+    are written first, so sqlite takes the write lock before the push reads.
+    Without a target for the repository, there is nothing to add.
+    """
+    if not get_targets(name):
+        yield
+        return
+    with transaction.atomic():
+        add_events(name, kind, digest, tags)
+        yield
+
+
+def claim_events(limit=100):
+    """Claim events that are due (the oldest first), so that another worker
+    (or process) doesn't deliver them too.
+    """
+    now = timezone.now()
+    events = ReplicationEvent.objects.filter(next_attempt__lte=now).order_by("id")
+    claimed = []
+    for event in events[:limit]:
+        if ReplicationEvent.objects.filter(
+            pk=event.pk, next_attempt=event.next_attempt
+        ).update(next_attempt=now + timedelta(seconds=CLAIM_SECONDS)):
+            claimed.append(event)
+    return claimed
+
+
+def replicate_blob(client, remote_name, name, digest):
+    """Push a blob to a target unless it has it. A blob that was deleted (or
+    quarantined) since it was pushed has nothing to replicate.
+    """
+    from django_oci.storage import storage
+
+    if client.has_blob(remote_name, digest):
+        return
+    blob = Blob.objects.filter(
+        repository__name=name, digest=digest, quarantine_date__isnull=True
+    ).first()
+    path = blob and storage.locate_blob(blob)
+    if path:
+        client.push_blob(remote_name, digest, path)
+
+
+def replicate_manifest(client, remote_name, name, digest, tag=None):
+    """Push a manifest (by tag, or by digest) to a target, first pushing the
+    blobs it references and the manifests an index lists, that the target
+    doesn't have.
+    """
+    image = Image.objects.filter(repository__name=name, version=digest).first()
+    if not image:
+        return
+    exists = client.has_manifest(remote_name, digest)
+    if exists and not tag:
+        return
+
+    body = bytes(image.get_manifest())
+    if not exists:
+        manifest = json.loads(body)
+        layers = [manifest.get("config", {})] + manifest.get("layers", [])
+        for layer in layers:
+            if layer.get("digest"):
+                replicate_blob(client, remote_name, name, layer["digest"])
+        for child in manifest.get("manifests", []):
+            replicate_manifest(client, remote_name, name, child["digest"])
+    client.push_manifest(
+        remote_name,
+        tag or digest,
+        body,
+        image.media_type or settings.IMAGE_MANIFEST_CONTENT_TYPE,
+    )
+
+
+def deliver(event):
+    """Deliver an event (in a worker thread), deleting it if it is delivered,
+    or scheduling a retry. Returns True if delivered.
+    """
+    try:
+        client = get_target(event.target)
+        if client is None:
+            logger.warning(f"Dropping replication to {event.target}, it isn't defined.")
+        elif event.kind == "blob":
+            remote_name = get_remote_name(event.target, event.repository)
+            replicate_blob(client, remote_name, event.repository, event.digest)
+
+        # A tag moved since the push is left to the event of the move
+        elif (
+            not event.tag
+            or Tag.objects.filter(
+                repository__name=event.repository, name=event.tag, digest=event.digest
+            ).exists()
+        ):
+            remote_name = get_remote_name(event.target, event.repository)
+            replicate_manifest(
+                client, remote_name, event.repository, event.digest, event.tag
+            )
+        event.delete()
+        return True
+
+    except (OSError, requests.RequestException, ReplicationError) as exc:
+        event.attempts += 1
+        event.error = str(exc)
+        event.next_attempt = None
+        if event.attempts < settings.REPLICATION_MAX_ATTEMPTS:
+            delay = settings.REPLICATION_RETRY_SECONDS * 2 ** (event.attempts - 1)
+            event.next_attempt = timezone.now() + timedelta(
+                seconds=min(delay, MAX_RETRY_SECONDS)
+            )
+        logger.warning(
+            f"Replication of {event.repository}@{event.digest} failed: {exc}"
+        )
+        ReplicationEvent.objects.filter(pk=event.pk).update(
+            attempts=event.attempts,
+            error=event.error,
+            next_attempt=event.next_attempt,
+        )
+        return False
+    finally:
+        connection.close()
+
+
+def replicate(workers=4, limit=100):
+    """Deliver a batch of due events with a pool of workers: blobs first, and
+    then manifests (which also push any blobs they need that the target
+    doesn't have). Returns the number of events delivered and failed.
+    """
+    events = claim_events(limit)
+    delivered = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for kind in ["blob", "manifest"]:
+            batch = [x for x in events if x.kind == kind]
+            delivered += sum(executor.map(deliver, batch))
+    return delivered, len(events) - delivered
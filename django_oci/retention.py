@@ -0,0 +1,172 @@
+"""
+
+Copyright (c) 2020-2023, Vanessa Sochat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import fnmatch
+import os
+from datetime import timedelta
+
+from django.db.models import Sum
+from django.utils import timezone
+
+from django_oci import settings
+from django_oci.models import (
+    Blob,
+    ChildManifest,
+    Image,
+    PullStat,
+    Tag,
+    forget_image,
+)
+from django_oci.signals import deferred_blob_cleanup
+
+# The number of rows deleted in one statement
+BATCH_SIZE = 500
+
+
+def get_rule(name):
+    """Return the first retention rule with a repository pattern (e.g.,
+    "ci/*") that matches a repository name, or None.
+    """
+    for rule in settings.RETENTION_RULES:
+        if fnmatch.fnmatchcase(name, rule.get("repository", "*")):
+            return rule
+
+
+class RetentionPlan:
+    """The tags, manifests and blobs of a repository that a retention rule
+    does not keep. A rule can define:
+
+    keep_last: keep the N tags of the most recently pushed manifests
+    keep_tags: keep tags matching a regular expression
+    untagged_days: delete manifests without a tag added more than N days ago
+    keep_pulled_days: keep tags and manifests pulled in the last N days
+
+    A tag is deleted only with keep_last, and a manifest only with
+    untagged_days. Manifests listed by an image index are kept while it is.
+    """
+
+    def __init__(self, repository, rule, now=None):
+        self.repository = repository
+        self.rule = rule
+        now = now or timezone.now()
+
+        # Digests pulled recently are kept, whatever else the rule says
+        pulled = PullStat.objects.none().values("digest")
+        if rule.get("keep_pulled_days") is not None:
+            since = now - timedelta(days=rule["keep_pulled_days"])
+            pulled = PullStat.objects.filter(
+                repository=repository, last_pulled__gte=since
+            ).values("digest")
+
+        tags = Tag.objects.filter(repository=repository)
+        expired_tags = Tag.objects.none()
+        if rule.get("keep_last") is not None:
+            newest = tags.order_by("-image__add_date", "-id")[: rule["keep_last"]]
+            expired_tags = tags.exclude(
+                id__in=list(newest.values_list("id", flat=True))
+            )
+            if rule.get("keep_tags"):
+                expired_tags = expired_tags.exclude(name__regex=rule["keep_tags"])
+            expired_tags = expired_tags.exclude(digest__in=pulled)
+        kept_tags = tags.exclude(id__in=expired_tags.values("id"))
+
+        images = Image.objects.none()
+        if rule.get("untagged_days") is not None:
+            before = now - timedelta(days=rule["untagged_days"])
+            children = ChildManifest.objects.filter(
+                index__repository=repository
+            ).values("digest")
+            images = (
+                Image.objects.filter(repository=repository, add_date__lt=before)
+                .exclude(id__in=kept_tags.values("image_id"))
+                .exclude(version__in=pulled)
+                .exclude(version__in=children)
+            )
+
+        # Blobs are deleted with the last manifest that links to them
+        blobs = (
+            Blob.objects.filter(image__in=images)
+            .exclude(image__in=Image.objects.exclude(id__in=images.values("id")))
+            .distinct()
+        )
+
+        # Evaluated now, so deleting one doesn't change what the others match
+        self.tags = list(expired_tags.values_list("id", "name"))
+        self.images = list(images.values_list("id", "version"))
+        self.blobs = list(blobs.values_list("id", flat=True))
+        self.size = (
+            Image.objects.filter(id__in=images.values("id")).aggregate(
+                size=Sum("size")
+            )["size"]
+            or 0
+        ) + (
+            Blob.objects.filter(id__in=blobs.values("id")).aggregate(size=Sum("size"))[
+                "size"
+            ]
+            or 0
+        )
+
+    def __str__(self):
+        return "%s: %s tags, %s manifests, %s blobs (%s bytes)" % (
+            self.repository.name,
+            len(self.tags),
+            len(self.images),
+            len(self.blobs),
+            self.size,
+        )
+
+    def apply(self):
+        """Delete the planned tags, manifests and blobs in batches. The blobs
+        are cleaned up together here, instead of per manifest by a signal.
+        """
+        from django_oci.storage import storage
+
+        name = self.repository.name
+        for batch in get_batches(self.tags):
+            Tag.objects.filter(id__in=[x[0] for x in batch]).delete()
+            for _, tag in batch:
+                forget_image(name, tag=tag)
+
+        with deferred_blob_cleanup():
+            for batch in get_batches(self.images):
+                Image.objects.filter(id__in=[x[0] for x in batch]).delete()
+                for _, version in batch:
+                    forget_image(name, reference=version)
+
+        # A file shared with a blob (mounted) in another repository is kept
+        for batch in get_batches(self.blobs):
+            blobs = list(Blob.objects.filter(id__in=batch))
+            shared = set(
+                Blob.objects.filter(datafile__in=[x.datafile.name for x in blobs])
+                .exclude(id__in=batch)
+                .values_list("datafile", flat=True)
+            )
+            Blob.objects.filter(id__in=batch).delete()
+            for blob in blobs:
+                path = storage.locate_blob(blob)
+                if path and blob.datafile.name not in shared:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                storage.forget_blob(name, blob.digest)
+
+
+def get_batches(items):
+    for start in range(0, len(items), BATCH_SIZE):
+        yield items[start : start + BATCH_SIZE]
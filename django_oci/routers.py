@@ -0,0 +1,77 @@
+"""
+
+Copyright (c) 2020-2023, Vanessa Sochat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import random
+import threading
+from contextlib import contextmanager
+
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from django_oci import settings
+
+_state = threading.local()
+
+
+def get_replica():
+    """Choose one of DATABASE_REPLICAS (for a request), or None if there are none"""
+    if settings.DATABASE_REPLICAS:
+        return random.choice(settings.DATABASE_REPLICAS)
+
+
+@contextmanager
+def reading_from(replica):
+    """Send the reads in this thread to a replica (if not None) until something
+    is written.
+    """
+    _state.replica = replica
+    try:
+        yield
+    finally:
+        _state.replica = None
+
+
+class ReplicaRouter:
+    """Send the reads of a read-only request to the replica chosen for it by
+    the ReplicaMiddleware, and everything else to the primary (default)
+    database. Once a request writes, its reads go to the primary, so they see
+    the write, and so do reads in a transaction. Reads outside of a request
+    (e.g., a management command) always go to the primary.
+    """
+
+    def db_for_read(self, model, **hints):
+        replica = getattr(_state, "replica", None)
+        if replica is None or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return None
+        return replica
+
+    def db_for_write(self, model, **hints):
+        # An object read from a replica is saved to the primary
+        _state.replica = None
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        aliases = [DEFAULT_DB_ALIAS] + list(settings.DATABASE_REPLICAS)
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # A replica is migrated by replicating the primary
+        if db in settings.DATABASE_REPLICAS:
+            return False
+        return None
@@ -0,0 +1,184 @@
+"""
+
+Copyright (c) 2020-2023, Vanessa Sochat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import hashlib
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+
+from django_oci import settings
+from django_oci.models import Blob, HotBlob
+from django_oci.storage import storage
+from django_oci.tiers import demote
+
+logger = logging.getLogger(__name__)
+
+# Blobs are read in chunks, each waiting on the rate limit
+CHUNK_SIZE = 1024 * 1024
+
+# The number of blobs read from the database (and checked) at once
+BATCH_SIZE = 500
+
+# The result of checking a blob
+OK = "ok"
+CORRUPT = "corrupt"
+MISSING = "missing"
+
+
+class RateLimiter:
+    """A token bucket shared by the scrub workers, so together they read at
+    most rate bytes per second (with a burst of up to a second). A worker
+    that takes more than there is waits for the difference.
+    """
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.tokens = rate or 0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self, size):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= size
+            delay = max(-self.tokens / self.rate, 0)
+        time.sleep(delay)
+
+
+def hash_file(path, algorithm, limiter):
+    """Calculate the digest of a file, reading no faster than the limiter allows.
+    hashlib releases the GIL for large updates, so workers hash in parallel.
+    """
+    hasher = hashlib.new(algorithm)
+    with open(path, "rb") as fd:
+        for chunk in iter(lambda: fd.read(CHUNK_SIZE), b""):
+            limiter.wait(len(chunk))
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def check_blob(blob, limiter, dry_run=False):
+    """Check that the file of a blob (in a worker thread) matches its digest.
+    A blob that was checked is not checked again for SCRUB_INTERVAL_DAYS, so
+    a scrub that is stopped picks up where it left off. A blob that doesn't
+    match (or is missing) is quarantined. Returns the blob and the result.
+    """
+    try:
+        path = storage.locate_blob(blob)
+        if path is None:
+            result = MISSING
+        else:
+            algorithm, expected = blob.digest.split(":", 1)
+            result = CORRUPT
+            if hash_file(path, algorithm, limiter) == expected:
+                result = OK
+
+        if result == OK:
+            Blob.objects.filter(datafile=blob.datafile.name).update(
+                verify_date=timezone.now()
+            )
+        elif not dry_run:
+            quarantine(blob, path)
+        return blob, result
+    finally:
+        connection.close()
+
+
+def quarantine(blob, path=None):
+    """Move the file of a corrupt blob aside (under .quarantine in its storage
+    root, to look at later) and mark the blobs that use it (mounts share the
+    file). A quarantined blob is missing to a HEAD or GET, so a client pushes
+    it again, and the push writes a new file and clears the quarantine.
+    """
+    now = timezone.now()
+    if path:
+        root = storage.get_storage_root(path)
+        destination = os.path.join(
+            root,
+            ".quarantine",
+            "%s-%s" % (os.path.relpath(path, root), now.strftime("%Y%m%d%H%M%S")),
+        )
+        storage.move_blob(path, destination)
+        logger.warning(f"Quarantined {blob.digest} ({path}) to {destination}")
+
+    blobs = Blob.objects.filter(datafile=blob.datafile.name)
+    names = list(blobs.values_list("repository__name", flat=True))
+    blobs.update(quarantine_date=now, verify_date=now)
+    for name in names:
+        storage.forget_blob(name, blob.digest)
+
+    # The hot copy could be as bad, so pulls go back to storage
+    demote(HotBlob.objects.filter(digest=blob.digest))
+
+
+def get_unverified(interval_days=None):
+    """Return the blobs that are due a check: never checked, or not checked in
+    the last SCRUB_INTERVAL_DAYS. Blobs that are quarantined are not.
+    """
+    if interval_days is None:
+        interval_days = settings.SCRUB_INTERVAL_DAYS
+    since = timezone.now() - timedelta(days=interval_days)
+    return (
+        Blob.objects.filter(Q(verify_date__isnull=True) | Q(verify_date__lt=since))
+        .filter(quarantine_date__isnull=True)
+        .exclude(datafile="")
+        .exclude(digest__startswith="session-")
+        .select_related("repository")
+        .order_by("id")
+    )
+
+
+def scrub(workers=4, rate=None, interval_days=None, dry_run=False):
+    """Check the blobs that are due (see get_unverified) with a pool of
+    workers, that together read at most rate (SCRUB_BYTES_PER_SECOND) bytes
+    a second. Blobs that share a file are checked once. Returns a lookup of
+    each result to the blobs with it.
+    """
+    if rate is None:
+        rate = settings.SCRUB_BYTES_PER_SECOND
+    limiter = RateLimiter(rate)
+    results = {OK: [], CORRUPT: [], MISSING: []}
+    blobs = get_unverified(interval_days)
+
+    last = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            batch = list(blobs.filter(id__gt=last)[:BATCH_SIZE])
+            if not batch:
+                break
+            last = batch[-1].id
+
+            # A file shared by mounts is marked for all of them when it is checked
+            files = {blob.datafile.name: blob for blob in batch}
+            checked = executor.map(
+                lambda blob: check_blob(blob, limiter, dry_run), files.values()
+            )
+            for blob, result in checked:
+                results[result].append(blob)
+    return results
@@ -30,6 +30,7 @@ authenticated_views = [
     "django_oci.views.blobs.BlobDownload",
     "django_oci.views.image.ImageTags",
     "django_oci.views.image.ImageManifest",
+    "django_oci.views.export.RepositoryExport",
     "django_oci.views.image.view",
     "django_oci.views.blobs.view",
 ]
@@ -49,6 +50,16 @@ DEFAULTS = {
     "IMAGE_MANIFEST_CONTENT_TYPE": "application/vnd.oci.image.manifest.v1+json",
     # Storage backend
     "STORAGE_BACKEND": "filesystem",
+    # Directories (e.g., one per volume) to spread blobs over by digest (MEDIA_ROOT/blobs if empty)
+    "STORAGE_ROOTS": [],
+    # A faster directory (e.g., local NVMe) to keep copies of frequently pulled blobs
+    "HOT_STORAGE_ROOT": None,
+    # The number of bytes the hot tier may hold (10GB)
+    "HOT_STORAGE_BYTES": 10 * 1024 * 1024 * 1024,
+    # The number of pulls of a blob before it is copied to the hot tier
+    "HOT_STORAGE_PROMOTE_HITS": 2,
+    # Blobs evicted from the hot tier first: least recently ("lru") or frequently ("lfu") pulled
+    "HOT_STORAGE_EVICTION": "lru",
     # Domain used in templates, api prefix
     "DOMAIN_URL": "http://127.0.0.1:8000",
     # Media root (if saving images on filesystem
@@ -73,6 +84,60 @@ DEFAULTS = {
     "VIEW_RATE_LIMIT": "100/1d",
     # Given that someone goes over, are they blocked for a period?
     "VIEW_RATE_LIMIT_BLOCK": True,
+    # Pull-through cache: lookup of repository namespaces to upstream registries
+    "PROXY_UPSTREAMS": {},
+    # The number of seconds a proxied manifest tag is fresh (5 minutes)
+    "PROXY_MANIFEST_TTL_SECONDS": 300,
+    # The number of seconds to wait on an upstream registry
+    "PROXY_TIMEOUT_SECONDS": 30,
+    # A shared cache name to coalesce identical lookups across processes
+    "SINGLEFLIGHT_CACHE": None,
+    # The number of seconds a coalesced lookup is shared across processes
+    "SINGLEFLIGHT_SECONDS": 1,
+    # Accept chunks of an upload in any order (e.g., over parallel connections)
+    "PARALLEL_CHUNK_UPLOADS": False,
+    # Flush finished blobs to disk: "none", "file", or "directory" (file and entry)
+    "FSYNC_POLICY": "none",
+    # The number of seconds to wait on a concurrent upload of the same digest
+    "UPLOAD_CLAIM_SECONDS": 60,
+    # Where manifests are stored: "database", or "storage" (the blob backend)
+    "MANIFEST_STORAGE": "database",
+    # Expected number of blobs for the in-memory filter of known digests (0 disables)
+    "BLOB_FILTER_CAPACITY": 1000000,
+    # The number of seconds a blob lookup miss is remembered (0 disables)
+    "BLOB_NEGATIVE_CACHE_SECONDS": 5,
+    # The number of seconds pulls are counted in memory before they are saved (None disables)
+    "PULL_STATS_FLUSH_SECONDS": 30,
+    # Rules for the tags and manifests to keep, for repositories matching a pattern
+    "RETENTION_RULES": [],
+    # The number of (not shared) blob bytes a repository may store (None is unlimited)
+    "REPOSITORY_QUOTA_BYTES": None,
+    # The number of bytes per second the blob scrubber may read (None is unlimited)
+    "SCRUB_BYTES_PER_SECOND": 50 * 1024 * 1024,
+    # The number of days before a verified blob is checked again
+    "SCRUB_INTERVAL_DAYS": 30,
+    # The number of blobs an export asks the kernel to read ahead (0 disables)
+    "EXPORT_READ_AHEAD": 4,
+    # Registries to replicate pushes to: a lookup of names to a url (and credentials)
+    "REPLICATION_TARGETS": {},
+    # The number of seconds before a failed replication is retried (doubling each time)
+    "REPLICATION_RETRY_SECONDS": 30,
+    # The number of attempts before a replication is given up on
+    "REPLICATION_MAX_ATTEMPTS": 10,
+    # Endpoints to send push, pull, delete and mount events to: a lookup of names to a url
+    "NOTIFICATION_ENDPOINTS": {},
+    # The number of events sent to an endpoint in one request
+    "NOTIFICATION_BATCH_SIZE": 100,
+    # The number of seconds an event waits for a batch to fill up
+    "NOTIFICATION_FLUSH_SECONDS": 1,
+    # The number of seconds before a failed batch is sent again (doubling each time)
+    "NOTIFICATION_RETRY_SECONDS": 1,
+    # The number of attempts before a batch of events is dropped
+    "NOTIFICATION_MAX_ATTEMPTS": 5,
+    # Database aliases to send the reads of GET and HEAD requests to (with the router)
+    "DATABASE_REPLICAS": [],
+    # The number of seconds the requests of a client that wrote are sent to the primary
+    "DATABASE_REPLICA_PIN_SECONDS": 10,
 }
 
 # The user can define a section for DJANGO_OCI in settings
@@ -113,6 +178,98 @@ VIEW_RATE_LIMIT_BLOCK = oci.get(
     "VIEW_RATE_LIMIT_BLOCK", DEFAULTS["VIEW_RATE_LIMIT_BLOCK"]
 )
 
+# Pull-through cache
+PROXY_UPSTREAMS = oci.get("PROXY_UPSTREAMS", DEFAULTS["PROXY_UPSTREAMS"])
+PROXY_MANIFEST_TTL_SECONDS = oci.get(
+    "PROXY_MANIFEST_TTL_SECONDS", DEFAULTS["PROXY_MANIFEST_TTL_SECONDS"]
+)
+PROXY_TIMEOUT_SECONDS = oci.get(
+    "PROXY_TIMEOUT_SECONDS", DEFAULTS["PROXY_TIMEOUT_SECONDS"]
+)
+
+# Request coalescing
+SINGLEFLIGHT_CACHE = oci.get("SINGLEFLIGHT_CACHE", DEFAULTS["SINGLEFLIGHT_CACHE"])
+SINGLEFLIGHT_SECONDS = oci.get("SINGLEFLIGHT_SECONDS", DEFAULTS["SINGLEFLIGHT_SECONDS"])
+
+# Blob lookups
+BLOB_FILTER_CAPACITY = oci.get("BLOB_FILTER_CAPACITY", DEFAULTS["BLOB_FILTER_CAPACITY"])
+BLOB_NEGATIVE_CACHE_SECONDS = oci.get(
+    "BLOB_NEGATIVE_CACHE_SECONDS", DEFAULTS["BLOB_NEGATIVE_CACHE_SECONDS"]
+)
+
+# Pull statistics
+PULL_STATS_FLUSH_SECONDS = oci.get(
+    "PULL_STATS_FLUSH_SECONDS", DEFAULTS["PULL_STATS_FLUSH_SECONDS"]
+)
+
+# Retention
+RETENTION_RULES = oci.get("RETENTION_RULES", DEFAULTS["RETENTION_RULES"])
+
+# Quotas
+REPOSITORY_QUOTA_BYTES = oci.get(
+    "REPOSITORY_QUOTA_BYTES", DEFAULTS["REPOSITORY_QUOTA_BYTES"]
+)
+
+# Scrubbing
+SCRUB_BYTES_PER_SECOND = oci.get(
+    "SCRUB_BYTES_PER_SECOND", DEFAULTS["SCRUB_BYTES_PER_SECOND"]
+)
+SCRUB_INTERVAL_DAYS = oci.get("SCRUB_INTERVAL_DAYS", DEFAULTS["SCRUB_INTERVAL_DAYS"])
+
+# Exports
+EXPORT_READ_AHEAD = oci.get("EXPORT_READ_AHEAD", DEFAULTS["EXPORT_READ_AHEAD"])
+
+# Replication
+REPLICATION_TARGETS = oci.get("REPLICATION_TARGETS", DEFAULTS["REPLICATION_TARGETS"])
+REPLICATION_RETRY_SECONDS = oci.get(
+    "REPLICATION_RETRY_SECONDS", DEFAULTS["REPLICATION_RETRY_SECONDS"]
+)
+REPLICATION_MAX_ATTEMPTS = oci.get(
+    "REPLICATION_MAX_ATTEMPTS", DEFAULTS["REPLICATION_MAX_ATTEMPTS"]
+)
+
+# Notifications
+NOTIFICATION_ENDPOINTS = oci.get(
+    "NOTIFICATION_ENDPOINTS", DEFAULTS["NOTIFICATION_ENDPOINTS"]
+)
+NOTIFICATION_BATCH_SIZE = oci.get(
+    "NOTIFICATION_BATCH_SIZE", DEFAULTS["NOTIFICATION_BATCH_SIZE"]
+)
+NOTIFICATION_FLUSH_SECONDS = oci.get(
+    "NOTIFICATION_FLUSH_SECONDS", DEFAULTS["NOTIFICATION_FLUSH_SECONDS"]
+)
+NOTIFICATION_RETRY_SECONDS = oci.get(
+    "NOTIFICATION_RETRY_SECONDS", DEFAULTS["NOTIFICATION_RETRY_SECONDS"]
+)
+NOTIFICATION_MAX_ATTEMPTS = oci.get(
+    "NOTIFICATION_MAX_ATTEMPTS", DEFAULTS["NOTIFICATION_MAX_ATTEMPTS"]
+)
+
+# Read replicas
+DATABASE_REPLICAS = oci.get("DATABASE_REPLICAS", DEFAULTS["DATABASE_REPLICAS"])
+DATABASE_REPLICA_PIN_SECONDS = oci.get(
+    "DATABASE_REPLICA_PIN_SECONDS", DEFAULTS["DATABASE_REPLICA_PIN_SECONDS"]
+)
+
+# Uploads
+PARALLEL_CHUNK_UPLOADS = oci.get(
+    "PARALLEL_CHUNK_UPLOADS", DEFAULTS["PARALLEL_CHUNK_UPLOADS"]
+)
+FSYNC_POLICY = oci.get("FSYNC_POLICY", DEFAULTS["FSYNC_POLICY"])
+UPLOAD_CLAIM_SECONDS = oci.get("UPLOAD_CLAIM_SECONDS", DEFAULTS["UPLOAD_CLAIM_SECONDS"])
+
+# Manifests
+MANIFEST_STORAGE = oci.get("MANIFEST_STORAGE", DEFAULTS["MANIFEST_STORAGE"])
+
+# Storage
+STORAGE_ROOTS = oci.get("STORAGE_ROOTS", DEFAULTS["STORAGE_ROOTS"])
+HOT_STORAGE_ROOT = oci.get("HOT_STORAGE_ROOT", DEFAULTS["HOT_STORAGE_ROOT"])
+HOT_STORAGE_BYTES = oci.get("HOT_STORAGE_BYTES", DEFAULTS["HOT_STORAGE_BYTES"])
+HOT_STORAGE_PROMOTE_HITS = oci.get(
+    "HOT_STORAGE_PROMOTE_HITS", DEFAULTS["HOT_STORAGE_PROMOTE_HITS"]
+)
+HOT_STORAGE_EVICTION = oci.get("HOT_STORAGE_EVICTION", DEFAULTS["HOT_STORAGE_EVICTION"])
+
 
 # Set filesystem cache, also adding to middleware
 CACHES = getattr(settings, "CACHES", {})
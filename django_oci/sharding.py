@@ -0,0 +1,52 @@
+"""
+
+Copyright (c) 2020-2023, Vanessa Sochat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import bisect
+import hashlib
+
+
+class HashRing:
+    """A consistent hash ring of storage roots. Each root is placed on the
+    ring at many points (replicas), and a digest belongs to the first root
+    after its own point. Adding a root takes over only the digests between
+    its points and the ones before them (about 1/n of the blobs), and every
+    other digest keeps its root.
+    """
+
+    def __init__(self, nodes, replicas=100):
+        self.nodes = list(nodes)
+        self.replicas = replicas
+        self.points = []
+        self.owners = {}
+        for node in self.nodes:
+            for replica in range(replicas):
+                point = self.get_point("%s#%s" % (node, replica))
+                self.points.append(point)
+                self.owners[point] = node
+        self.points.sort()
+
+    def get_point(self, key):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+        return int.from_bytes(digest, "big")
+
+    def get_node(self, key):
+        """Return the node (storage root) for a key (digest)"""
+        if len(self.nodes) == 1:
+            return self.nodes[0]
+        index = bisect.bisect(self.points, self.get_point(key)) % len(self.points)
+        return self.owners[self.points[index]]
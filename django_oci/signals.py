@@ -15,18 +15,38 @@ See the License for the specific language governing permissions and
 limitations under the License.
 
 """
+import threading
+from contextlib import contextmanager
+
 from django.contrib.auth import get_user_model
 from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from rest_framework.authtoken.models import Token
 
-from .models import Image
+from .models import Blob, Image
+from .usage import add_blob_usage, add_image_usage
 
 UserModel = get_user_model()
 
+_state = threading.local()
+
+
+@contextmanager
+def deferred_blob_cleanup():
+    """Skip cleaning up the blobs of each deleted image, for a batch delete
+    that cleans up the blobs of all of its images at once.
+    """
+    _state.deferred = True
+    try:
+        yield
+    finally:
+        _state.deferred = False
+
 
 @receiver(post_delete, sender=Image)
 def delete_blobs(sender, instance, **kwargs):
+    if getattr(_state, "deferred", False):
+        return
     print("Delete image signal running.")
 
     for blob in instance.blobs.all():
@@ -37,6 +57,29 @@ def delete_blobs(sender, instance, **kwargs):
                 blob.delete()
 
 
+@receiver(post_delete, sender=Blob)
+def delete_blob_usage(sender, instance, **kwargs):
+    add_blob_usage(instance, sign=-1)
+
+
+@receiver(post_delete, sender=Image)
+def delete_image_usage(sender, instance, **kwargs):
+    add_image_usage(instance, sign=-1)
+
+
+@receiver(post_delete, sender=Image)
+def delete_manifest(sender, instance, **kwargs):
+    """A manifest kept with the blobs is shared by digest, and deleted with
+    the last image that uses it.
+    """
+    if not instance.manifest_key:
+        return
+    if not Image.objects.filter(manifest_key=instance.manifest_key).exists():
+        from django_oci.storage import storage
+
+        storage.delete_manifest(instance.manifest_key)
+
+
 @receiver(post_save, sender=UserModel)
 def create_auth_token(sender, instance=None, created=False, **kwargs):
     """Create a token for the user when the user is created (with oAuth2)
@@ -0,0 +1,116 @@
+"""
+
+Copyright (c) 2020-2023, Vanessa Sochat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import threading
+import time
+
+from django.middleware import cache
+
+from django_oci import settings
+
+# A sentinel to tell a cached None apart from a cache miss
+_missing = object()
+
+
+class Call:
+    """A call in flight, which followers wait on for the result"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesce concurrent identical calls, so that only the first caller
+    (the leader) runs the function and the rest wait and share its result.
+    Within a process this is done with an event per key. If SINGLEFLIGHT_CACHE
+    names a shared cache, the leaders of different processes also coalesce
+    through it, and a result is shared for SINGLEFLIGHT_SECONDS.
+    """
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def get_cache_key(self, key):
+        return "singleflight/%s/%s" % (self.namespace, key)
+
+    def do(self, key, func):
+        """Run func for a key, or wait for the call already in flight"""
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self.shared(key, func)
+        except Exception as exc:
+            call.error = exc
+            raise
+        finally:
+            with self.lock:
+                self.calls.pop(key, None)
+            call.event.set()
+        return call.result
+
+    def shared(self, key, func):
+        """Coalesce the leaders of different processes through the shared
+        cache. The first to add the lock runs the function, and the others
+        poll for its result, falling back to running it themselves.
+        """
+        if not settings.SINGLEFLIGHT_CACHE:
+            return func()
+
+        sharedcache = cache.caches[settings.SINGLEFLIGHT_CACHE]
+        cache_key = self.get_cache_key(key)
+        result = sharedcache.get(cache_key, _missing)
+        if result is not _missing:
+            return result
+
+        lock_key = cache_key + "/lock"
+        if sharedcache.add(lock_key, 1, timeout=settings.SINGLEFLIGHT_SECONDS):
+            try:
+                result = func()
+                sharedcache.set(
+                    cache_key, result, timeout=settings.SINGLEFLIGHT_SECONDS
+                )
+            finally:
+                sharedcache.delete(lock_key)
+            return result
+
+        deadline = time.time() + settings.SINGLEFLIGHT_SECONDS
+        while time.time() < deadline:
+            time.sleep(0.01)
+            result = sharedcache.get(cache_key, _missing)
+            if result is not _missing:
+                return result
+        return func()
+
+    def forget(self, key):
+        """Forget a shared result, e.g., after the underlying data changed"""
+        if settings.SINGLEFLIGHT_CACHE:
+            cache.caches[settings.SINGLEFLIGHT_CACHE].delete(self.get_cache_key(key))
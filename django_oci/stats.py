@@ -0,0 +1,157 @@
+"""
+
+Copyright (c) 2020-2023, Vanessa Sochat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import atexit
+import logging
+import threading
+
+from django.db import connection
+from django.db.models import F
+from django.utils import timezone
+
+from django_oci import settings
+from django_oci.models import PullStat, Repository
+
+logger = logging.getLogger(__name__)
+
+# A flush is started early when this many (repository, digest) pairs are waiting
+MAX_PENDING = 10000
+
+# The number of rows added in one statement
+BATCH_SIZE = 500
+
+# Add counts to existing rows, in one statement for a batch
+INSERT = "INSERT INTO {table} ({repository}, {digest}, {pulls}, {last_pulled}) VALUES {values} "
+ON_CONFLICT = INSERT + (
+    "ON CONFLICT ({repository}, {digest}) DO UPDATE SET "
+    "{pulls} = {table}.{pulls} + excluded.{pulls}, {last_pulled} = excluded.{last_pulled}"
+)
+UPSERT = {
+    "sqlite": ON_CONFLICT,
+    "postgresql": ON_CONFLICT,
+    "mysql": INSERT
+    + (
+        "ON DUPLICATE KEY UPDATE "
+        "{pulls} = {pulls} + VALUES({pulls}), {last_pulled} = VALUES({last_pulled})"
+    ),
+}
+
+
+class PullCounter:
+    """Count pulls per (repository, digest) in memory, and add them to the
+    PullStat table in bulk every PULL_STATS_FLUSH_SECONDS, so a pull doesn't
+    need a write. The counts are flushed by a background thread, so no pull
+    waits on one. Each process (e.g., a gunicorn worker) has its own counts,
+    and a flush adds to the rows, so workers don't overwrite each other.
+    Counts not yet flushed when a process dies are lost.
+    """
+
+    def __init__(self):
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        atexit.register(self.flush)
+
+    def record(self, repository_id, digest):
+        """Count a pull, starting the thread that flushes the counts if needed"""
+        if settings.PULL_STATS_FLUSH_SECONDS is None:
+            return
+        with self.lock:
+            count, _ = self.pending.get((repository_id, digest), (0, None))
+            self.pending[(repository_id, digest)] = (count + 1, timezone.now())
+            full = len(self.pending) >= MAX_PENDING
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        if full:
+            self.wakeup.set()
+
+    def run(self):
+        """Flush the counts when they are due, or sooner if MAX_PENDING are waiting"""
+        while True:
+            self.wakeup.wait(max(settings.PULL_STATS_FLUSH_SECONDS or 0, 0.1))
+            self.wakeup.clear()
+            try:
+                self.flush()
+            finally:
+                connection.close()
+
+    def reset(self):
+        """Forget the counts not yet flushed (e.g., between tests)"""
+        with self.lock:
+            self.pending = {}
+
+    def flush(self):
+        """Add the pending counts to the PullStat table in one statement"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        try:
+            # Counts for a repository deleted since the pull are dropped
+            repository_ids = Repository.objects.filter(
+                id__in={x for x, _ in pending}
+            ).values_list("id", flat=True)
+            repository_ids = set(repository_ids)
+            self.upsert({x: y for x, y in pending.items() if x[0] in repository_ids})
+        except Exception as exc:
+            logger.warning(f"Saving {len(pending)} pull counts failed: {exc}")
+
+    def upsert(self, pending):
+        """Add counts to their rows (creating them) in batches of BATCH_SIZE"""
+        if connection.vendor not in UPSERT:
+            return self.update(pending)
+
+        names = {
+            x: connection.ops.quote_name(PullStat._meta.get_field(x).column)
+            for x in ["repository", "digest", "pulls", "last_pulled"]
+        }
+        table = connection.ops.quote_name(PullStat._meta.db_table)
+        last_pulled = PullStat._meta.get_field("last_pulled")
+        items = list(pending.items())
+        for start in range(0, len(items), BATCH_SIZE):
+            batch = items[start : start + BATCH_SIZE]
+            params = []
+            for (repository_id, digest), (count, pulled) in batch:
+                pulled = last_pulled.get_db_prep_value(pulled, connection)
+                params += [repository_id, digest, count, pulled]
+            sql = UPSERT[connection.vendor].format(
+                table=table,
+                values=", ".join(["(%s, %s, %s, %s)"] * len(batch)),
+                **names,
+            )
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+
+    def update(self, pending):
+        """Add counts one row at a time, for databases without an upsert above"""
+        for (repository_id, digest), (count, pulled) in pending.items():
+            updated = PullStat.objects.filter(
+                repository_id=repository_id, digest=digest
+            ).update(pulls=F("pulls") + count, last_pulled=pulled)
+            if not updated:
+                PullStat.objects.create(
+                    repository_id=repository_id,
+                    digest=digest,
+                    pulls=count,
+                    last_pulled=pulled,
+                )
+
+
+pull_counter = PullCounter()
@@ -16,23 +16,51 @@ limitations under the License.
 
 """
 
+import errno
+import fcntl
 import hashlib
 import logging
 import os
 import shutil
+import time
 import uuid
+from datetime import timedelta
 
-from django.core.files.uploadedfile import SimpleUploadedFile
-from django.http.response import Http404, HttpResponse
+from django.db import IntegrityError, transaction
+from django.http.response import Http404, HttpResponse, StreamingHttpResponse
+from django.middleware import cache
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework.response import Response
 
 from django_oci import settings
-from django_oci.files import ChunkedUpload
-from django_oci.models import Blob
+from django_oci.bloom import blob_filter
+from django_oci.files import (
+    ChunkedUpload,
+    delete_upload_ranges,
+    get_session_dir,
+    get_upload_ranges,
+    get_upload_session,
+    set_upload_ranges,
+    update_upload_session,
+)
+from django_oci.models import Blob, UploadClaim, upsert_rows
+from django_oci.replication import add_events
+from django_oci.sharding import HashRing
+from django_oci.singleflight import SingleFlight
+from django_oci.stats import pull_counter
+from django_oci.tiers import get_read_path
+from django_oci.usage import add_blob_usage, check_quota
+from django_oci.utils import parse_byte_range
 
 logger = logging.getLogger(__name__)
 
+# Coalesce concurrent identical blob lookups (query and stat)
+blob_lookups = SingleFlight("blob")
+
+# Size of chunks read from a blob file and streamed to the client
+CHUNK_SIZE = 1024 * 1024
+
 
 def get_storage():
     """Return the correct storage handler based on the key obtained from
@@ -64,8 +92,200 @@ class StorageBase:
         hasher.update(body)
         return hasher.hexdigest()
 
+    def calculate_file_digest(self, path, algorithm="sha256"):
+        """Calculate the digest of a file, reading it in chunks"""
+        hasher = hashlib.new(algorithm)
+        with open(path, "rb") as fd:
+            for chunk in iter(lambda: fd.read(1024 * 1024), b""):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+
 
 class FileSystemStorage(StorageBase):
+    def __init__(self):
+        self.blobs_dir = os.path.join(settings.MEDIA_ROOT, "blobs")
+        self.session_dir = get_session_dir()
+        os.makedirs(self.session_dir, exist_ok=True)
+
+        # Blobs are spread over storage roots by digest
+        self.storage_roots = settings.STORAGE_ROOTS or [self.blobs_dir]
+        self.ring = HashRing(self.storage_roots)
+        for root in self.storage_roots:
+            os.makedirs(root, exist_ok=True)
+
+            # A rename across filesystems is a copy, and is not atomic
+            if os.stat(self.session_dir).st_dev != os.stat(root).st_dev:
+                logger.warning(
+                    f"{self.session_dir} is not on the same filesystem as {root}, "
+                    "finishing a chunked upload will require a copy."
+                )
+
+    def get_blob_path(self, repository, digest):
+        """Return the path for a finished blob in a repository, under the
+        storage root that the digest hashes to.
+        """
+        return os.path.join(self.ring.get_node(digest), repository.name, digest)
+
+    def get_storage_root(self, path):
+        """Return the storage root that a blob path is under"""
+        for root in self.storage_roots:
+            if path.startswith(os.path.join(root, "")):
+                return root
+        return self.blobs_dir
+
+    def locate_blob(self, blob):
+        """Return the path of a blob file. If it isn't where the row says (e.g.,
+        a rebalance moved it after the row was read) look where it hashes to,
+        and then in every root. Returns None if the file is missing.
+        """
+        path = blob.datafile.name
+        if os.path.exists(path):
+            return path
+        key = os.path.relpath(path, self.get_storage_root(path))
+        roots = [self.ring.get_node(blob.digest)] + self.storage_roots
+        for root in roots:
+            if os.path.exists(os.path.join(root, key)):
+                return os.path.join(root, key)
+
+    def is_misplaced(self, blob):
+        """Determine if a blob file is on a different storage root than the one
+        its digest hashes to. Only the root is compared, as a mounted blob
+        shares the file (and path) of the repository it was mounted from.
+        """
+        root = self.get_storage_root(blob.datafile.name)
+        return root != self.ring.get_node(blob.digest)
+
+    def relocate_blob(self, blob):
+        """Move a blob file to the storage root it hashes to (e.g., after a root
+        was added), keeping its key under the root, and update every row that
+        shares the file (e.g., mounts). Returns True if the file was moved.
+        Readers that looked up the old path find the new one with locate_blob.
+        """
+        source = blob.datafile.name
+        if not self.is_misplaced(blob) or not os.path.exists(source):
+            return False
+        key = blob.storage_key or os.path.relpath(source, self.get_storage_root(source))
+        destination = os.path.join(self.ring.get_node(blob.digest), key)
+        self.move_blob(source, destination)
+        blob.datafile.name = destination
+        blob.storage_key = key
+        blobs = Blob.objects.filter(datafile=source)
+        names = list(blobs.values_list("repository__name", flat=True))
+        blobs.update(datafile=destination, storage_key=key)
+        for name in set(names + [blob.repository.name]):
+            self.forget_blob(name, blob.digest)
+        return True
+
+    def fsync(self, path):
+        """Flush a file (or directory) to disk"""
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def move_blob(self, source, destination):
+        """Move a finished file into place with an atomic rename, so a reader
+        sees either no blob or the whole blob. With an FSYNC_POLICY of "file"
+        the file is flushed before the rename, and with "directory" the new
+        directory entry is flushed after it.
+        """
+        dirname = os.path.dirname(destination)
+        os.makedirs(dirname, exist_ok=True)
+        if settings.FSYNC_POLICY in ["file", "directory"]:
+            self.fsync(source)
+
+        try:
+            os.replace(source, destination)
+
+        # Fall back to a copy to a temporary name beside the destination
+        except OSError as exc:
+            if exc.errno != errno.EXDEV:
+                raise
+            logger.warning(f"Copying {source} across filesystems to {destination}")
+            tmp = "%s.tmp-%s" % (destination, uuid.uuid4())
+            shutil.copyfile(source, tmp)
+            if settings.FSYNC_POLICY in ["file", "directory"]:
+                self.fsync(tmp)
+            os.replace(tmp, destination)
+            os.remove(source)
+
+        if settings.FSYNC_POLICY == "directory":
+            self.fsync(dirname)
+
+    def set_blob_metadata(self, blob, digest, size=None):
+        """Record the size, digest algorithm and storage location of a finished
+        blob, so a HEAD or GET only needs to read its row.
+        """
+        if size is None:
+            size = os.path.getsize(blob.datafile.name)
+        blob.size = size
+        blob.algorithm = digest.split(":", 1)[0] if ":" in digest else "sha256"
+        blob.storage_key = os.path.relpath(
+            blob.datafile.name, self.get_storage_root(blob.datafile.name)
+        )
+
+    def get_root_session_dir(self, destination):
+        """Return the session directory on the storage root of a destination,
+        so moving a finished file there is a rename and not a copy.
+        """
+        session_dir = os.path.join(self.get_storage_root(destination), ".sessions")
+        os.makedirs(session_dir, exist_ok=True)
+        return session_dir
+
+    def write_blob(self, body, destination):
+        """Write a blob from a request body to a session file on the root of
+        the destination, and then move it into place so it is never seen
+        partially written.
+        """
+        tmp = os.path.join(
+            self.get_root_session_dir(destination), "monolithic-%s" % uuid.uuid4()
+        )
+        with open(tmp, "wb") as fd:
+            fd.write(body)
+        self.move_blob(tmp, destination)
+
+    def get_manifest_path(self, digest):
+        """Manifests are content addressed, and shared between repositories"""
+        return os.path.join(self.blobs_dir, ".manifests", digest)
+
+    def save_manifest(self, digest, body):
+        """Save the bytes of a manifest by digest (unless we have them already)
+        and return the storage key to look them up.
+        """
+        path = self.get_manifest_path(digest)
+        if not os.path.exists(path):
+            self.write_blob(body, path)
+        return os.path.relpath(path, self.blobs_dir)
+
+    def read_manifest(self, key):
+        """Return the bytes of a manifest saved with save_manifest"""
+        with open(os.path.join(self.blobs_dir, key), "rb") as fh:
+            return fh.read()
+
+    def delete_manifest(self, key):
+        """Delete the bytes of a manifest saved with save_manifest"""
+        try:
+            os.remove(os.path.join(self.blobs_dir, key))
+        except FileNotFoundError:
+            pass
+
+    def download_manifest(self, image):
+        """Stream a manifest saved with save_manifest, the same as a blob"""
+        try:
+            fh = open(os.path.join(self.blobs_dir, image.manifest_key), "rb")
+        except FileNotFoundError:
+            raise Http404
+
+        size = image.size if image.size is not None else os.fstat(fh.fileno()).st_size
+        response = StreamingHttpResponse(
+            self.read_blob(fh, 0, size - 1),
+            content_type=image.media_type or settings.IMAGE_MANIFEST_CONTENT_TYPE,
+        )
+        response["Content-Length"] = size
+        response["Docker-Content-Digest"] = image.version
+        return response
+
     def create_blob_request(self, repository):
         """A create blob request is intended to be done first with a name,
         and content type, and we do all steps of the creation
@@ -88,35 +308,163 @@ class FileSystemStorage(StorageBase):
         """Finish a blob, meaning finalizing the digest and returning a download
         url relative to the name provided.
         """
+        # Chunks uploaded out of order must cover the blob, and the session stays
+        # open so the client can send the ranges that are missing
+        ranges = None
+        if settings.PARALLEL_CHUNK_UPLOADS:
+            ranges = get_upload_ranges(blob.session_id)
+        if ranges and ranges.ranges:
+            if not ranges.complete:
+                return Response(status=416, headers=self.get_upload_headers(blob))
+
+            # A complete upload that doesn't match the digest can't be resumed
+            algorithm, expected = digest.split(":", 1)
+            if self.calculate_file_digest(blob.datafile.name, algorithm) != expected:
+                self.discard_session(blob)
+                return Response(status=400)
+            delete_upload_ranges(blob.session_id)
+
+        # The whole blob is checked against the quota, less a blob it replaces
+        previous = self.get_previous_size(blob.repository, digest)
+        size = os.path.getsize(blob.datafile.name) if blob.datafile else 0
+        if not check_quota(blob.repository, size - (previous or 0)):
+            self.discard_session(blob)
+            return Response(status=413)
 
         # In the case of a blob created from upload session, need to rename to be digest
-        if blob.datafile.name != digest:
-            final_path = os.path.join(
-                settings.MEDIA_ROOT, "blobs", blob.repository.name, digest
-            )
-            if not os.path.exists(final_path):
-                dirname = os.path.dirname(final_path)
-                if not os.path.exists(dirname):
-                    os.makedirs(dirname)
-                shutil.move(blob.datafile.path, final_path)
-            else:
-                os.remove(blob.datafile.name)
+        final_path = self.get_blob_path(blob.repository, digest)
+        if blob.datafile.name != final_path:
+            self.move_blob(blob.datafile.name, final_path)
             blob.datafile.name = final_path
 
-        # Delete the blob if it already existed
-        try:
-            existing_blob = Blob.objects.get(repository=blob.repository, digest=digest)
-            existing_blob.delete()
-        except Exception:
-            pass
-
-        blob.digest = digest
-        blob.save()
+        # The session blob is replaced by the blob for the digest
+        with transaction.atomic():
+            session = blob
+            blob = self.upsert_blob(
+                session.repository, digest, session.content_type, final_path
+            )
+            add_blob_usage(blob, previous=previous)
+            add_events(blob.repository.name, "blob", digest)
+            session.delete()
+        self.forget_blob(blob.repository.name, digest, added=True)
 
         # Location header must have <blob-location> being a pullable blob URL.
         return Response(status=201, headers={"Location": blob.get_download_url()})
 
-    def create_blob(self, digest, body, content_type, blob=None, repository=None):
+    def discard_session(self, blob):
+        """Remove an upload session blob, with its file and range map"""
+        if blob.datafile:
+            try:
+                os.remove(blob.datafile.name)
+            except FileNotFoundError:
+                pass
+        delete_upload_ranges(blob.session_id)
+        blob.delete()
+
+    def upsert_blob(self, repository, digest, content_type, path, size=None):
+        """Insert the blob for a digest in a repository, or update it if it
+        exists, in one statement (INSERT ... ON CONFLICT). Concurrent pushes
+        of a digest can't collide, and an existing blob keeps its id (and so
+        the images that link to it). A new file clears any quarantine.
+        """
+        blob = Blob(
+            repository=repository,
+            digest=digest,
+            content_type=content_type or settings.DEFAULT_CONTENT_TYPE,
+        )
+        blob.datafile.name = path
+        self.set_blob_metadata(blob, digest, size=size)
+        upsert_rows(
+            Blob,
+            [blob],
+            unique_fields=["repository", "digest"],
+            update_fields=[
+                "content_type",
+                "datafile",
+                "size",
+                "algorithm",
+                "storage_key",
+                "verify_date",
+                "quarantine_date",
+                "modify_date",
+            ],
+        )
+        return blob
+
+    def get_previous_size(self, repository, digest):
+        """Return the size of a blob that a finished blob will replace (0 if it
+        has none), or None if there is no blob, so usage counts the difference.
+        This is read before the transaction that writes the blob, as a sqlite
+        transaction that reads first can't wait on another writer.
+        """
+        existing = (
+            Blob.objects.filter(repository=repository, digest=digest)
+            .values_list("id", "size")
+            .first()
+        )
+        return (existing[1] or 0) if existing else None
+
+    def claim_upload(self, repository, digest):
+        """Claim the upload of a digest to a repository, first clearing a claim
+        left behind (e.g., by a worker that died). Returns True if claimed.
+        While another upload holds the claim this is one read, so waiting on
+        it doesn't write (or fail to write) to the database.
+        """
+        stale = timezone.now() - timedelta(seconds=settings.UPLOAD_CLAIM_SECONDS)
+        claims = UploadClaim.objects.filter(repository=repository, digest=digest)
+        claimed = claims.values_list("add_date", flat=True).first()
+        if claimed and claimed >= stale:
+            return False
+        if claimed:
+            claims.filter(add_date__lt=stale).delete()
+        try:
+            with transaction.atomic():
+                UploadClaim.objects.create(repository=repository, digest=digest)
+            return True
+        except IntegrityError:
+            return False
+
+    def upload_once(self, repository, digest, upload, blob=None):
+        """Run a monolithic upload of a digest (upload is a function that reads
+        the body and creates the blob) unless the blob already exists, in which
+        case the body is never read. If another worker is uploading the same
+        digest, wait for it and use its blob, or take over if it fails.
+        """
+        deadline = time.time() + settings.UPLOAD_CLAIM_SECONDS
+        while True:
+            existing, exists = self.find_blob(repository.name, digest)
+            if not exists and (
+                self.claim_upload(repository, digest) or time.time() > deadline
+            ):
+                # A cached miss can predate the upload we waited on, so look again
+                existing, exists = self._find_blob(repository.name, digest, False)
+                if not exists:
+                    break
+                UploadClaim.objects.filter(
+                    repository=repository, digest=digest
+                ).delete()
+            if exists:
+                if blob:
+                    blob.delete()
+                return Response(
+                    status=201, headers={"Location": existing.get_download_url()}
+                )
+            time.sleep(0.05)
+
+        try:
+            return upload()
+        finally:
+            UploadClaim.objects.filter(repository=repository, digest=digest).delete()
+
+    def create_blob(
+        self,
+        digest,
+        body,
+        content_type,
+        blob=None,
+        repository=None,
+        content_length=None,
+    ):
         """Create an image blob from a monolithic post. We get the repository
         name along with the body for the blob and the digest.
 
@@ -126,7 +474,12 @@ class FileSystemStorage(StorageBase):
         digest (str): the computed digest of the blob
         content_type (str): the blob content type
         blob (models.Blob): a blob object (if already created)
+        content_length (int): if defined, the body must be this length
         """
+        # Confirm that content length (body) == header value, otherwise bad request
+        if content_length is not None and len(body) != content_length:
+            return Response(status=400)
+
         # the <digest> MUST match the blob's digest (how to calculate)
         calculated_digest = self.calculate_digest(body)
 
@@ -137,30 +490,25 @@ class FileSystemStorage(StorageBase):
         if calculated_digest != digest:
             return Response(status=400)
 
-        # If we don't have the blob object yet
-        created = False
-        if not blob:
-            blob, created = Blob.objects.get_or_create(
-                digest=calculated_digest, repository=repository
+        # A file in place was moved there whole, so it doesn't need writing
+        session = blob
+        if session:
+            repository = session.repository
+        final_path = self.get_blob_path(repository, calculated_digest)
+        if not os.path.exists(final_path):
+            self.write_blob(body, final_path)
+
+        # The session blob (if there is one) is replaced by the blob for the digest
+        previous = self.get_previous_size(repository, digest)
+        with transaction.atomic():
+            blob = self.upsert_blob(
+                repository, digest, content_type, final_path, size=len(body)
             )
-
-        # Delete the blob if it already existed
-        try:
-            existing_blob = Blob.objects.get(repository=blob.repository, digest=digest)
-            existing_blob.delete()
-        except Exception:
-            pass
-
-        if not blob.datafile:
-            datafile = SimpleUploadedFile(
-                calculated_digest, body, content_type=content_type
-            )
-            blob.datafile = datafile
-
-        # The digest is updated here if it was previously a session id
-        blob.content_type = content_type
-        blob.digest = digest
-        blob.save()
+            add_blob_usage(blob, previous=previous)
+            add_events(repository.name, "blob", digest)
+            if session:
+                session.delete()
+        self.forget_blob(blob.repository.name, digest, added=True)
 
         # If it's already existing, return Accepted header, otherwise alert created
         # NOTE: this is set to 201 currently because the conformance test only allows that
@@ -200,11 +548,29 @@ class FileSystemStorage(StorageBase):
         if status_code not in [201, 202]:
             return Response(status=status_code)
 
-        # Generate the same upload <location>
+        # Generate the same upload <location>, and the range received so far
+        return Response(status=status_code, headers=self.get_upload_headers(blob))
+
+    def get_upload_headers(self, blob):
+        """Return the Location of an upload session, and the Range of bytes
+        received so far, read from the session metadata.
+        """
         location = reverse(
             "django_oci:blob_upload", kwargs={"session_id": blob.session_id}
         )
-        return Response(status=status_code, headers={"Location": location})
+        session = get_upload_session(blob.session_id) or {}
+        offset = session.get("offset", 0)
+        return {
+            "Location": location,
+            "Range": "0-%s" % max(offset - 1, 0),
+            "Docker-Upload-UUID": blob.digest,
+        }
+
+    def upload_status(self, blob):
+        """Return the status of an upload session, so that an interrupted
+        upload can resume from the last byte received.
+        """
+        return Response(status=204, headers=self.get_upload_headers(blob))
 
     def write_chunk(self, blob, content_start, content_end, body):
         """Write a chunk to a blob. During a chunked upload, the digest corresponds
@@ -214,6 +580,9 @@ class FileSystemStorage(StorageBase):
         if len(body) != content_end - content_start + 1:
             return 416
 
+        if settings.PARALLEL_CHUNK_UPLOADS:
+            return self.write_chunk_at(blob, content_start, content_end, body)
+
         # If we don't yet have a blob.datafile, create a new one, assert that upload_range starts at 0
         if not blob.datafile:
 
@@ -232,46 +601,178 @@ class FileSystemStorage(StorageBase):
         status_code = datafile.write_chunk(body, content_start)
         blob.datafile.name = datafile.file.name
         blob.save()
+        if status_code == 202:
+            update_upload_session(blob.session_id, offset=content_end + 1)
         return status_code
 
+    def write_chunk_at(self, blob, content_start, content_end, body):
+        """Write a chunk at its offset in the session file, in any order, as
+        long as it does not overlap a range already received. Parallel writers
+        to the same session are serialized with a lock on the session file,
+        which also guards the range map kept with the session.
+        """
+        path = os.path.join(get_session_dir(), blob.digest)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            ranges = get_upload_ranges(blob.session_id)
+            if ranges.overlaps(content_start, content_end + 1):
+                return 416
+
+            # Writing past the end leaves a sparse hole for missing chunks
+            os.pwrite(fd, body, content_start)
+            ranges.add(content_start, content_end + 1)
+            set_upload_ranges(blob.session_id, ranges)
+            update_upload_session(blob.session_id, offset=ranges.offset)
+        finally:
+            os.close(fd)
+
+        if blob.datafile.name != path:
+            blob.datafile.name = path
+            blob.save()
+        return 202
+
+    def find_blob(self, name, digest, mounted=False):
+        """Given a blob repository name and digest, look up the blob and check
+        that its file exists. If mounted is True, fall back to a cross mounted
+        blob with a matching digest (any name). Concurrent identical lookups
+        share one query and stat. Returns the blob (or None) and if it exists.
+        """
+        # Definite misses (e.g., most HEADs during a push) skip the database
+        if not blob_filter.might_contain(digest):
+            return None, False
+        filecache = cache.caches["django_oci_upload"]
+        missing_key = self.get_missing_key(name, digest, mounted)
+        if settings.BLOB_NEGATIVE_CACHE_SECONDS and filecache.get(missing_key):
+            return None, False
+
+        key = "%s/%s/%s" % (name, digest, mounted)
+        blob, exists = blob_lookups.do(
+            key, lambda: self._find_blob(name, digest, mounted)
+        )
+        if not blob and settings.BLOB_NEGATIVE_CACHE_SECONDS:
+            filecache.set(missing_key, 1, timeout=settings.BLOB_NEGATIVE_CACHE_SECONDS)
+        return blob, exists
+
+    def get_missing_key(self, name, digest, mounted=False):
+        """A mounted lookup can find a blob in any repository, so a miss for it
+        is only kept by digest.
+        """
+        if mounted:
+            return "blob-missing/%s" % digest
+        return "blob-missing/%s/%s" % (name, digest)
+
+    def _find_blob(self, name, digest, mounted):
+        blob = Blob.objects.filter(digest=digest, repository__name=name).first()
+        if mounted and (not blob or blob.quarantine_date):
+            healthy = Blob.objects.filter(digest=digest, quarantine_date__isnull=True)
+            blob = healthy.first() or blob
+        if not blob:
+            return None, False
+
+        # A quarantined blob (its file didn't match) is missing until pushed again
+        if blob.quarantine_date:
+            return blob, False
+
+        # Blobs finished before sizes were recorded still need a stat
+        if blob.size is not None:
+            return blob, True
+        return blob, self.locate_blob(blob) is not None
+
+    def forget_blob(self, name, digest, added=False):
+        """Forget any shared lookup (or miss) of a blob after it changes. A blob
+        that was added (finished or mounted) is also added to the filter, and
+        other processes are told to refresh theirs. A deleted digest stays in
+        the filter, as the negative cache answers for it.
+        """
+        filecache = cache.caches["django_oci_upload"]
+        for mounted in [True, False]:
+            blob_lookups.forget("%s/%s/%s" % (name, digest, mounted))
+            filecache.delete(self.get_missing_key(name, digest, mounted))
+        if added:
+            blob_filter.add(digest)
+            blob_filter.changed()
+
     def blob_exists(self, name, digest):
         """Given a blob repository name and digest, return a 200 response
         with the digest of the uploaded blob in the header Docker-Content-Digest.
         """
-        try:
-            blob = Blob.objects.get(digest=digest, repository__name=name)
-        except Blob.DoesNotExist:
+        blob, exists = self.find_blob(name, digest)
+        if not blob or not exists:
             raise Http404
-        headers = {"Docker-Content-Digest": blob.digest}
-        return Response(status=200, headers=headers)
-
-    def download_blob(self, name, digest):
+        headers = {
+            "Docker-Content-Digest": blob.digest,
+            "Content-Length": self.get_blob_size(blob),
+            "Accept-Ranges": "bytes",
+        }
+        return HttpResponse(status=200, headers=headers, content_type=blob.content_type)
+
+    def get_blob_size(self, blob):
+        """The size of a blob, from its row unless it has yet to be backfilled"""
+        if blob.size is not None:
+            return blob.size
+        return os.path.getsize(self.locate_blob(blob))
+
+    def read_blob(self, fh, start, end):
+        """Yield the bytes of an open blob from start to end (inclusive) in chunks"""
+        with fh:
+            fh.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = fh.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    def download_blob(self, name, digest, byte_range=None):
         """Given a blob repository name and digest, return response to stream download.
-        The repository name is associated to the blob via the image.
+        The repository name is associated to the blob via the image. If a byte
+        range (a Range header) is given, only that part of the blob is returned.
         """
-        try:
-            blob = Blob.objects.get(digest=digest, repository__name=name)
-        except Blob.DoesNotExist:
-            try:
-                # Try getting a cross mounted blob with matching digest (any name)
-                blob = Blob.objects.filter(digest=digest).first()
-            except Blob.DoesNotExist:
-                raise Http404
+        blob, exists = self.find_blob(name, digest, mounted=True)
 
-        # If we don't have a blob, no go.
-        if not blob:
+        # If we don't have a blob, or the file doesn't exist, no go.
+        if not blob or not exists:
             raise Http404
 
-        if os.path.exists(blob.datafile.name):
-            with open(blob.datafile.name, "rb") as fh:
-                response = HttpResponse(fh.read(), content_type=blob.content_type)
-                response[
-                    "Content-Disposition"
-                ] = "inline; filename=" + os.path.basename(blob.datafile.name)
-                return response
+        size = self.get_blob_size(blob)
+        start, end, status = 0, size - 1, 200
+        if byte_range:
+            try:
+                start, end = parse_byte_range(byte_range, size)
+            except ValueError:
+                return HttpResponse(
+                    status=416, headers={"Content-Range": "bytes */%s" % size}
+                )
+            status = 206
+
+        # Open the file here, so a missing file is a 404 and not a broken stream
+        path = self.locate_blob(blob) or blob.datafile.name
+        try:
+            fh = open(get_read_path(blob.digest, path, size), "rb")
+        except FileNotFoundError:
+            # The hot copy can be demoted between the lookup and the open
+            try:
+                fh = open(path, "rb")
+            except FileNotFoundError:
+                raise Http404
+        pull_counter.record(blob.repository_id, blob.digest)
 
-        # If we get here, file doesn't exist
-        raise Http404
+        response = StreamingHttpResponse(
+            self.read_blob(fh, start, end),
+            status=status,
+            content_type=blob.content_type,
+        )
+        response["Content-Length"] = end - start + 1
+        response["Docker-Content-Digest"] = blob.digest
+        response["Accept-Ranges"] = "bytes"
+        response["Content-Disposition"] = "inline; filename=" + os.path.basename(
+            blob.datafile.name
+        )
+        if status == 206:
+            response["Content-Range"] = "bytes %s-%s/%s" % (start, end, size)
+        return response
 
     def delete_blob(self, name, digest):
         """Given a blob repository name and digest, delete and return success (202)."""
@@ -282,6 +783,7 @@ class FileSystemStorage(StorageBase):
 
         # Delete the blob, will eventually need to check permissions
         blob.delete()
+        self.forget_blob(name, digest)
         return Response(status=202)
 
 
@@ -0,0 +1,221 @@
+"""
+
+Copyright (c) 2020-2023, Vanessa Sochat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import atexit
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from django.db import connection, transaction
+from django.db.models import F, Sum
+from django.middleware import cache
+from django.utils import timezone
+
+from django_oci import settings
+from django_oci.models import Blob, HotBlob, upsert_rows
+
+logger = logging.getLogger(__name__)
+
+# The number of seconds pulls of hot blobs are counted in memory before they are saved
+HIT_FLUSH_SECONDS = 10
+
+# Blobs being copied to the hot tier (one copy per digest)
+_promotions = {}
+_lock = threading.Lock()
+
+
+class HitCounter:
+    """Count pulls of blobs served from the hot tier in memory, and add them
+    (with the time of the last pull) to their HotBlob rows from a background
+    thread every HIT_FLUSH_SECONDS, so a pull of a hot blob doesn't write.
+    A sweep flushes first, to evict with the hits of its own process.
+    """
+
+    def __init__(self):
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        atexit.register(self.flush)
+
+    def record(self, digest):
+        """Count a pull, starting the thread that flushes the counts if needed"""
+        with self.lock:
+            hits, _ = self.pending.get(digest, (0, None))
+            self.pending[digest] = (hits + 1, timezone.now())
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(HIT_FLUSH_SECONDS)
+            try:
+                self.flush()
+            finally:
+                connection.close()
+
+    def reset(self):
+        """Forget the hits not yet flushed (e.g., between tests)"""
+        with self.lock:
+            self.pending = {}
+
+    def flush(self):
+        """Add the pending hits to their rows"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        try:
+            with transaction.atomic():
+                for digest, (hits, last_access) in pending.items():
+                    HotBlob.objects.filter(digest=digest).update(
+                        hits=F("hits") + hits, last_access=last_access
+                    )
+        except Exception as exc:
+            logger.warning(f"Saving {len(pending)} hot blob hits failed: {exc}")
+
+
+hot_hits = HitCounter()
+
+
+def get_hot_path(digest):
+    """Blobs in the hot tier are content addressed, and shared between repositories"""
+    return os.path.join(settings.HOT_STORAGE_ROOT, digest)
+
+
+def get_read_path(digest, path, size):
+    """Given the digest, path and size of a blob being pulled, return the path
+    to read it from: its copy in the hot tier if there is one. Pulls of other
+    blobs are counted, and one pulled HOT_STORAGE_PROMOTE_HITS times is copied
+    to the hot tier in the background.
+    """
+    if not settings.HOT_STORAGE_ROOT:
+        return path
+
+    hot_path = get_hot_path(digest)
+    if os.path.exists(hot_path):
+        hot_hits.record(digest)
+        return hot_path
+
+    if count_pull(digest) >= settings.HOT_STORAGE_PROMOTE_HITS:
+        promote(digest, path, size)
+    return path
+
+
+def count_pull(digest):
+    """Count a pull of a blob that is not in the hot tier, returning the count"""
+    filecache = cache.caches["django_oci_upload"]
+    key = "blob-pulls/%s" % digest
+    if filecache.add(key, 1, timeout=None):
+        return 1
+    try:
+        return filecache.incr(key)
+    except ValueError:
+        filecache.set(key, 1, timeout=None)
+        return 1
+
+
+def promote(digest, path, size):
+    """Start copying a blob to the hot tier, unless it is already underway"""
+    with _lock:
+        if digest in _promotions:
+            return
+        thread = threading.Thread(
+            target=run_promotion, args=(digest, path, size), daemon=True
+        )
+        _promotions[digest] = thread
+    thread.start()
+
+
+def run_promotion(digest, path, size):
+    try:
+        copy_to_hot(digest, path, size)
+        sweep()
+    except Exception as exc:
+        logger.warning(f"Promotion of {digest} to the hot tier failed: {exc}")
+    finally:
+        with _lock:
+            _promotions.pop(digest, None)
+        connection.close()
+
+
+def copy_to_hot(digest, path, size):
+    """Copy a blob to the hot tier under a temporary name, and then move it
+    into place, so a reader sees either no copy or the whole copy.
+    """
+    hot_path = get_hot_path(digest)
+    os.makedirs(settings.HOT_STORAGE_ROOT, exist_ok=True)
+    tmp = "%s.tmp-%s" % (hot_path, uuid.uuid4())
+    shutil.copyfile(path, tmp)
+    os.replace(tmp, hot_path)
+
+    filecache = cache.caches["django_oci_upload"]
+    hits = filecache.get("blob-pulls/%s" % digest) or 0
+    upsert_rows(
+        HotBlob,
+        [HotBlob(digest=digest, size=size, hits=hits, last_access=timezone.now())],
+        unique_fields=["digest"],
+        update_fields=["size", "hits", "last_access"],
+    )
+    filecache.delete("blob-pulls/%s" % digest)
+
+
+def sweep(budget=None, dry_run=False):
+    """Demote (delete the hot copy of) blobs until the hot tier is under its
+    budget, evicting the least recently or least frequently pulled first
+    (HOT_STORAGE_EVICTION), and copies of blobs that were deleted. The
+    blobs are always kept in their storage root, so demotion is a delete.
+    Returns the demoted blobs.
+    """
+    if budget is None:
+        budget = settings.HOT_STORAGE_BYTES
+    hot_hits.flush()
+
+    demoted = list(HotBlob.objects.exclude(digest__in=Blob.objects.values("digest")))
+    total = HotBlob.objects.aggregate(total=Sum("size"))["total"] or 0
+    total -= sum(x.size for x in demoted)
+
+    order = ["last_access"]
+    if settings.HOT_STORAGE_EVICTION == "lfu":
+        order = ["hits", "last_access"]
+    if total > budget:
+        hot_blobs = HotBlob.objects.exclude(pk__in=[x.pk for x in demoted])
+        for hot_blob in hot_blobs.order_by(*order).iterator():
+            if total <= budget:
+                break
+            demoted.append(hot_blob)
+            total -= hot_blob.size
+
+    if not dry_run:
+        demote(demoted)
+    return demoted
+
+
+def demote(hot_blobs):
+    """Delete hot copies of blobs. A reader with the file open keeps reading
+    it, and a new reader is served from the storage root.
+    """
+    for hot_blob in hot_blobs:
+        try:
+            os.remove(get_hot_path(hot_blob.digest))
+        except FileNotFoundError:
+            pass
+    HotBlob.objects.filter(pk__in=[x.pk for x in hot_blobs]).delete()
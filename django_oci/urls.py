@@ -41,6 +41,13 @@ urlpatterns = [
         views.ImageTags.as_view(),
         name="image_tags",
     ),
+    # Not in the distribution spec: a repository as an OCI image layout tar
+    re_path(
+        r"^%s/(?P<name>[a-z0-9\/-_]+(?:[._-][a-z0-9]+)*)/export/?$"
+        % settings.URL_PREFIX,
+        views.RepositoryExport.as_view(),
+        name="repository_export",
+    ),
     # This is for a full digest reference
     # https://github.com/opencontainers/distribution-spec/blob/master/spec.md#pulling-an-image-manifest
     re_path(
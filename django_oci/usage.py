@@ -0,0 +1,119 @@
+"""
+
+Copyright (c) 2020-2023, Vanessa Sochat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+from django.db.models import Count, F, Q, Sum
+from django.utils import timezone
+
+from django_oci import settings
+from django_oci.models import Blob, Image, RepositoryUsage
+
+
+def is_shared(blob):
+    """A blob mounted from another repository is stored under it"""
+    name = blob.repository.name
+    return bool(blob.storage_key) and not blob.storage_key.startswith(name + "/")
+
+
+def add_usage(repository_id, **deltas):
+    """Add to (or with negative values, subtract from) the usage counters of a
+    repository in one statement. A repository without a row only gets one
+    when usage is added, so a delete (e.g., of a repository and its blobs)
+    never creates a row.
+    """
+    deltas = {key: value for key, value in deltas.items() if value}
+    if not deltas:
+        return
+    updates = {key: F(key) + value for key, value in deltas.items()}
+    updated = RepositoryUsage.objects.filter(repository_id=repository_id).update(
+        modify_date=timezone.now(), **updates
+    )
+    if not updated and all(value > 0 for value in deltas.values()):
+        RepositoryUsage.objects.bulk_create(
+            [RepositoryUsage(repository_id=repository_id)], ignore_conflicts=True
+        )
+        RepositoryUsage.objects.filter(repository_id=repository_id).update(
+            modify_date=timezone.now(), **updates
+        )
+
+
+def add_blob_usage(blob, sign=1, previous=None):
+    """Count a finished (or with a sign of -1, deleted) blob. If the blob
+    replaced a row with a size (previous), only the difference is counted.
+    """
+    if blob.size is None or blob.digest.startswith("session-"):
+        return
+    size = blob.size if previous is None else blob.size - previous
+    add_usage(
+        blob.repository_id,
+        blob_count=sign if previous is None else 0,
+        blob_bytes=sign * size,
+        shared_bytes=sign * size if is_shared(blob) else 0,
+    )
+
+
+def add_image_usage(image, sign=1, previous=None):
+    """Count a pushed (or with a sign of -1, deleted) manifest"""
+    size = image.size or 0
+    if previous is not None:
+        size -= previous
+    add_usage(
+        image.repository_id,
+        manifest_count=sign if previous is None else 0,
+        manifest_bytes=sign * size,
+    )
+
+
+def check_quota(repository, size):
+    """Return True if a repository can store size more bytes. This is one read
+    of the usage row (by primary key).
+    """
+    usage = (
+        RepositoryUsage.objects.filter(repository_id=repository.id)
+        .values_list("blob_bytes", "shared_bytes", "quota_bytes")
+        .first()
+    )
+    used, shared, quota = usage or (0, 0, None)
+    if quota is None:
+        quota = settings.REPOSITORY_QUOTA_BYTES
+    return quota is None or used - shared + size <= quota
+
+
+def reconcile(repository):
+    """Recompute the usage of a repository from its blobs and manifests, to
+    correct any drift (e.g., from concurrent pushes of the same blob, or
+    rows changed outside of the registry). The quota is kept.
+    """
+    blobs = (
+        Blob.objects.filter(repository=repository, size__isnull=False)
+        .exclude(digest__startswith="session-")
+        .aggregate(
+            blob_count=Count("id"),
+            blob_bytes=Sum("size"),
+            shared_bytes=Sum(
+                "size",
+                filter=Q(storage_key__isnull=False)
+                & ~Q(storage_key__startswith=repository.name + "/"),
+            ),
+        )
+    )
+    images = Image.objects.filter(repository=repository).aggregate(
+        manifest_count=Count("id"), manifest_bytes=Sum("size")
+    )
+    counts = {key: value or 0 for key, value in {**blobs, **images}.items()}
+    RepositoryUsage.objects.update_or_create(repository=repository, defaults=counts)
+    return counts
@@ -22,6 +22,9 @@ import re
 logger = logging.getLogger(__name__)
 
 
+# A valid tag, from the distribution spec
+TAG_REGEX = re.compile("^[a-zA-Z0-9_][a-zA-Z0-9._-]{0,127}$")
+
 # Regular expressions to parse registry, collection, repo, tag and version
 _docker_uri = re.compile(
     "(?:(?P<registry>[^/@]+[.:][^/@]*)/)?"
@@ -80,6 +83,40 @@ def parse_content_range(content_range):
     return [int(x.strip()) for x in content_range.strip().split("-")]
 
 
+def parse_byte_range(byte_range, size):
+    """Given a Range header (bytes=<start>-<end>, bytes=<start>- or bytes=-<suffix>)
+    and the size of the content, return the inclusive start and end. A range
+    that cannot be satisfied (or that we don't support, e.g., multiple ranges)
+    raises a ValueError.
+    """
+    match = re.search("^bytes=([0-9]*)-([0-9]*)$", byte_range.strip())
+    if not match or match.groups() == ("", ""):
+        raise ValueError
+
+    start, end = match.groups()
+    if start == "":
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start = int(start)
+        end = min(int(end), size - 1) if end else size - 1
+
+    if start > end or start >= size:
+        raise ValueError
+    return start, end
+
+
+def parse_platform(platform):
+    """Given a platform string (os/architecture[/variant], e.g., linux/arm64/v8)
+    return the os, architecture and variant (None if not defined).
+    """
+    parts = platform.strip().strip("/").split("/")
+    if len(parts) not in [2, 3] or not all(parts):
+        raise ValueError
+    if len(parts) == 2:
+        parts.append(None)
+    return parts
+
+
 def parse_image_name(
     image_name,
     tag=None,
@@ -4,6 +4,7 @@ from django_oci.storage import get_storage
 from .auth import GetAuthToken
 from .base import APIVersionCheck
 from .blobs import BlobDownload, BlobUpload
+from .export import RepositoryExport
 from .image import ImageManifest, ImageTags
 
 storage = get_storage()
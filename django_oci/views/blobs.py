@@ -16,6 +16,7 @@ limitations under the License.
 
 """
 
+from django.http.response import Http404
 from django.middleware import cache
 from django.shortcuts import get_object_or_404
 from django.utils.decorators import method_decorator
@@ -24,10 +25,14 @@ from ratelimit.decorators import ratelimit
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from django_oci import settings
+from django_oci import proxy, settings
 from django_oci.auth import is_authenticated
+from django_oci.files import get_upload_session
 from django_oci.models import Blob, Repository
+from django_oci.notifications import notifier
+from django_oci.replication import replicated
 from django_oci.storage import storage
+from django_oci.usage import add_blob_usage, check_quota
 from django_oci.utils import parse_content_range
 
 
@@ -61,12 +66,46 @@ class BlobDownload(APIView):
         name = kwargs.get("name")
         digest = kwargs.get("digest")
 
-        # If allow_continue False, return response
-        allow_continue, response, _ = is_authenticated(request, name, scopes=["pull"])
+        # Anyone can pull from a proxied repository, created on first pull
+        proxied = proxy.is_proxied(name)
+        allow_continue, response, user = is_authenticated(
+            request,
+            name,
+            must_be_owner=not proxied,
+            repository_exists=not proxied,
+            scopes=["pull"],
+        )
         if not allow_continue:
             return response
+        if proxied:
+            proxy.get_repository(name)
 
-        return storage.download_blob(name, digest)
+        try:
+            response = storage.download_blob(
+                name, digest, byte_range=request.META.get("HTTP_RANGE")
+            )
+        except Http404:
+            if not proxied:
+                raise
+
+            # A miss for a proxied repository is streamed from the upstream
+            response = proxy.get_blob(name, digest)
+            if not response:
+                raise Http404
+
+        # Only a whole blob is a pull, and not each range of one
+        if response.status_code == 200:
+            size = response.get("Content-Length")
+            notifier.notify(
+                request,
+                "pull",
+                name,
+                digest,
+                media_type=response.get("Content-Type"),
+                size=int(size) if size else None,
+                user=user,
+            )
+        return response
 
     @method_decorator(
         ratelimit(
@@ -84,13 +123,15 @@ class BlobDownload(APIView):
         digest = kwargs.get("digest")
 
         # If allow_continue False, return response
-        allow_continue, response, _ = is_authenticated(
+        allow_continue, response, user = is_authenticated(
             request, name, must_be_owner=True
         )
         if not allow_continue:
             return response
 
-        return storage.delete_blob(name, digest)
+        response = storage.delete_blob(name, digest)
+        notifier.notify(request, "delete", name, digest, user=user)
+        return response
 
     @method_decorator(never_cache)
     @method_decorator(
@@ -108,15 +149,30 @@ class BlobDownload(APIView):
         name = kwargs.get("name")
         digest = kwargs.get("digest")
 
-        # If allow_continue False, return response
+        # A proxied repository is checked like a pull
+        proxied = proxy.is_proxied(name)
         allow_continue, response, _ = is_authenticated(
-            request, name, must_be_owner=True
+            request,
+            name,
+            must_be_owner=not proxied,
+            repository_exists=not proxied,
+            scopes=["pull"] if proxied else None,
         )
         if not allow_continue:
             return response
 
         # A HEAD request to an existing blob or manifest URL MUST return 200 OK.
-        return storage.blob_exists(name, digest)
+        try:
+            return storage.blob_exists(name, digest)
+        except Http404:
+            if not proxied:
+                raise
+
+        # A miss for a proxied repository is answered by the upstream
+        response = proxy.head_blob(name, digest)
+        if not response:
+            raise Http404
+        return response
 
 
 @method_decorator(never_cache, name="dispatch")
@@ -128,11 +184,42 @@ class BlobUpload(APIView):
 
     permission_classes = []
     allowed_methods = (
+        "GET",
         "POST",
         "PUT",
         "PATCH",
     )
 
+    @method_decorator(never_cache)
+    @method_decorator(
+        ratelimit(
+            key="ip",
+            rate=settings.VIEW_RATE_LIMIT,
+            method="GET",
+            block=settings.VIEW_RATE_LIMIT_BLOCK,
+        )
+    )
+    def get(self, request, *args, **kwargs):
+        """
+        GET /v2/<name>/blobs/uploads/<session_id>
+        Return the status of an upload session, with the range of bytes received
+        so an interrupted upload can resume. This is read from the session
+        metadata, without looking at the session file.
+        """
+        session_id = kwargs.get("session_id")
+        if not session_id or not get_upload_session(session_id):
+            return Response(status=404)
+
+        # Break apart into blob id and session uuid
+        _, blob_id, version = session_id.split("/", 3)
+        blob = get_object_or_404(Blob, id=blob_id, digest=version)
+        allow_continue, response, _ = is_authenticated(
+            request, blob.repository, must_be_owner=True
+        )
+        if not allow_continue:
+            return response
+        return storage.upload_status(blob)
+
     @method_decorator(never_cache)
     @method_decorator(
         ratelimit(
@@ -167,18 +254,11 @@ class BlobUpload(APIView):
         if not session_id or not digest or not content_type:
             return Response(status=400)
 
-        # Confirm that content length (body) == header value, otherwise bad request
-        if len(request.body) != content_length:
-            return Response(status=400)
-
         # Get the session id, if it has not expired
         filecache = cache.caches["django_oci_upload"]
         if not filecache.get(session_id):
             return Response(status=400)
 
-        # Ensure it cannot be used again
-        filecache.set(session_id, None, timeout=0)
-
         # Break apart into blob id, and session uuid (version)
         _, blob_id, version = session_id.split("/")
         blob = get_object_or_404(Blob, id=blob_id, digest=version)
@@ -190,50 +270,65 @@ class BlobUpload(APIView):
         if not allow_continue:
             return response
 
-        if not content_range and request.body:
+        if not content_range and content_length:
+
+            # Ensure it cannot be used again
+            filecache.set(session_id, None, timeout=0)
+
+            def upload():
+                # A blob over quota is refused before the body is read
+                if not check_quota(blob.repository, content_length):
+                    return Response(status=413)
+                return storage.create_blob(
+                    blob=blob,
+                    body=request.body,
+                    digest=digest,
+                    content_type=content_type,
+                    content_length=content_length,
+                )
 
             # Now process the PUT request to the file! Provide the blob to update
-            return storage.create_blob(
-                blob=blob,
-                body=request.body,
-                digest=digest,
-                content_type=content_type,
-            )
+            # The body is only read if the blob isn't there, or being uploaded by another client
+            return storage.upload_once(blob.repository, digest, upload, blob=blob)
 
-        # Scenario 2: a PUT to end a chunked upload session, no final chunk
-        elif not request.body:
-            return storage.finish_blob(
-                blob=blob,
-                digest=digest,
-            )
+        # Confirm that content length (body) == header value, otherwise bad request
+        if len(request.body) != content_length:
+            return Response(status=400)
 
         # Scenario 3: a PUT to end a chunked upload session with a final chunk
-        # First ensure upload session cannot be used again
-        filecache.set(session_id, None, timeout=0)
+        if request.body:
+            try:
+                content_start, content_end = parse_content_range(content_range)
+            except ValueError:
+                return Response(status=400)
 
-        # Parse the start and end for the chunk to write
-        try:
-            content_start, content_end = parse_content_range(content_range)
-        except ValueError:
-            return Response(status=400)
+            # A final chunk that would take the blob over quota is refused
+            if not check_quota(blob.repository, content_end + 1):
+                return Response(status=413)
 
-        # Write the final chunk and finish the session
-        status_code = storage.write_chunk(
-            blob=blob,
-            content_start=content_start,
-            content_end=content_end,
-            body=request.body,
-        )
+            # Write the final chunk and finish the session
+            status_code = storage.write_chunk(
+                blob=blob,
+                content_start=content_start,
+                content_end=content_end,
+                body=request.body,
+            )
 
-        # If it's already existing, return Accepted header, otherwise alert created
-        if status_code != 202:
-            return Response(status=status_code)
+            # If it's already existing, return Accepted header, otherwise alert created
+            if status_code != 202:
+                return Response(status=status_code)
 
-        return storage.finish_blob(
+        # Scenario 2: a PUT to end a chunked upload session, no final chunk
+        response = storage.finish_blob(
             blob=blob,
             digest=digest,
         )
 
+        # A session missing chunks stays open, otherwise it cannot be used again
+        if response.status_code != 416:
+            filecache.set(session_id, None, timeout=0)
+        return response
+
     @method_decorator(never_cache)
     def patch(self, request, *args, **kwargs):
         """a patch request is done after a POST with content-length 0 to indicate
@@ -247,10 +342,15 @@ class BlobUpload(APIView):
         if not session_id or not content_length or not content_type:
             return Response(status=400)
 
-        # If a content range is not defined, assume start to end
+        # Get the session id, if it has not expired, keep open for next
+        session = get_upload_session(session_id)
+        if not session:
+            return Response(status=400)
+
+        # If a content range is not defined, continue from the bytes received
         if not content_range:
-            content_start = 0
-            content_end = content_length - 1
+            content_start = session.get("offset", 0)
+            content_end = content_start + content_length - 1
 
         else:
             # Parse content range into start and end (int)
@@ -259,15 +359,6 @@ class BlobUpload(APIView):
             except ValueError:
                 return Response(status=400)
 
-        # Confirm that content length (body) == header value, otherwise bad request
-        if len(request.body) != content_length:
-            return Response(status=400)
-
-        # Get the session id, if it has not expired, keep open for next
-        filecache = cache.caches["django_oci_upload"]
-        if not filecache.get(session_id):
-            return Response(status=400)
-
         # Break apart into blob id and session uuid
         _, blob_id, version = session_id.split("/", 3)
         blob = get_object_or_404(Blob, id=blob_id, digest=version)
@@ -277,6 +368,14 @@ class BlobUpload(APIView):
         if not allow_continue:
             return response
 
+        # A blob over quota is refused before the chunk is read
+        if not check_quota(blob.repository, content_end + 1):
+            return Response(status=413)
+
+        # Confirm that content length (body) == header value, otherwise bad request
+        if len(request.body) != content_length:
+            return Response(status=400)
+
         # Update the blob content_type TODO: There should be some check
         # to ensure that a next chunk content type is not different from that
         # already defined
@@ -353,18 +452,22 @@ class BlobUpload(APIView):
 
             digest = request.GET["digest"]
 
-            # Confirm that content length (body) == header value, otherwise bad request
-            if len(request.body) != content_length:
-                return Response(status=400)
+            def upload():
+                # A blob over quota is refused before the body is read
+                if not check_quota(repository, content_length):
+                    return Response(status=413)
+                return storage.create_blob(
+                    body=request.body,
+                    digest=digest,
+                    content_type=content_type,
+                    repository=repository,
+                    content_length=content_length,
+                )
 
             # The storage.create_blob handles creation of blob with body (no second request required)
             # We only pass the name to return it with the blob's download url, there is no association
-            return storage.create_blob(
-                body=request.body,
-                digest=digest,
-                content_type=content_type,
-                repository=repository,
-            )
+            # The body is only read if the blob isn't there, or being uploaded by another client
+            return storage.upload_once(repository, digest, upload)
 
         # Case 2: Mount a blob from a different repository
         # /v2/<name>/blobs/uploads/?mount=<digest>&from=<other_name>
@@ -375,7 +478,11 @@ class BlobUpload(APIView):
 
             # Mount is the digest of the blob we need. We use the same datafile
             try:
-                blob = Blob.objects.get(digest=mount, repository=from_repository)
+                blob = Blob.objects.get(
+                    digest=mount,
+                    repository=from_repository,
+                    quarantine_date__isnull=True,
+                )
             except Blob.DoesNotExist:
                 # Cross-mounting of nonexistent blob should yield session id
                 return storage.create_blob_request(repository)
@@ -385,8 +492,22 @@ class BlobUpload(APIView):
             blob.id = None
             blob.repository = repository
             blob.digest = mount
-            blob.save()
+            with replicated(repository.name, "blob", mount):
+                blob.save()
+                add_blob_usage(blob)
             from_repository.save()
+            storage.forget_blob(repository.name, mount, added=True)
+            notifier.notify(
+                request,
+                "mount",
+                repository.name,
+                mount,
+                media_type=blob.content_type,
+                size=blob.size,
+                url=blob.get_download_url(),
+                user=user,
+                from_repository=from_repository.name,
+            )
 
             # Successful mount MUST be 201 Created, and MUST contain Location: <blob-location>
             return Response(status=201, headers={"Location": blob.get_download_url()})
@@ -0,0 +1,83 @@
+"""
+
+Copyright (c) 2020-2023, Vanessa Sochat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+from django.http import StreamingHttpResponse
+from django.http.response import Http404
+from django.utils.decorators import method_decorator
+from django.views.decorators.cache import never_cache
+from ratelimit.decorators import ratelimit
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from django_oci import settings
+from django_oci.auth import is_authenticated
+from django_oci.exporter import ExportError, LayoutExport
+from django_oci.models import Repository
+
+
+@method_decorator(never_cache, name="dispatch")
+class RepositoryExport(APIView):
+    """
+    Stream a repository (or some of its tags) as an OCI image layout tar.
+    """
+
+    permission_classes = []
+    allowed_methods = ("GET",)
+
+    @method_decorator(
+        ratelimit(
+            key="ip",
+            rate=settings.VIEW_RATE_LIMIT,
+            method="GET",
+            block=settings.VIEW_RATE_LIMIT_BLOCK,
+        )
+    )
+    @method_decorator(never_cache)
+    def get(self, request, *args, **kwargs):
+        """
+        GET /v2/<name>/export/?tag=<tag>&tag=<tag>. Without a tag, every
+        manifest in the repository is exported.
+        """
+        name = kwargs.get("name")
+        try:
+            repository = Repository.objects.get(name=name)
+        except Repository.DoesNotExist:
+            raise Http404
+
+        allow_continue, response, _ = is_authenticated(
+            request, repository, scopes=["pull"]
+        )
+        if not allow_continue:
+            return response
+
+        try:
+            export = LayoutExport(repository, tags=request.GET.getlist("tag")).plan()
+        except ValueError:
+            raise Http404
+
+        # A blob that cannot be exported fails the export, before it starts
+        except ExportError as exc:
+            return Response({"message": str(exc)}, status=409)
+
+        response = StreamingHttpResponse(
+            export.stream(), content_type="application/x-tar"
+        )
+        response["Content-Disposition"] = (
+            'attachment; filename="%s.tar"' % name.replace("/", "-")
+        )
+        return response
@@ -16,7 +16,7 @@ limitations under the License.
 
 """
 
-from django.http.response import Http404
+from django.http.response import Http404, HttpResponse
 from django.utils.decorators import method_decorator
 from django.views.decorators.cache import never_cache
 from ratelimit.decorators import ratelimit
@@ -24,9 +24,23 @@ from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from django_oci import settings
+from django_oci import proxy, settings
 from django_oci.auth import is_authenticated
-from django_oci.models import Repository, get_image_by_tag
+from django_oci.models import (
+    Repository,
+    Tag,
+    calculate_digest,
+    forget_image,
+    get_image_by_tag,
+    get_image_metadata,
+    resolve_platform,
+    set_tags,
+)
+from django_oci.notifications import notifier
+from django_oci.replication import replicated
+from django_oci.stats import pull_counter
+from django_oci.storage import storage
+from django_oci.utils import TAG_REGEX
 
 from .parsers import ManifestRenderer
 
@@ -70,32 +84,25 @@ class ImageTags(APIView):
         if not allow_continue:
             return response
 
-        tags = [
-            x
-            for x in list(repository.image_set.values_list("tag__name", flat=True))
-            if x
-        ]
+        # Tags must be sorted in lexical order (a scan of the tag index)
+        tags = repository.tag_set.order_by("name")
 
-        # Tags must be sorted in lexical order
-        tags.sort()
+        # if last, <tagname> not included in the results, but up to <int> tags after <tagname> will be returned.
+        if last:
+            tags = tags.filter(name__gt=last)
 
         # Number must be an integer if defined
         if number:
-            number = int(number)
-
-        # if last, <tagname> not included in the results, but up to <int> tags after <tagname> will be returned.
-        if last and number:
             try:
-                start = tags.index(last)
-            except IndexError:
-                start = 0
-            tags = tags[start:number]
-
-        elif number:
+                number = int(number)
+            except ValueError:
+                return Response(status=400)
             tags = tags[:number]
 
-        # Ensure tags sorted in lexical order
-        data = {"name": repository.name, "tags": sorted(tags)}
+        data = {
+            "name": repository.name,
+            "tags": list(tags.values_list("name", flat=True)),
+        }
         return Response(status=200, data=data)
 
 
@@ -138,7 +145,7 @@ class ImageManifest(APIView):
         tag = kwargs.get("tag")
 
         # If allow_continue False, return response
-        allow_continue, response, _ = is_authenticated(
+        allow_continue, response, user = is_authenticated(
             request, name, must_be_owner=True
         )
         if not allow_continue:
@@ -151,13 +158,24 @@ class ImageManifest(APIView):
 
         # Delete the image tag
         if tag:
-            tag = image.tag_set.filter(name=tag)
-            tag.delete()
+            Tag.objects.filter(repository=image.repository, name=tag).delete()
 
         # Delete a manifest
         elif reference:
             image.delete()
 
+        # Deleting changes what a lookup of the tag or manifest returns
+        forget_image(name, reference, tag)
+        notifier.notify(
+            request,
+            "delete",
+            name,
+            image.version,
+            media_type=image.media_type,
+            tag=tag,
+            user=user,
+        )
+
         # Upon success, the registry MUST respond with a 202 Accepted code.
         return Response(status=202)
 
@@ -173,19 +191,22 @@ class ImageManifest(APIView):
     def put(self, request, *args, **kwargs):
         """
         PUT /v2/<name>/manifests/<reference>
+        PUT /v2/<name>/manifests/<reference>?tag=<tag>&tag=<tag>
         https://github.com/opencontainers/distribution-spec/blob/master/spec.md#pushing-manifests
         """
         # We likely can default to the v1 manifest, unless otherwise specified
-        # This isn't used or checked for the time being
+        # This isn't checked, but is kept if the manifest has no mediaType
         # application/vnd.oci.image.manifest.v1+json
-        _ = request.META.get("CONTENT_TYPE", settings.IMAGE_MANIFEST_CONTENT_TYPE)
+        content_type = request.META.get(
+            "CONTENT_TYPE", settings.IMAGE_MANIFEST_CONTENT_TYPE
+        )
 
         name = kwargs.get("name")
         reference = kwargs.get("reference")
         tag = kwargs.get("tag")
 
         # If allow_continue False, return response
-        allow_continue, response, _ = is_authenticated(
+        allow_continue, response, user = is_authenticated(
             request, name, must_be_owner=True
         )
         if not allow_continue:
@@ -195,17 +216,56 @@ class ImageManifest(APIView):
         if reference and not reference.startswith("sha256:"):
             return Response(status=400)
 
-        # Also provide the body in case we have a tag
-        image = get_image_by_tag(name, reference, tag, create=True, body=request.body)
-
-        # If allow_continue False, return response
-        allow_continue, response, _ = is_authenticated(
-            request, image.repository, must_be_owner=True
-        )
-        if not allow_continue:
-            return response
+        # A manifest pushed by digest can be given any number of tags
+        # A tag repeated is only applied once (an upsert can't touch a row twice)
+        tags = list(dict.fromkeys(request.GET.getlist("tag")))
+        if any(not TAG_REGEX.match(x) for x in tags):
+            return Response(status=400)
 
-        return Response(status=201, headers={"Location": image.get_manifest_url()})
+        # The push is recorded for replication in the same transaction
+        digest = reference or "sha256:%s" % calculate_digest(request.body)
+        pushed = list(dict.fromkeys(x for x in [tag] + tags if x))
+        with replicated(name, "manifest", digest, pushed):
+
+            # Also provide the body in case we have a tag
+            image = get_image_by_tag(
+                name,
+                reference,
+                tag,
+                create=True,
+                body=request.body,
+                media_type=content_type,
+            )
+
+            # If allow_continue False, return response
+            allow_continue, response, _ = is_authenticated(
+                request, image.repository, must_be_owner=True
+            )
+            if not allow_continue:
+                return response
+
+            # The manifest is ingested once, and all tags applied in one statement
+            headers = {"Location": image.get_manifest_url()}
+            if tags:
+                set_tags(image, tags)
+                for tag in tags:
+                    forget_image(name, image.version, tag)
+                headers["OCI-Tag"] = ", ".join(tags)
+
+        # A push is one event per tag, sent in the background
+        for tag in pushed or [None]:
+            notifier.notify(
+                request,
+                "push",
+                name,
+                image.version,
+                media_type=image.media_type,
+                size=len(request.body),
+                tag=tag,
+                url=headers["Location"],
+                user=user,
+            )
+        return Response(status=201, headers=headers)
 
     @method_decorator(never_cache)
     @method_decorator(
@@ -219,23 +279,70 @@ class ImageManifest(APIView):
     def get(self, request, *args, **kwargs):
         """
         GET /v2/<name>/manifests/<reference>
+        GET /v2/<name>/manifests/<reference>?platform=<os>/<architecture>[/<variant>]
         """
 
         name = kwargs.get("name")
         reference = kwargs.get("reference")
         tag = kwargs.get("tag")
-
-        # If allow_continue False, return response
-        allow_continue, response, _ = is_authenticated(request, name, scopes=["pull"])
+        platform = request.GET.get("platform")
+
+        # Anyone can pull from a proxied repository, created on first pull
+        proxied = proxy.is_proxied(name)
+        allow_continue, response, user = is_authenticated(
+            request,
+            name,
+            must_be_owner=not proxied,
+            repository_exists=not proxied,
+            scopes=["pull"],
+        )
         if not allow_continue:
             return response
 
-        image = get_image_by_tag(name, tag=tag, reference=reference)
+        # A proxied manifest is fetched on a miss, or when a tag is stale
+        if proxied:
+            proxy.get_repository(name)
+            image = proxy.get_manifest(name, reference=reference, tag=tag)
+            digest = platform and resolve_platform(name, reference, tag, platform)
+            if digest:
+                image = proxy.get_manifest(name, reference=digest)
+
+        # A manifest kept with the blobs is streamed like one
+        else:
+            digest = platform and resolve_platform(name, reference, tag, platform)
+            if digest:
+                reference, tag = digest, None
+            if settings.MANIFEST_STORAGE == "storage":
+                image = get_image_metadata(name, tag=tag, reference=reference)
+                if image and not image.manifest_key:
+                    image = get_image_by_tag(name, tag=tag, reference=reference)
+
+            # Otherwise the manifest is in its row, and read in one query
+            else:
+                image = get_image_by_tag(name, tag=tag, reference=reference)
 
         # If the manifest is not found in the registry, the response code MUST be 404 Not Found.
         if not image:
             raise Http404
-        return Response(image.manifest, status=200)
+        pull_counter.record(image.repository_id, image.version)
+        notifier.notify(
+            request,
+            "pull",
+            name,
+            image.version,
+            media_type=image.media_type,
+            size=image.size,
+            tag=tag,
+            user=user,
+        )
+        if image.manifest_key:
+            return storage.download_manifest(image)
+        return Response(
+            image.manifest,
+            status=200,
+            headers={"Docker-Content-Digest": image.version},
+            content_type=image.media_type,
+        )
 
     @method_decorator(never_cache)
     @method_decorator(
@@ -249,16 +356,55 @@ class ImageManifest(APIView):
     def head(self, request, *args, **kwargs):
         """
         HEAD /v2/<name>/manifests/<reference>
+        HEAD /v2/<name>/manifests/<reference>?platform=<os>/<architecture>[/<variant>]
         """
         name = kwargs.get("name")
         reference = kwargs.get("reference")
         tag = kwargs.get("tag")
+        platform = request.GET.get("platform")
 
-        allow_continue, response, _ = is_authenticated(request, name)
+        # A proxied repository is checked like a pull
+        proxied = proxy.is_proxied(name)
+        allow_continue, response, _ = is_authenticated(
+            request,
+            name,
+            must_be_owner=not proxied,
+            repository_exists=not proxied,
+            scopes=["pull"] if proxied else None,
+        )
         if not allow_continue:
             return response
 
-        image = get_image_by_tag(name, tag=tag, reference=reference)
+        # A proxied manifest is fetched on a miss, or when a tag is stale
+        if proxied:
+            proxy.get_repository(name)
+            image = proxy.get_manifest(name, reference=reference, tag=tag)
+            digest = platform and resolve_platform(name, reference, tag, platform)
+            if digest:
+                image = proxy.get_manifest(name, reference=digest)
+
+        # Otherwise only the columns that describe the manifest are read
+        else:
+            digest = platform and resolve_platform(name, reference, tag, platform)
+            if digest:
+                reference, tag = digest, None
+            image = get_image_metadata(name, tag=tag, reference=reference)
         if not image:
             raise Http404
-        return Response(status=200)
+
+        # Manifests pushed before sizes were recorded need to be read
+        size = image.size
+        if size is None:
+            image = get_image_by_tag(name, tag=None, reference=image.version)
+            size = len(image.get_manifest())
+
+        # A Response without data drops the Content-Type, so we use HttpResponse
+        headers = {
+            "Docker-Content-Digest": image.version,
+            "Content-Length": size,
+        }
+        return HttpResponse(
+            status=200,
+            headers=headers,
+            content_type=image.media_type or settings.IMAGE_MANIFEST_CONTENT_TYPE,
+        )
@@ -16,6 +16,11 @@ setup
 python manage.py test tests.test_api
 cleanup
 
+# In-process tests (no running server required)
+setup
+python manage.py test tests.test_proxy tests.test_singleflight tests.test_uploads tests.test_manifests tests.test_bloom tests.test_concurrency tests.test_sharding tests.test_tiers tests.test_stats tests.test_retention tests.test_usage tests.test_scrub tests.test_import tests.test_export tests.test_replication tests.test_notifications tests.test_replicas
+cleanup
+
 # Test conformance without authentication
 setup
 DISABLE_AUTHENTICATION=yes python manage.py test tests.test_conformance
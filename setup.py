@@ -35,9 +35,17 @@ setup(
     url="https://github.com/vsoch/django-oci",
     packages=[
         "django_oci",
+        "django_oci.management",
+        "django_oci.management.commands",
     ],
     include_package_data=True,
-    install_requires=["djangorestframework", "pyjwt", "django-ratelimit==3.0.0"],
+    install_requires=[
+        "django>=4.1",
+        "djangorestframework",
+        "pyjwt",
+        "django-ratelimit==3.0.0",
+        "requests",
+    ],
     license="Apache Software License 2.0",
     zip_safe=False,
     keywords="django-oci",
@@ -0,0 +1,67 @@
+"""
+test_django-oci helpers
+-----------------------
+
+Helpers shared by the `django-oci` tests.
+"""
+
+import hashlib
+from unittest import mock
+
+from django.urls import reverse
+
+from django_oci import settings
+
+MEDIA_TYPE = "application/vnd.oci.image.manifest.v1+json"
+INDEX_MEDIA_TYPE = "application/vnd.oci.image.index.v1+json"
+
+
+def calculate_digest(blob):
+    return "sha256:%s" % hashlib.sha256(blob).hexdigest()
+
+
+class RegistryTestMixin:
+    """A mixin for registry test cases, which runs each test with authentication
+    disabled (and any other patches from start_patches), and pushes blobs and
+    manifests to the repository named by self.repository.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.start_patches(mock.patch.object(settings, "DISABLE_AUTHENTICATION", True))
+
+    def start_patches(self, *patches):
+        """Start patches that are stopped when the test ends"""
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def push_blob(self, data, name=None):
+        """Push a blob monolithically, returning the response"""
+        url = reverse(
+            "django_oci:blob_upload", kwargs={"name": name or self.repository}
+        )
+        return self.client.post(
+            "%s?digest=%s" % (url, calculate_digest(data)),
+            data=data,
+            content_type="application/octet-stream",
+        )
+
+    def push_manifest(self, manifest, tag, name=None, media_type=MEDIA_TYPE):
+        """Push a manifest to a tag, returning the response"""
+        url = reverse(
+            "django_oci:image_manifest",
+            kwargs={"name": name or self.repository, "tag": tag},
+        )
+        return self.client.put(url, data=manifest, content_type=media_type)
+
+    def push_image(self, manifest, blobs, tag="1.0", name=None):
+        """Push the blobs of an image and then its manifest, checking each is
+        created, and return the response for the manifest.
+        """
+        for data in blobs:
+            response = self.push_blob(data, name=name)
+            self.assertEqual(response.status_code, 201)
+        response = self.push_manifest(manifest, tag, name=name)
+        self.assertEqual(response.status_code, 201)
+        return response
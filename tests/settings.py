@@ -41,6 +41,7 @@ MIDDLEWARE = [
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    "django_oci.middleware.ReplicaMiddleware",
 ]
 
 ROOT_URLCONF = "tests.urls"
@@ -73,9 +74,24 @@ DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": os.path.join(BASE_DIR, "db-test.sqlite3"),
-    }
+        # A file (and not in memory) so concurrent tests wait on each other's writes
+        "TEST": {"NAME": os.path.join(BASE_DIR, "db-test-run.sqlite3")},
+        "OPTIONS": {"timeout": 30},
+    },
+    # A replica of the primary, for tests of the replica router
+    "replica": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": os.path.join(BASE_DIR, "db-test.sqlite3"),
+        "TEST": {"MIRROR": "default"},
+        "OPTIONS": {"timeout": 30},
+    },
 }
 
+DATABASE_ROUTERS = ["django_oci.routers.ReplicaRouter"]
+
+# The suite makes more requests from one address than a day's view rate limit
+RATELIMIT_ENABLE = False
+
 # Django OCI Example (with defaults_
 
 DJANGO_OCI = {
@@ -89,6 +105,8 @@ DJANGO_OCI = {
     "DISABLE_AUTHENTICATION": os.environ.get("DISABLE_AUTHENTICATION") is not None,
     # "secret" for jwt decoding, hard coded for tests here. Likely you'd want to set in enviroment
     "JWT_SERVER_SECRET": "c4978944-8ea4-41f2-ac55-e38dcc09cff4'",
+    # Pulls are only counted by the tests for them, which reset the counts
+    "PULL_STATS_FLUSH_SECONDS": None,
 }
 
 # Password validation
@@ -0,0 +1,129 @@
+"""
+test_django-oci bloom
+---------------------
+
+Tests for `django-oci` blob existence checks that skip the database.
+"""
+
+from unittest import mock
+
+from django.db import connection
+from django.middleware import cache
+from django.test import SimpleTestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from django_oci import settings
+from django_oci.bloom import BlobFilter, BloomFilter
+from django_oci.models import Blob, Repository
+from django_oci.storage import storage
+from tests.helpers import RegistryTestMixin
+
+
+class BloomFilterTests(SimpleTestCase):
+    def test_membership(self):
+        """
+        Added items are always found, and most others are not
+        """
+        bloom = BloomFilter(1000)
+        items = ["sha256:%064x" % i for i in range(1000)]
+        for item in items:
+            bloom.add(item)
+        self.assertTrue(all(item in bloom for item in items))
+
+        others = ["sha256:%064x" % i for i in range(1000, 11000)]
+        false_positives = len([x for x in others if x in bloom])
+        self.assertLess(false_positives, 300)
+
+
+class BlobFilterTests(RegistryTestMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.repository = Repository.objects.create(name="vanessa/filter")
+        self.digest = "sha256:%064x" % 1
+        self.start_patches(
+            mock.patch("django_oci.storage.blob_filter", BlobFilter()),
+        )
+        cache.caches["django_oci_upload"].clear()
+
+    def get_url(self, digest):
+        return reverse(
+            "django_oci:blob_download",
+            kwargs={"name": self.repository.name, "digest": digest},
+        )
+
+    def test_missing_blob_skips_database(self):
+        """
+        A HEAD for a blob that doesn't exist is answered without a blob query
+        """
+        self.client.head(self.get_url("sha256:%064x" % 2))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.head(self.get_url(self.digest))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        for query in queries.captured_queries:
+            self.assertNotIn("django_oci_blob", query["sql"])
+
+    def test_blob_from_another_process(self):
+        """
+        A blob added elsewhere is found after the shared version changes
+        """
+        response = self.client.head(self.get_url(self.digest))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        # Another process finishes the blob, and forgets its lookups
+        Blob.objects.create(
+            repository=self.repository,
+            digest=self.digest,
+            content_type=settings.DEFAULT_CONTENT_TYPE,
+            size=0,
+        )
+        filecache = cache.caches["django_oci_upload"]
+        for mounted in [True, False]:
+            filecache.delete(
+                storage.get_missing_key(self.repository.name, self.digest, mounted)
+            )
+        BlobFilter().changed()
+
+        response = self.client.head(self.get_url(self.digest))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_negative_cache(self):
+        """
+        A miss that passes the filter is remembered until the blob is finished
+        """
+        with mock.patch.object(settings, "BLOB_FILTER_CAPACITY", 0):
+            response = self.client.head(self.get_url(self.digest))
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+            Blob.objects.create(
+                repository=self.repository,
+                digest=self.digest,
+                content_type=settings.DEFAULT_CONTENT_TYPE,
+                size=0,
+            )
+            response = self.client.head(self.get_url(self.digest))
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+            storage.forget_blob(self.repository.name, self.digest, added=True)
+            response = self.client.head(self.get_url(self.digest))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_delete_keeps_filter(self):
+        """
+        Deleting a blob forgets its lookups, without telling other processes
+        to refresh their filters
+        """
+        Blob.objects.create(
+            repository=self.repository,
+            digest=self.digest,
+            content_type=settings.DEFAULT_CONTENT_TYPE,
+            size=0,
+        )
+        with mock.patch.object(BlobFilter, "changed") as changed:
+            response = self.client.delete(self.get_url(self.digest))
+            self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+            response = self.client.head(self.get_url(self.digest))
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        changed.assert_not_called()
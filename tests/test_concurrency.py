@@ -0,0 +1,166 @@
+"""
+test_django-oci concurrency
+---------------------------
+
+Stress tests for `django-oci` concurrent pushes of one digest and one tag.
+"""
+
+import json
+import threading
+import time
+
+from django.db import connection
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient, APITransactionTestCase
+
+from django_oci.models import (
+    Blob,
+    Image,
+    Repository,
+    RepositoryUsage,
+    Tag,
+    UploadClaim,
+)
+from django_oci.storage import storage
+from tests.helpers import MEDIA_TYPE, RegistryTestMixin, calculate_digest
+
+
+class ConcurrentPushTests(RegistryTestMixin, APITransactionTestCase):
+    threads = 8
+    iterations = 5
+
+    # A generous floor for calls per second, far below what contention allows,
+    # that only catches pushes serializing on a lock or timing out
+    min_rate = 1
+
+    def setUp(self):
+        super().setUp()
+        self.repository = Repository.objects.create(name="vanessa/stress")
+        self.layer = b"layer" * 1024
+        self.layer_digest = calculate_digest(self.layer)
+        self.manifest = json.dumps(
+            {
+                "schemaVersion": 2,
+                "config": {},
+                "layers": [{"digest": self.layer_digest, "size": len(self.layer)}],
+            }
+        ).encode("utf-8")
+
+    def hammer(self, func):
+        """Run a function from many threads at once, returning the results
+        (or errors), and check the number of calls per second.
+        """
+        results = []
+        barrier = threading.Barrier(self.threads)
+
+        def run():
+            barrier.wait()
+            for _ in range(self.iterations):
+                try:
+                    results.append(func())
+                except Exception as exc:
+                    results.append(exc)
+            connection.close()
+
+        threads = [threading.Thread(target=run) for _ in range(self.threads)]
+        start = time.time()
+        [thread.start() for thread in threads]
+        [thread.join() for thread in threads]
+        rate = len(results) / (time.time() - start)
+        self.assertGreater(rate, self.min_rate, "%.1f calls per second" % rate)
+        return results
+
+    def assert_one_blob(self):
+        """There is one blob for the layer, and its file holds the layer"""
+        blobs = Blob.objects.filter(repository=self.repository)
+        self.assertEqual(blobs.count(), 1)
+        blob = blobs.first()
+        self.assertEqual(blob.digest, self.layer_digest)
+        self.assertEqual(blob.size, len(self.layer))
+        with open(storage.locate_blob(blob), "rb") as fd:
+            self.assertEqual(fd.read(), self.layer)
+
+    def test_one_digest(self):
+        """
+        Many pushes of one digest all succeed, and leave one blob
+        """
+        results = self.hammer(
+            lambda: storage.create_blob(
+                digest=self.layer_digest,
+                body=self.layer,
+                content_type="application/octet-stream",
+                repository=self.repository,
+            ).status_code
+        )
+        self.assertEqual(
+            results, [status.HTTP_201_CREATED] * self.threads * self.iterations
+        )
+        self.assert_one_blob()
+
+    def test_one_digest_uploaded_once(self):
+        """
+        Many monolithic uploads of one digest read and write the body once,
+        and the others wait for it and leave no claims behind
+        """
+        uploads = []
+
+        def upload():
+            uploads.append(threading.get_ident())
+            return storage.create_blob(
+                digest=self.layer_digest,
+                body=self.layer,
+                content_type="application/octet-stream",
+                repository=self.repository,
+            )
+
+        results = self.hammer(
+            lambda: storage.upload_once(
+                self.repository, self.layer_digest, upload
+            ).status_code
+        )
+        self.assertEqual(
+            results, [status.HTTP_201_CREATED] * self.threads * self.iterations
+        )
+        self.assertEqual(len(uploads), 1)
+        self.assertFalse(UploadClaim.objects.exists())
+        self.assert_one_blob()
+
+    def test_one_tag(self):
+        """
+        Many pushes of one manifest to one tag all succeed, and leave one image
+        that links to its layer
+        """
+        storage.create_blob(
+            digest=self.layer_digest,
+            body=self.layer,
+            content_type="application/octet-stream",
+            repository=self.repository,
+        )
+        url = reverse(
+            "django_oci:image_manifest",
+            kwargs={"name": self.repository.name, "tag": "latest"},
+        )
+
+        def push():
+            response = APIClient().put(url, data=self.manifest, content_type=MEDIA_TYPE)
+            return response.status_code
+
+        results = self.hammer(push)
+        self.assertEqual(
+            results, [status.HTTP_201_CREATED] * self.threads * self.iterations
+        )
+
+        image = Image.objects.get(repository=self.repository)
+        self.assertEqual(image.version, calculate_digest(self.manifest))
+        self.assertEqual(bytes(image.get_manifest()), self.manifest)
+        usage = RepositoryUsage.objects.get(repository=self.repository)
+        self.assertEqual(
+            (usage.manifest_count, usage.manifest_bytes), (1, len(self.manifest))
+        )
+        self.assertEqual(
+            Tag.objects.filter(repository=self.repository, name="latest").count(), 1
+        )
+        self.assertEqual(
+            list(image.blobs.values_list("digest", flat=True)), [self.layer_digest]
+        )
@@ -0,0 +1,173 @@
+"""
+test_django-oci export
+----------------------
+
+Tests for `django-oci` export of repositories as OCI image layouts.
+"""
+
+import io
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+from unittest import mock
+
+from django.core.management import CommandError, call_command
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from django_oci.exporter import ExportError, LayoutExport
+from django_oci.models import Blob, Image, Repository
+from tests.helpers import MEDIA_TYPE, RegistryTestMixin, calculate_digest
+
+
+class ExportTests(RegistryTestMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.repository = "vanessa/export"
+        self.tmpdir = tempfile.mkdtemp()
+
+        # Two tags, with manifests that share a config and a layer
+        self.shared = os.urandom(1000)
+        self.config = b"{}"
+        self.manifests = {}
+        for tag in ["1.0", "2.0"]:
+            layer = os.urandom(100)
+            for data in [self.config, self.shared, layer]:
+                self.push_blob(data)
+            manifest = json.dumps(
+                {
+                    "schemaVersion": 2,
+                    "mediaType": MEDIA_TYPE,
+                    "config": {"digest": calculate_digest(self.config)},
+                    "layers": [
+                        {"digest": calculate_digest(self.shared)},
+                        {"digest": calculate_digest(layer)},
+                    ],
+                }
+            ).encode("utf-8")
+            url = reverse(
+                "django_oci:image_manifest",
+                kwargs={"name": self.repository, "tag": tag},
+            )
+            response = self.client.put(url, data=manifest, content_type=MEDIA_TYPE)
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            self.manifests[tag] = manifest
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def read_index(self, archive):
+        return json.loads(archive.extractfile("index.json").read())
+
+    def test_export_command(self):
+        """
+        A repository is written as an OCI image layout, with each shared blob
+        once, and it can be imported again
+        """
+        output = os.path.join(self.tmpdir, "export.tar")
+        with mock.patch.object(os, "posix_fadvise") as advise:
+            call_command(
+                "export_repository", self.repository, output, stdout=io.StringIO()
+            )
+        self.assertEqual(advise.call_count, 4)
+
+        with tarfile.open(output) as archive:
+            names = archive.getnames()
+            index = self.read_index(archive)
+            archive.extractall(os.path.join(self.tmpdir, "layout"))
+        self.assertEqual(names[:2], ["oci-layout", "index.json"])
+        self.assertEqual(len(names), len(set(names)))
+        self.assertIn(
+            "blobs/sha256/%s" % calculate_digest(self.shared).split(":")[1], names
+        )
+        self.assertEqual(len(names), 2 + 4 + 2)
+        self.assertEqual(
+            [
+                x["annotations"]["org.opencontainers.image.ref.name"]
+                for x in index["manifests"]
+            ],
+            ["1.0", "2.0"],
+        )
+
+        call_command(
+            "import_registry",
+            os.path.join(self.tmpdir, "layout"),
+            "--repository",
+            "vanessa/imported",
+            stdout=io.StringIO(),
+        )
+        image = Image.objects.get(repository__name="vanessa/imported", tag__name="2.0")
+        self.assertEqual(bytes(image.get_manifest()), self.manifests["2.0"])
+        self.assertEqual(image.blobs.count(), 3)
+
+    def test_export_endpoint(self):
+        """
+        The export endpoint streams the manifests of the tags asked for
+        """
+        url = reverse("django_oci:repository_export", kwargs={"name": self.repository})
+        response = self.client.get(url, {"tag": "1.0"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Type"], "application/x-tar")
+        data = b"".join(response.streaming_content)
+        self.assertEqual(len(data) % tarfile.RECORDSIZE, 0)
+
+        with tarfile.open(fileobj=io.BytesIO(data)) as archive:
+            index = self.read_index(archive)
+            manifest = archive.extractfile(
+                "blobs/sha256/%s"
+                % calculate_digest(self.manifests["1.0"]).split(":")[1]
+            ).read()
+            self.assertEqual(len(archive.getnames()), 2 + 3 + 1)
+        self.assertEqual(manifest, self.manifests["1.0"])
+        self.assertEqual(
+            [x["digest"] for x in index["manifests"]],
+            [calculate_digest(self.manifests["1.0"])],
+        )
+
+        # A manifest pushed before sizes were recorded is described by its length
+        Image.objects.update(size=None)
+        response = self.client.get(url, {"tag": "1.0"})
+        data = b"".join(response.streaming_content)
+        with tarfile.open(fileobj=io.BytesIO(data)) as archive:
+            index = self.read_index(archive)
+        self.assertEqual(index["manifests"][0]["size"], len(self.manifests["1.0"]))
+
+        response = self.client.get(url, {"tag": "missing"})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_export_fails_without_every_blob(self):
+        """
+        A quarantined or missing blob fails the export, and is never skipped
+        """
+        url = reverse("django_oci:repository_export", kwargs={"name": self.repository})
+        blob = Blob.objects.get(digest=calculate_digest(self.shared))
+        Blob.objects.filter(pk=blob.pk).update(quarantine_date=timezone.now())
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertIn(blob.digest, response.json()["message"])
+
+        Blob.objects.filter(pk=blob.pk).update(quarantine_date=None)
+        os.remove(blob.datafile.name)
+        output = os.path.join(self.tmpdir, "export.tar")
+        with self.assertRaises(CommandError):
+            call_command(
+                "export_repository", self.repository, output, stdout=io.StringIO()
+            )
+        self.assertFalse(os.path.exists(output))
+
+    def test_export_aborts_when_a_blob_goes_missing(self):
+        """
+        A blob removed once the export has started aborts the stream
+        """
+        repository = Repository.objects.get(name=self.repository)
+        export = LayoutExport(repository, read_ahead=0).plan()
+        stream = export.stream()
+        next(stream)
+        for path in export.paths:
+            os.remove(path)
+        with self.assertRaises(ExportError):
+            list(stream)
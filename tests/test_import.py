@@ -0,0 +1,170 @@
+"""
+test_django-oci import
+----------------------
+
+Tests for `django-oci` bulk import of OCI image layouts and registry trees.
+"""
+
+import io
+import json
+import os
+import shutil
+import tempfile
+
+from django.core.management import call_command
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from django_oci.models import Blob, Image, RepositoryUsage, Tag
+from tests.helpers import MEDIA_TYPE, RegistryTestMixin, calculate_digest
+
+
+class ImportTests(RegistryTestMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.config = b"{}"
+        self.layer = os.urandom(1000)
+        self.manifest = json.dumps(
+            {
+                "schemaVersion": 2,
+                "mediaType": MEDIA_TYPE,
+                "config": {"digest": calculate_digest(self.config)},
+                "layers": [{"digest": calculate_digest(self.layer)}],
+                "annotations": {"org.opencontainers.image.title": "imported"},
+            }
+        ).encode("utf-8")
+        self.digest = calculate_digest(self.manifest)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as fd:
+            fd.write(data)
+
+    def write_layout(self):
+        """Write an OCI image layout with one tagged manifest"""
+        for data in [self.config, self.layer, self.manifest]:
+            path = os.path.join(
+                self.tmpdir, "blobs", *calculate_digest(data).split(":")
+            )
+            self.write(path, data)
+        self.write(
+            os.path.join(self.tmpdir, "oci-layout"), b'{"imageLayoutVersion": "1.0.0"}'
+        )
+        index = {
+            "schemaVersion": 2,
+            "manifests": [
+                {
+                    "mediaType": MEDIA_TYPE,
+                    "digest": self.digest,
+                    "size": len(self.manifest),
+                    "annotations": {"org.opencontainers.image.ref.name": "1.0"},
+                }
+            ],
+        }
+        self.write(
+            os.path.join(self.tmpdir, "index.json"), json.dumps(index).encode("utf-8")
+        )
+
+    def write_registry(self):
+        """Write a registry v2 tree with the manifest tagged in a nested repository"""
+        root = os.path.join(self.tmpdir, "docker", "registry", "v2")
+        for data in [self.config, self.layer, self.manifest]:
+            hexdigest = calculate_digest(data).split(":")[1]
+            self.write(
+                os.path.join(root, "blobs", "sha256", hexdigest[:2], hexdigest, "data"),
+                data,
+            )
+        repository = os.path.join(root, "repositories", "library", "imported")
+        hexdigest = self.digest.split(":")[1]
+        link = self.digest.encode("utf-8")
+        self.write(
+            os.path.join(
+                repository, "_manifests", "revisions", "sha256", hexdigest, "link"
+            ),
+            link,
+        )
+        self.write(
+            os.path.join(repository, "_manifests", "tags", "1.0", "current", "link"),
+            link,
+        )
+        for data in [self.config, self.layer]:
+            hexdigest = calculate_digest(data).split(":")[1]
+            self.write(
+                os.path.join(repository, "_layers", "sha256", hexdigest, "link"),
+                calculate_digest(data).encode("utf-8"),
+            )
+
+    def assert_imported(self, name):
+        image = Image.objects.get(repository__name=name, version=self.digest)
+        self.assertEqual(image.blobs.count(), 2)
+        self.assertEqual(
+            list(image.annotation_set.values_list("value", flat=True)), ["imported"]
+        )
+        self.assertEqual(
+            Tag.objects.get(repository__name=name, name="1.0").image, image
+        )
+        usage = RepositoryUsage.objects.get(repository__name=name)
+        self.assertEqual((usage.blob_count, usage.manifest_count), (2, 1))
+
+        url = reverse("django_oci:image_manifest", kwargs={"name": name, "tag": "1.0"})
+        response = self.client.get(url, HTTP_ACCEPT=MEDIA_TYPE)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.content, self.manifest)
+
+        url = reverse(
+            "django_oci:blob_download",
+            kwargs={"name": name, "digest": calculate_digest(self.layer)},
+        )
+        self.assertEqual(self.client.get(url).getvalue(), self.layer)
+
+    def test_import_oci_layout(self):
+        """
+        An OCI image layout is imported as a repository, and importing it
+        again changes nothing
+        """
+        self.write_layout()
+        out = io.StringIO()
+        call_command(
+            "import_registry", self.tmpdir, "--repository", "vanessa/layout", stdout=out
+        )
+        self.assertIn(
+            "Imported vanessa/layout: 2 blobs, 1 manifests, 1 tags, 0 failed",
+            out.getvalue(),
+        )
+        self.assert_imported("vanessa/layout")
+
+        # Blobs are linked into storage, not copied
+        blob = Blob.objects.get(digest=calculate_digest(self.layer))
+        self.assertEqual(os.stat(blob.datafile.name).st_nlink, 2)
+
+        out = io.StringIO()
+        call_command(
+            "import_registry", self.tmpdir, "--repository", "vanessa/layout", stdout=out
+        )
+        self.assertIn("0 blobs, 0 manifests, 1 tags, 0 failed", out.getvalue())
+
+    def test_import_registry_tree(self):
+        """
+        A registry tree is imported with the names of its repositories, and a
+        blob that doesn't match its digest is skipped
+        """
+        self.write_registry()
+        hexdigest = calculate_digest(self.layer).split(":")[1]
+        path = os.path.join(
+            self.tmpdir, "docker", "registry", "v2", "blobs", "sha256", hexdigest[:2]
+        )
+        self.write(os.path.join(path, hexdigest, "data"), b"corrupt")
+
+        out = io.StringIO()
+        call_command("import_registry", self.tmpdir, stdout=out)
+        self.assertIn("1 blobs, 1 manifests, 1 tags, 1 failed", out.getvalue())
+
+        # The blob is imported when it is fixed
+        self.write(os.path.join(path, hexdigest, "data"), self.layer)
+        call_command("import_registry", self.tmpdir, stdout=io.StringIO())
+        self.assert_imported("library/imported")
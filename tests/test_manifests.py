@@ -0,0 +1,367 @@
+"""
+test_django-oci manifests
+-------------------------
+
+Tests for `django-oci` manifest pushes and lookups.
+"""
+
+import io
+import json
+import os
+from unittest import mock
+
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from django_oci import settings
+from django_oci.models import Image, Tag, resolve_platform, set_tags
+from tests.helpers import (
+    INDEX_MEDIA_TYPE,
+    MEDIA_TYPE,
+    RegistryTestMixin,
+    calculate_digest,
+)
+
+
+class ImageManifestTests(RegistryTestMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.repository = "vanessa/manifests"
+        self.manifest = json.dumps(
+            {"schemaVersion": 2, "config": {}, "layers": []}
+        ).encode("utf-8")
+        self.digest = calculate_digest(self.manifest)
+
+    def get_url(self, tag="latest"):
+        return reverse(
+            "django_oci:image_manifest", kwargs={"name": self.repository, "tag": tag}
+        )
+
+    def push(self):
+        url = reverse("django_oci:blob_upload", kwargs={"name": self.repository})
+        self.client.post(url, content_type="application/octet-stream")
+        response = self.push_manifest(self.manifest, "latest")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_manifest_metadata(self):
+        """
+        A pushed manifest records its media type and size
+        """
+        self.push()
+        image = Image.objects.get(repository__name=self.repository)
+        self.assertEqual(image.size, len(self.manifest))
+        self.assertEqual(image.media_type, MEDIA_TYPE)
+
+        response = self.client.get(self.get_url(), HTTP_ACCEPT=MEDIA_TYPE)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(bytes(response.content), self.manifest)
+        self.assertEqual(response.headers["Docker-Content-Digest"], self.digest)
+
+    def test_head_does_not_read_manifest(self):
+        """
+        HEAD returns the digest, media type and size without reading the manifest
+        """
+        self.push()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.head(self.get_url(), HTTP_ACCEPT=MEDIA_TYPE)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.headers["Docker-Content-Digest"], self.digest)
+        self.assertEqual(response.headers["Content-Type"], MEDIA_TYPE)
+        self.assertEqual(response.headers["Content-Length"], str(len(self.manifest)))
+        for query in queries.captured_queries:
+            self.assertNotIn('"manifest"', query["sql"])
+
+        response = self.client.head(self.get_url("missing"), HTTP_ACCEPT=MEDIA_TYPE)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_manifest_storage(self):
+        """
+        With a MANIFEST_STORAGE of "storage", manifests are kept with the blobs
+        """
+        with mock.patch.object(settings, "MANIFEST_STORAGE", "storage"):
+            self.push()
+        image = Image.objects.get(repository__name=self.repository)
+        self.assertEqual(bytes(image.manifest), b"")
+        self.assertEqual(image.manifest_key, ".manifests/%s" % self.digest)
+        self.assertEqual(image.get_manifest(), self.manifest)
+
+        response = self.client.get(self.get_url(), HTTP_ACCEPT=MEDIA_TYPE)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.getvalue(), self.manifest)
+        self.assertEqual(response.headers["Content-Type"], MEDIA_TYPE)
+        self.assertEqual(response.headers["Docker-Content-Digest"], self.digest)
+
+        response = self.client.head(self.get_url(), HTTP_ACCEPT=MEDIA_TYPE)
+        self.assertEqual(response.headers["Content-Length"], str(len(self.manifest)))
+
+        # The file is shared by digest, and deleted with the last image
+        path = os.path.join(settings.MEDIA_ROOT, "blobs", image.manifest_key)
+        with mock.patch.object(settings, "MANIFEST_STORAGE", "storage"):
+            self.repository = "vanessa/manifests-copy"
+            self.push()
+        url = reverse(
+            "django_oci:image_manifest",
+            kwargs={"name": "vanessa/manifests", "reference": self.digest},
+        )
+        self.assertEqual(self.client.delete(url).status_code, status.HTTP_202_ACCEPTED)
+        self.assertTrue(os.path.exists(path))
+        url = reverse(
+            "django_oci:image_manifest",
+            kwargs={"name": self.repository, "reference": self.digest},
+        )
+        self.assertEqual(self.client.delete(url).status_code, status.HTTP_202_ACCEPTED)
+        self.assertFalse(os.path.exists(path))
+
+    def test_get_reads_manifest_once(self):
+        """
+        With manifests in the database, a GET reads the image in one query
+        """
+        self.push()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.get_url(), HTTP_ACCEPT=MEDIA_TYPE)
+        self.assertEqual(bytes(response.content), self.manifest)
+        images = [
+            x for x in queries.captured_queries if '"django_oci_image"' in x["sql"]
+        ]
+        self.assertEqual(len(images), 1)
+
+    def test_store_manifests(self):
+        """
+        Manifests kept in the database can be moved to storage
+        """
+        self.push()
+        call_command("store_manifests", stdout=io.StringIO())
+        image = Image.objects.get(repository__name=self.repository)
+        self.assertEqual(image.manifest_key, ".manifests/%s" % self.digest)
+        response = self.client.get(self.get_url(), HTTP_ACCEPT=MEDIA_TYPE)
+        self.assertEqual(response.getvalue(), self.manifest)
+
+    def test_tag_moves(self):
+        """
+        Pushing a new manifest to a tag moves it, and the tag resolves in one query
+        """
+        self.push()
+        manifest = json.dumps(
+            {"schemaVersion": 2, "config": {}, "layers": [], "version": 2}
+        ).encode("utf-8")
+        response = self.client.put(
+            self.get_url(), data=manifest, content_type=MEDIA_TYPE
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        tag = Tag.objects.get(repository__name=self.repository, name="latest")
+        self.assertEqual(tag.digest, calculate_digest(manifest))
+        self.assertEqual(tag.image.version, calculate_digest(manifest))
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.head(self.get_url(), HTTP_ACCEPT=MEDIA_TYPE)
+        self.assertEqual(
+            response.headers["Docker-Content-Digest"], calculate_digest(manifest)
+        )
+        self.assertEqual(len(queries.captured_queries), 1)
+
+    def test_upsert_without_conflict_target(self):
+        """
+        Databases that can't name the conflict of an upsert (e.g., MySQL) update
+        each row, or else insert it
+        """
+        with mock.patch.object(
+            connection.features, "supports_update_conflicts_with_target", False
+        ):
+            self.push()
+            self.push()
+            manifest = json.dumps(
+                {"schemaVersion": 2, "config": {}, "layers": [], "version": 2}
+            ).encode("utf-8")
+            response = self.client.put(
+                self.get_url(), data=manifest, content_type=MEDIA_TYPE
+            )
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        self.assertEqual(Image.objects.count(), 2)
+        tag = Tag.objects.get(repository__name=self.repository, name="latest")
+        self.assertEqual(tag.digest, calculate_digest(manifest))
+        self.assertEqual(tag.image.version, calculate_digest(manifest))
+
+    def test_tags_list_pagination(self):
+        """
+        Tags are listed in lexical order, after last and up to n
+        """
+        self.push()
+        for tag in ["c", "a", "d", "b"]:
+            response = self.client.put(
+                self.get_url(tag), data=self.manifest, content_type=MEDIA_TYPE
+            )
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        url = reverse("django_oci:image_tags", kwargs={"name": self.repository})
+        response = self.client.get(url)
+        self.assertEqual(response.json()["tags"], ["a", "b", "c", "d", "latest"])
+        response = self.client.get(url, {"n": 2})
+        self.assertEqual(response.json()["tags"], ["a", "b"])
+        response = self.client.get(url, {"n": 2, "last": "b"})
+        self.assertEqual(response.json()["tags"], ["c", "d"])
+        response = self.client.get(url, {"last": "c"})
+        self.assertEqual(response.json()["tags"], ["d", "latest"])
+
+    def test_push_multiple_tags(self):
+        """
+        A manifest pushed by digest with several tags is ingested once
+        """
+        self.push()
+        url = reverse(
+            "django_oci:image_manifest",
+            kwargs={"name": self.repository, "reference": self.digest},
+        )
+        tags = ["1.2.3", "1.2", "1", "latest"]
+        with mock.patch.object(Image, "update_manifest") as update_manifest:
+            response = self.client.put(
+                "%s?%s" % (url, "&".join("tag=%s" % x for x in tags)),
+                data=self.manifest,
+                content_type=MEDIA_TYPE,
+            )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.headers["OCI-Tag"], ", ".join(tags))
+        self.assertFalse(update_manifest.called)
+
+        tags_url = reverse("django_oci:image_tags", kwargs={"name": self.repository})
+        response = self.client.get(tags_url)
+        self.assertEqual(response.json()["tags"], sorted(tags))
+        for tag in tags:
+            response = self.client.head(self.get_url(tag), HTTP_ACCEPT=MEDIA_TYPE)
+            self.assertEqual(response.headers["Docker-Content-Digest"], self.digest)
+
+        response = self.client.put(
+            "%s?tag=.invalid" % url, data=self.manifest, content_type=MEDIA_TYPE
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_first_push_with_repeated_tags(self):
+        """
+        A first push by digest applies each of several (repeated) tags once
+        """
+        url = reverse("django_oci:blob_upload", kwargs={"name": self.repository})
+        self.client.post(url, content_type="application/octet-stream")
+        url = reverse(
+            "django_oci:image_manifest",
+            kwargs={"name": self.repository, "reference": self.digest},
+        )
+        tags = ["1.0", "latest", "1.0", "1", "latest"]
+        with mock.patch(
+            "django_oci.views.image.set_tags", wraps=set_tags
+        ) as patched_set_tags:
+            response = self.client.put(
+                "%s?%s" % (url, "&".join("tag=%s" % x for x in tags)),
+                data=self.manifest,
+                content_type=MEDIA_TYPE,
+            )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.headers["OCI-Tag"], "1.0, latest, 1")
+        self.assertEqual(patched_set_tags.call_args[0][1], ["1.0", "latest", "1"])
+
+        image = Image.objects.get(repository__name=self.repository)
+        self.assertEqual(image.version, self.digest)
+        self.assertEqual(
+            sorted(Tag.objects.filter(image=image).values_list("name", flat=True)),
+            ["1", "1.0", "latest"],
+        )
+        for tag in ["1.0", "latest", "1"]:
+            response = self.client.get(self.get_url(tag), HTTP_ACCEPT=MEDIA_TYPE)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.headers["Docker-Content-Digest"], self.digest)
+
+
+class ImageIndexTests(RegistryTestMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.repository = "vanessa/multiarch"
+
+        # Push a manifest per platform, and an index that lists them
+        url = reverse("django_oci:blob_upload", kwargs={"name": self.repository})
+        self.client.post(url, content_type="application/octet-stream")
+        self.children = {}
+        platforms = []
+        for arch, variant in [("amd64", None), ("arm64", "v8")]:
+            manifest = json.dumps(
+                {"schemaVersion": 2, "config": {}, "layers": [], "arch": arch}
+            ).encode("utf-8")
+            digest = calculate_digest(manifest)
+            self.put(digest, manifest, MEDIA_TYPE, is_digest=True)
+            self.children[arch] = digest
+            platform = {"os": "linux", "architecture": arch}
+            if variant:
+                platform["variant"] = variant
+            platforms.append(
+                {
+                    "mediaType": MEDIA_TYPE,
+                    "digest": digest,
+                    "size": len(manifest),
+                    "platform": platform,
+                }
+            )
+
+        self.index = json.dumps(
+            {"schemaVersion": 2, "mediaType": INDEX_MEDIA_TYPE, "manifests": platforms}
+        ).encode("utf-8")
+        self.put("latest", self.index, INDEX_MEDIA_TYPE)
+
+    def get_url(self, reference, is_digest=False):
+        key = "reference" if is_digest else "tag"
+        return reverse(
+            "django_oci:image_manifest",
+            kwargs={"name": self.repository, key: reference},
+        )
+
+    def put(self, reference, manifest, media_type, is_digest=False):
+        response = self.client.put(
+            self.get_url(reference, is_digest), data=manifest, content_type=media_type
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_child_manifests(self):
+        """
+        Pushing an index records its child manifests and their platforms
+        """
+        index = Image.objects.get(version=calculate_digest(self.index))
+        self.assertEqual(index.media_type, INDEX_MEDIA_TYPE)
+        children = index.childmanifest_set.order_by("architecture")
+        self.assertEqual(
+            [(x.os, x.architecture, x.variant) for x in children],
+            [("linux", "amd64", None), ("linux", "arm64", "v8")],
+        )
+        self.assertEqual(
+            resolve_platform(self.repository, None, "latest", "linux/arm64"),
+            self.children["arm64"],
+        )
+        self.assertIsNone(
+            resolve_platform(self.repository, None, "latest", "linux/s390x")
+        )
+
+    def test_platform_lookup(self):
+        """
+        A GET or HEAD with a platform returns the child manifest for it
+        """
+        for platform, arch in [("linux/amd64", "amd64"), ("linux/arm64/v8", "arm64")]:
+            url = "%s?platform=%s" % (self.get_url("latest"), platform)
+            response = self.client.get(url, HTTP_ACCEPT=MEDIA_TYPE)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(
+                response.headers["Docker-Content-Digest"], self.children[arch]
+            )
+            self.assertEqual(json.loads(bytes(response.content))["arch"], arch)
+
+            response = self.client.head(url, HTTP_ACCEPT=MEDIA_TYPE)
+            self.assertEqual(
+                response.headers["Docker-Content-Digest"], self.children[arch]
+            )
+
+        # Without a match, the index itself is returned
+        url = "%s?platform=linux/s390x" % self.get_url("latest")
+        response = self.client.head(url, HTTP_ACCEPT=MEDIA_TYPE)
+        self.assertEqual(
+            response.headers["Docker-Content-Digest"], calculate_digest(self.index)
+        )
@@ -0,0 +1,186 @@
+"""
+test_django-oci notifications
+-----------------------------
+
+Tests for `django-oci` event notifications, using a local in-process
+endpoint as the receiver.
+"""
+
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from django_oci import settings
+from django_oci.notifications import EVENTS_MEDIA_TYPE
+from tests.helpers import MEDIA_TYPE, RegistryTestMixin, calculate_digest
+
+
+class Receiver(BaseHTTPRequestHandler):
+    """An endpoint stand-in that keeps the batches it receives, and fails
+    the first requests if asked to.
+    """
+
+    batches = []
+    failures = 0
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if Receiver.failures:
+            Receiver.failures -= 1
+            self.send_response(500)
+        else:
+            self.batches.append((self.headers["Content-Type"], json.loads(body)))
+            self.send_response(202)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+class NotificationTests(RegistryTestMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Receiver)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:%s/events" % self.server.server_address[1]
+        Receiver.batches = []
+        Receiver.failures = 0
+
+        self.repository = "vanessa/notified"
+        self.layer = os.urandom(1000)
+        self.manifest = json.dumps(
+            {
+                "schemaVersion": 2,
+                "mediaType": MEDIA_TYPE,
+                "config": {"digest": calculate_digest(self.layer)},
+                "layers": [{"digest": calculate_digest(self.layer)}],
+            }
+        ).encode("utf-8")
+        self.digest = calculate_digest(self.manifest)
+        self.start_patches(
+            mock.patch.object(settings, "NOTIFICATION_RETRY_SECONDS", 0.1),
+        )
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def set_endpoints(self, endpoints, batch_size=100, flush_seconds=0.1):
+        for name, value in [
+            ("NOTIFICATION_ENDPOINTS", endpoints),
+            ("NOTIFICATION_BATCH_SIZE", batch_size),
+            ("NOTIFICATION_FLUSH_SECONDS", flush_seconds),
+        ]:
+            self.start_patches(mock.patch.object(settings, name, value))
+
+    def get_events(self, count):
+        """Wait for count events to be received, and return them"""
+        for _ in range(100):
+            events = [x for _, batch in Receiver.batches for x in batch["events"]]
+            if len(events) >= count:
+                return events
+            time.sleep(0.1)
+        self.fail("Received %s events, expected %s" % (len(events), count))
+
+    def test_events_are_batched(self):
+        """
+        Events are sent in the background, in a batch once it is full
+        """
+        self.set_endpoints({"scanner": self.url}, batch_size=3, flush_seconds=30)
+        self.push_image(self.manifest, [self.layer])
+        url = reverse(
+            "django_oci:image_manifest",
+            kwargs={"name": self.repository, "tag": "1.0"},
+        )
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+        self.assertEqual(Receiver.batches, [])
+        url = reverse(
+            "django_oci:blob_download",
+            kwargs={"name": self.repository, "digest": calculate_digest(self.layer)},
+        )
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        events = self.get_events(3)
+        self.assertEqual(len(Receiver.batches), 1)
+        self.assertEqual(Receiver.batches[0][0], EVENTS_MEDIA_TYPE)
+        self.assertEqual([x["action"] for x in events], ["push", "pull", "pull"])
+        push = events[0]["target"]
+        self.assertEqual(push["repository"], self.repository)
+        self.assertEqual(push["digest"], self.digest)
+        self.assertEqual(push["tag"], "1.0")
+        self.assertEqual(push["size"], len(self.manifest))
+        self.assertTrue(push["url"].endswith("/manifests/%s" % self.digest))
+        self.assertEqual(events[2]["target"]["size"], len(self.layer))
+        self.assertEqual(events[2]["request"]["method"], "GET")
+
+    def test_endpoint_filters(self):
+        """
+        An endpoint is only sent the actions and repositories it asks for
+        """
+        self.set_endpoints(
+            {
+                "deploy": {
+                    "url": self.url,
+                    "actions": ["push", "mount"],
+                    "repositories": "vanessa/*",
+                    "headers": {"Authorization": "Bearer deploy"},
+                }
+            }
+        )
+        self.push_image(self.manifest, [self.layer], name="other/notified")
+        self.push_image(self.manifest, [self.layer])
+        url = reverse("django_oci:blob_upload", kwargs={"name": "vanessa/mounted"})
+        response = self.client.post(
+            "%s?mount=%s&from=%s"
+            % (url, calculate_digest(self.layer), self.repository),
+            content_type="application/octet-stream",
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        url = reverse(
+            "django_oci:image_manifest",
+            kwargs={"name": self.repository, "tag": "1.0"},
+        )
+        self.client.get(url)
+
+        events = self.get_events(2)
+        time.sleep(0.3)
+        self.assertEqual(len(self.get_events(2)), 2)
+        self.assertEqual([x["action"] for x in events], ["push", "mount"])
+        self.assertEqual(events[0]["target"]["repository"], self.repository)
+        self.assertEqual(events[1]["target"]["repository"], "vanessa/mounted")
+        self.assertEqual(events[1]["target"]["fromRepository"], self.repository)
+
+    def test_failed_batches_are_retried(self):
+        """
+        A batch the endpoint fails is sent again, and dropped after the last attempt
+        """
+        self.set_endpoints({"scanner": self.url})
+        Receiver.failures = 2
+        self.push_image(self.manifest, [self.layer])
+        events = self.get_events(1)
+        self.assertEqual(events[0]["action"], "push")
+        self.assertEqual(len(Receiver.batches), 1)
+
+        with mock.patch.object(settings, "NOTIFICATION_MAX_ATTEMPTS", 2):
+            Receiver.failures = 2
+            url = reverse(
+                "django_oci:image_manifest",
+                kwargs={"name": self.repository, "reference": self.digest},
+            )
+            response = self.client.delete(url)
+            self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+            for _ in range(50):
+                if not Receiver.failures:
+                    break
+                time.sleep(0.1)
+            time.sleep(0.3)
+        self.assertEqual(len(Receiver.batches), 1)
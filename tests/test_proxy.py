@@ -0,0 +1,256 @@
+"""
+test_django-oci proxy
+---------------------
+
+Tests for the `django-oci` pull-through cache, using a local in-process
+registry as the upstream.
+"""
+
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from django.middleware import cache
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITransactionTestCase
+
+from django_oci import settings
+from django_oci.files import get_session_dir
+from django_oci.models import Blob, Image, Repository
+from tests.helpers import RegistryTestMixin, calculate_digest
+
+
+class UpstreamRegistry(BaseHTTPRequestHandler):
+    """A registry stand-in that serves manifests and blobs from memory, and
+    counts the requests it receives.
+    """
+
+    manifests = {}
+    blobs = {}
+    hits = {}
+
+    def log_message(self, *args):
+        pass
+
+    def count(self):
+        key = (self.command, self.path)
+        self.hits[key] = self.hits.get(key, 0) + 1
+
+    def do_HEAD(self):
+        self.count()
+        if "/blobs/" in self.path:
+            return self.serve_blob(include_body=False)
+        self.serve_manifest(include_body=False)
+
+    def do_GET(self):
+        self.count()
+        if "/blobs/" in self.path:
+            return self.serve_blob()
+        self.serve_manifest()
+
+    def serve_manifest(self, include_body=True):
+        reference = self.path.rsplit("/", 1)[-1]
+        body = self.manifests.get(reference)
+        if body is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/vnd.oci.image.manifest.v1+json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Docker-Content-Digest", calculate_digest(body))
+        self.end_headers()
+        if include_body:
+            self.wfile.write(body)
+
+    def serve_blob(self, include_body=True):
+        body = self.blobs.get(self.path.rsplit("/", 1)[-1])
+        if body is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if not include_body:
+            return
+
+        # Send slowly so that concurrent requests overlap
+        for start in range(0, len(body), 1024):
+            self.wfile.write(body[start : start + 1024])
+            self.wfile.flush()
+            time.sleep(0.01)
+
+
+class ProxyTests(RegistryTestMixin, APITransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), UpstreamRegistry)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        url = "http://127.0.0.1:%s" % self.server.server_address[1]
+
+        self.layer = b"layer" * 4096
+        self.digest = calculate_digest(self.layer)
+        self.manifest = json.dumps(
+            {
+                "schemaVersion": 2,
+                "config": {"digest": self.digest},
+                "layers": [{"digest": self.digest}],
+            }
+        ).encode("utf-8")
+        UpstreamRegistry.blobs = {self.digest: self.layer}
+        UpstreamRegistry.manifests = {"latest": self.manifest}
+        UpstreamRegistry.hits = {}
+        cache.caches["django_oci_upload"].delete("proxy/library/busybox/latest")
+
+        self.start_patches(
+            mock.patch.object(settings, "PROXY_UPSTREAMS", {"library": url}),
+        )
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def upstream_hits(self, method, path):
+        return UpstreamRegistry.hits.get((method, path), 0)
+
+    def get_blob(self, results=None):
+        url = reverse(
+            "django_oci:blob_download",
+            kwargs={"name": "library/busybox", "digest": self.digest},
+        )
+        response = self.client.get(url)
+        if response.streaming:
+            content = b"".join(response.streaming_content)
+        else:
+            content = response.content
+        if results is not None:
+            results.append((response.status_code, content))
+        return response.status_code, content
+
+    def test_blob_pull_through(self):
+        """
+        A blob miss is streamed from the upstream, and then served locally
+        """
+        code, content = self.get_blob()
+        self.assertEqual(code, status.HTTP_200_OK)
+        self.assertEqual(content, self.layer)
+
+        # Wait for the fetch to be finalized into storage
+        for _ in range(50):
+            if Blob.objects.filter(digest=self.digest).exists():
+                break
+            time.sleep(0.1)
+        self.assertTrue(Blob.objects.filter(digest=self.digest).exists())
+
+        code, content = self.get_blob()
+        self.assertEqual(code, status.HTTP_200_OK)
+        self.assertEqual(content, self.layer)
+        path = "/v2/library/busybox/blobs/%s" % self.digest
+        self.assertEqual(self.upstream_hits("GET", path), 1)
+
+    def test_concurrent_misses_coalesced(self):
+        """
+        Concurrent misses for the same blob share one upstream fetch
+        """
+        results = []
+        threads = [
+            threading.Thread(target=self.get_blob, args=(results,)) for _ in range(5)
+        ]
+        [thread.start() for thread in threads]
+        [thread.join() for thread in threads]
+
+        self.assertEqual(len(results), 5)
+        for code, content in results:
+            self.assertEqual(code, status.HTTP_200_OK)
+            self.assertEqual(content, self.layer)
+        path = "/v2/library/busybox/blobs/%s" % self.digest
+        self.assertEqual(self.upstream_hits("GET", path), 1)
+
+    def test_manifest_ttl(self):
+        """
+        A proxied tag is fetched once, then re-validated when stale
+        """
+        url = reverse(
+            "django_oci:image_manifest",
+            kwargs={"name": "library/busybox", "tag": "latest"},
+        )
+        path = "/v2/library/busybox/manifests/latest"
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(bytes(response.content), self.manifest)
+        self.assertEqual(
+            Image.objects.get(tag__name="latest").version,
+            calculate_digest(self.manifest),
+        )
+
+        # While fresh, the upstream is not asked again
+        self.client.get(url)
+        self.assertEqual(self.upstream_hits("GET", path), 1)
+        self.assertEqual(self.upstream_hits("HEAD", path), 0)
+
+        # Once stale, a HEAD confirms the digest without a second GET
+        cache.caches["django_oci_upload"].delete("proxy/library/busybox/latest")
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.upstream_hits("GET", path), 1)
+        self.assertEqual(self.upstream_hits("HEAD", path), 1)
+
+    def test_head_pull_through(self):
+        """
+        A HEAD on a cold cache is answered by the upstream, without a fetch
+        """
+        url = reverse(
+            "django_oci:blob_download",
+            kwargs={"name": "library/busybox", "digest": self.digest},
+        )
+        response = self.client.head(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Length"], str(len(self.layer)))
+        self.assertEqual(response["Docker-Content-Digest"], self.digest)
+        path = "/v2/library/busybox/blobs/%s" % self.digest
+        self.assertEqual(self.upstream_hits("HEAD", path), 1)
+        self.assertEqual(self.upstream_hits("GET", path), 0)
+
+        url = reverse(
+            "django_oci:image_manifest",
+            kwargs={"name": "library/busybox", "tag": "latest"},
+        )
+        response = self.client.head(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response["Docker-Content-Digest"], calculate_digest(self.manifest)
+        )
+        self.assertEqual(response["Content-Length"], str(len(self.manifest)))
+
+    def test_failed_fetch_removes_session_file(self):
+        """
+        A fetch that fails verification leaves no session file behind
+        """
+        UpstreamRegistry.blobs = {self.digest: b"corrupted" * 1024}
+        self.get_blob()
+
+        session_files = []
+        for _ in range(50):
+            session_files = [
+                x for x in os.listdir(get_session_dir()) if x.startswith("proxy-")
+            ]
+            if not session_files:
+                break
+            time.sleep(0.1)
+        self.assertEqual(session_files, [])
+        self.assertFalse(Blob.objects.filter(digest=self.digest).exists())
+
+    def test_unauthenticated_pull_creates_nothing(self):
+        """
+        A request that fails authentication does not create a repository
+        """
+        with mock.patch.object(settings, "DISABLE_AUTHENTICATION", False):
+            code, _ = self.get_blob()
+        self.assertEqual(code, status.HTTP_401_UNAUTHORIZED)
+        self.assertFalse(Repository.objects.filter(name="library/busybox").exists())
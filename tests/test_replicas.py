@@ -0,0 +1,142 @@
+"""
+test_django-oci replicas
+------------------------
+
+Tests for `django-oci` routing of reads to database replicas, using a
+replica that mirrors the test database.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import time
+from unittest import mock
+
+from django.db import connections
+from django.middleware import cache
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITransactionTestCase
+
+from django_oci import settings, tiers
+from django_oci.middleware import get_pin_key
+from django_oci.models import Image
+from django_oci.routers import ReplicaRouter, reading_from
+from tests.helpers import MEDIA_TYPE, RegistryTestMixin, calculate_digest
+
+
+class ReplicaTests(RegistryTestMixin, APITransactionTestCase):
+    databases = {"default", "replica"}
+
+    def setUp(self):
+        super().setUp()
+        self.repository = "vanessa/replicas"
+        self.layer = os.urandom(1000)
+        self.manifest = json.dumps(
+            {
+                "schemaVersion": 2,
+                "mediaType": MEDIA_TYPE,
+                "config": {"digest": calculate_digest(self.layer)},
+                "layers": [{"digest": calculate_digest(self.layer)}],
+            }
+        ).encode("utf-8")
+        self.start_patches(
+            mock.patch.object(settings, "DATABASE_REPLICAS", ["replica"]),
+            mock.patch.object(settings, "PULL_STATS_FLUSH_SECONDS", None),
+        )
+
+    def tearDown(self):
+        for addr in ["127.0.0.1", "10.0.0.2"]:
+            request = mock.Mock(META={"REMOTE_ADDR": addr})
+            cache.caches["django_oci_upload"].delete(get_pin_key(request))
+
+    def pull(self, **extra):
+        """Pull the manifest and blob, returning the queries on each database"""
+        urls = [
+            reverse(
+                "django_oci:image_manifest",
+                kwargs={"name": self.repository, "reference": self.manifest_digest},
+            ),
+            reverse(
+                "django_oci:blob_download",
+                kwargs={
+                    "name": self.repository,
+                    "digest": calculate_digest(self.layer),
+                },
+            ),
+        ]
+        with CaptureQueriesContext(connections["default"]) as primary:
+            with CaptureQueriesContext(connections["replica"]) as replica:
+                for url in urls:
+                    response = self.client.get(url, **extra)
+                    self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(primary), len(replica)
+
+    @property
+    def manifest_digest(self):
+        return calculate_digest(self.manifest)
+
+    def test_pulls_read_from_replicas(self):
+        """
+        A pull reads from a replica, unless the client just pushed
+        """
+        self.push_image(self.manifest, [self.layer])
+
+        # The client that pushed reads its writes from the primary
+        primary, replica = self.pull()
+        self.assertGreater(primary, 0)
+        self.assertEqual(replica, 0)
+
+        # Another client reads from the replica
+        primary, replica = self.pull(REMOTE_ADDR="10.0.0.2")
+        self.assertEqual(primary, 0)
+        self.assertGreater(replica, 0)
+
+        # As does the client that pushed, once its pin expires
+        with mock.patch.object(settings, "DATABASE_REPLICA_PIN_SECONDS", 0):
+            self.push_image(self.manifest, [self.layer])
+        primary, replica = self.pull()
+        self.assertEqual(primary, 0)
+        self.assertGreater(replica, 0)
+
+    def test_proxied_and_hot_pulls_read_from_replicas(self):
+        """
+        Pulls of a proxied repository, or of blobs in the hot tier, don't pin
+        the client to the primary
+        """
+        self.repository = "library/busybox"
+        self.push_image(self.manifest, [self.layer])
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        with mock.patch.object(
+            settings, "PROXY_UPSTREAMS", {"library": "http://127.0.0.1:9"}
+        ), mock.patch.object(settings, "HOT_STORAGE_ROOT", tmpdir), mock.patch.object(
+            settings, "HOT_STORAGE_PROMOTE_HITS", 1
+        ):
+            for _ in range(3):
+                primary, replica = self.pull(REMOTE_ADDR="10.0.0.2")
+                self.assertEqual(primary, 0)
+                self.assertGreater(replica, 0)
+                for _ in range(50):
+                    if not tiers._promotions:
+                        break
+                    time.sleep(0.05)
+            self.assertTrue(
+                os.path.exists(tiers.get_hot_path(calculate_digest(self.layer)))
+            )
+        tiers.hot_hits.reset()
+
+    def test_router(self):
+        """
+        Reads go to the primary after a write, in a transaction, and outside of a request
+        """
+        router = ReplicaRouter()
+        self.assertIsNone(router.db_for_read(Image))
+        with reading_from("replica"):
+            self.assertEqual(router.db_for_read(Image), "replica")
+            self.assertEqual(router.db_for_write(Image), "default")
+            self.assertIsNone(router.db_for_read(Image))
+        self.assertFalse(router.allow_migrate("replica", "django_oci"))
+        self.assertIsNone(router.allow_migrate("default", "django_oci"))
@@ -0,0 +1,114 @@
+"""
+test_django-oci replication
+---------------------------
+
+Tests for `django-oci` replication of pushes, using the live test server as
+the target registry.
+"""
+
+import io
+import json
+import os
+from unittest import mock
+
+from django.core.management import call_command
+from django.test import LiveServerTestCase
+from django.urls import reverse
+
+from django_oci import settings
+from django_oci.models import Image, ReplicationEvent
+from tests.helpers import MEDIA_TYPE, RegistryTestMixin, calculate_digest
+
+
+class ReplicationTests(RegistryTestMixin, LiveServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.repository = "vanessa/replicated"
+        self.target = {
+            "url": self.live_server_url,
+            "namespace": "replica",
+            "repositories": "vanessa/*",
+        }
+        self.start_patches(
+            mock.patch.object(
+                settings, "REPLICATION_TARGETS", {"replica": self.target}
+            ),
+        )
+
+        self.config = b"{}"
+        self.layer = os.urandom(1000)
+        self.manifest = json.dumps(
+            {
+                "schemaVersion": 2,
+                "mediaType": MEDIA_TYPE,
+                "config": {"digest": calculate_digest(self.config)},
+                "layers": [{"digest": calculate_digest(self.layer)}],
+            }
+        ).encode("utf-8")
+        self.digest = calculate_digest(self.manifest)
+
+    def replicate(self, *args):
+        out = io.StringIO()
+        call_command("replicate", *args, stdout=out)
+        return out.getvalue()
+
+    def test_replication(self):
+        """
+        Pushes are recorded with their events, and replicated with the blobs
+        a manifest needs first
+        """
+        self.push_image(self.manifest, [self.config, self.layer])
+        events = ReplicationEvent.objects.order_by("id")
+        self.assertEqual(
+            list(events.values_list("kind", "tag")),
+            [("blob", None), ("blob", None), ("manifest", "1.0")],
+        )
+
+        # A manifest pushes the blobs it needs, if their events are lost
+        events.filter(kind="blob").delete()
+        self.assertIn("Delivered 1 events, 0 failed", self.replicate())
+        self.assertFalse(ReplicationEvent.objects.exists())
+
+        image = Image.objects.get(repository__name="replica/" + self.repository)
+        self.assertEqual(image.version, self.digest)
+        self.assertEqual(image.tag_set.get().name, "1.0")
+        self.assertEqual(image.blobs.count(), 2)
+
+        # A new tag for the manifest is pushed as a tag
+        url = reverse(
+            "django_oci:image_manifest",
+            kwargs={"name": self.repository, "reference": self.digest},
+        )
+        self.client.put("%s?tag=2.0" % url, data=self.manifest, content_type=MEDIA_TYPE)
+        self.assertIn("Delivered 1 events, 0 failed", self.replicate())
+        self.assertEqual(
+            sorted(image.tag_set.values_list("name", flat=True)), ["1.0", "2.0"]
+        )
+
+        # The replica isn't replicated itself
+        self.assertFalse(ReplicationEvent.objects.exists())
+
+    def test_replication_retries(self):
+        """
+        A failed event is retried later, and given up on after the last attempt
+        """
+        self.target["url"] = "http://127.0.0.1:1"
+        with mock.patch.object(settings, "REPLICATION_MAX_ATTEMPTS", 2):
+            self.push_image(self.manifest, [self.config, self.layer])
+            self.assertIn("Delivered 0 events, 3 failed", self.replicate())
+            event = ReplicationEvent.objects.filter(kind="manifest").get()
+            self.assertEqual(event.attempts, 1)
+            self.assertIsNotNone(event.error)
+            self.assertIsNotNone(event.next_attempt)
+
+            ReplicationEvent.objects.update(next_attempt=event.add_date)
+            self.replicate()
+            self.assertFalse(
+                ReplicationEvent.objects.filter(next_attempt__isnull=False).exists()
+            )
+
+        # Events given up on can be retried
+        self.target["url"] = self.live_server_url
+        output = self.replicate("--retry-failed")
+        self.assertIn("Retrying 3 events", output)
+        self.assertIn("Delivered 3 events, 0 failed", output)
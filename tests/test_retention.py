@@ -0,0 +1,140 @@
+"""
+test_django-oci retention
+-------------------------
+
+Tests for `django-oci` retention rules for tags and manifests.
+"""
+
+import io
+import json
+import os
+from datetime import timedelta
+from unittest import mock
+
+from django.core.management import call_command
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from django_oci import settings
+from django_oci.models import Blob, Image, PullStat, Repository, Tag
+from django_oci.storage import storage
+from tests.helpers import MEDIA_TYPE, RegistryTestMixin, calculate_digest
+
+RULES = [
+    {
+        "repository": "ci/*",
+        "keep_last": 2,
+        "keep_tags": "^release-",
+        "untagged_days": 1,
+        "keep_pulled_days": 7,
+    }
+]
+
+
+class RetentionTests(RegistryTestMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.start_patches(
+            mock.patch.object(settings, "RETENTION_RULES", RULES),
+        )
+
+    def push(self, name, count=6):
+        """Push count manifests tagged t0..tN (oldest first), each with its
+        own layer and a layer they share.
+        """
+        repository = Repository.objects.create(name=name)
+        shared = os.urandom(100)
+        storage.create_blob(
+            calculate_digest(shared), shared, MEDIA_TYPE, repository=repository
+        )
+        self.layers, self.manifests = [], []
+        now = timezone.now()
+        for i in range(count):
+            layer = os.urandom(1000)
+            storage.create_blob(
+                calculate_digest(layer), layer, MEDIA_TYPE, repository=repository
+            )
+            manifest = json.dumps(
+                {
+                    "schemaVersion": 2,
+                    "config": {},
+                    "layers": [
+                        {"digest": calculate_digest(layer)},
+                        {"digest": calculate_digest(shared)},
+                    ],
+                }
+            ).encode("utf-8")
+            url = reverse(
+                "django_oci:image_manifest", kwargs={"name": name, "tag": "t%s" % i}
+            )
+            response = self.client.put(url, data=manifest, content_type=MEDIA_TYPE)
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            Image.objects.filter(version=calculate_digest(manifest)).update(
+                add_date=now - timedelta(days=10 - i)
+            )
+            self.layers.append(calculate_digest(layer))
+            self.manifests.append(calculate_digest(manifest))
+        self.shared = calculate_digest(shared)
+        return repository
+
+    def test_retention_rules(self):
+        """
+        Tags past the last N are deleted unless kept by name or a recent pull,
+        and then old untagged manifests and the blobs only they used
+        """
+        other = self.push("vanessa/app", count=3)
+        repository = self.push("ci/app")
+        image = Image.objects.get(version=self.manifests[0])
+        Tag.objects.create(
+            repository=repository, image=image, digest=image.version, name="release-1"
+        )
+        PullStat.objects.create(
+            repository=repository,
+            digest=self.manifests[1],
+            pulls=1,
+            last_pulled=timezone.now(),
+        )
+
+        size = (
+            sum(Image.objects.get(version=x).size for x in self.manifests[2:4])
+            + 2 * 1000
+        )
+        out = io.StringIO()
+        call_command("apply_retention", "--dry-run", stdout=out)
+        self.assertIn(
+            "Would delete ci/app: 3 tags, 2 manifests, 2 blobs (%s bytes)" % size,
+            out.getvalue(),
+        )
+        self.assertNotIn("vanessa/app", out.getvalue())
+        self.assertEqual(Tag.objects.filter(repository=repository).count(), 7)
+
+        blobs = {
+            x.digest: x.datafile.name
+            for x in Blob.objects.filter(repository=repository)
+        }
+        with mock.patch("builtins.print") as signal_print:
+            call_command("apply_retention", stdout=io.StringIO())
+        self.assertFalse(signal_print.called)
+
+        self.assertEqual(
+            sorted(
+                Tag.objects.filter(repository=repository).values_list("name", flat=True)
+            ),
+            ["release-1", "t1", "t4", "t5"],
+        )
+        remaining = [self.manifests[x] for x in [0, 1, 4, 5]]
+        self.assertEqual(
+            sorted(
+                Image.objects.filter(repository=repository).values_list(
+                    "version", flat=True
+                )
+            ),
+            sorted(remaining),
+        )
+        for digest in self.layers[2:4]:
+            self.assertFalse(Blob.objects.filter(digest=digest).exists())
+            self.assertFalse(os.path.exists(blobs[digest]))
+        self.assertTrue(os.path.exists(blobs[self.shared]))
+        self.assertEqual(Tag.objects.filter(repository=other).count(), 3)
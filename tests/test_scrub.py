@@ -0,0 +1,99 @@
+"""
+test_django-oci scrub
+---------------------
+
+Tests for `django-oci` blob integrity scrubbing.
+"""
+
+import io
+import os
+from unittest import mock
+
+from django.core.management import call_command
+from django.test import SimpleTestCase
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITransactionTestCase
+
+from django_oci import scrub, settings
+from django_oci.models import Blob
+from tests.helpers import RegistryTestMixin, calculate_digest
+
+
+class RateLimiterTests(SimpleTestCase):
+    def test_rate_limit(self):
+        """
+        Reads within the burst don't wait, and reads over it wait the difference
+        """
+        limiter = scrub.RateLimiter(1000)
+        with mock.patch("time.sleep") as sleep:
+            limiter.wait(1000)
+            self.assertEqual(sleep.call_args[0][0], 0)
+            limiter.wait(500)
+            self.assertAlmostEqual(sleep.call_args[0][0], 0.5, places=1)
+
+        # Without a rate, reads never wait
+        with mock.patch("time.sleep") as sleep:
+            scrub.RateLimiter(None).wait(10**9)
+            self.assertFalse(sleep.called)
+
+
+class ScrubTests(RegistryTestMixin, APITransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.repository = "vanessa/scrub"
+        self.good = os.urandom(1000)
+        self.bad = os.urandom(1000)
+        self.push_blob(self.good)
+        self.push_blob(self.bad)
+
+        # Flip a byte of the second blob's file
+        self.blob = Blob.objects.get(digest=calculate_digest(self.bad))
+        with open(self.blob.datafile.name, "r+b") as fd:
+            fd.write(bytes([self.bad[0] ^ 0xFF]))
+
+    def test_scrub_quarantines_corrupt_blobs(self):
+        """
+        A corrupt blob is moved aside and is missing until it is pushed again
+        """
+        out = io.StringIO()
+        call_command("scrub_blobs", "--rate", "0", stdout=out)
+        self.assertIn("Checked 2 blobs, 1 ok, 1 corrupt, 0 missing", out.getvalue())
+        self.assertIn(
+            "Quarantined %s@%s" % (self.repository, self.blob.digest), out.getvalue()
+        )
+
+        blob = Blob.objects.get(pk=self.blob.pk)
+        self.assertIsNotNone(blob.quarantine_date)
+        self.assertFalse(os.path.exists(blob.datafile.name))
+        quarantined = os.listdir(
+            os.path.join(settings.MEDIA_ROOT, "blobs", ".quarantine", self.repository)
+        )
+        self.assertEqual(len(quarantined), 1)
+        self.assertTrue(quarantined[0].startswith(blob.digest))
+
+        url = reverse(
+            "django_oci:blob_download",
+            kwargs={"name": self.repository, "digest": blob.digest},
+        )
+        self.assertEqual(self.client.head(url).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_404_NOT_FOUND)
+
+        # Checked blobs are not checked again until they are due
+        out = io.StringIO()
+        call_command("scrub_blobs", stdout=out)
+        self.assertIn("Checked 0 blobs", out.getvalue())
+
+        # A push of the digest repairs it
+        location = self.push_blob(self.bad)["Location"]
+        self.assertEqual(self.client.get(location).getvalue(), self.bad)
+        self.assertIsNone(Blob.objects.get(pk=self.blob.pk).quarantine_date)
+
+    def test_scrub_dry_run(self):
+        """
+        A dry run reports corrupt blobs, and leaves them be
+        """
+        results = scrub.scrub(dry_run=True)
+        self.assertEqual(results[scrub.CORRUPT], [self.blob])
+        self.assertTrue(os.path.exists(self.blob.datafile.name))
+        self.assertEqual(scrub.get_unverified().count(), 1)
@@ -0,0 +1,156 @@
+"""
+test_django-oci sharding
+------------------------
+
+Tests for `django-oci` blob storage spread over several roots.
+"""
+
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from django.core.management import call_command
+from django.test import SimpleTestCase
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITransactionTestCase
+
+from django_oci.models import Blob
+from django_oci.sharding import HashRing
+from django_oci.storage import storage
+from tests.helpers import RegistryTestMixin, calculate_digest
+
+
+class HashRingTests(SimpleTestCase):
+    def test_adding_a_node_moves_a_fraction(self):
+        """
+        Keys spread over the nodes, and a new node only takes keys for itself
+        """
+        keys = [
+            "sha256:%s" % hashlib.sha256(str(i).encode()).hexdigest()
+            for i in range(5000)
+        ]
+        ring = HashRing(["a", "b", "c", "d"])
+        before = {key: ring.get_node(key) for key in keys}
+        for node in ["a", "b", "c", "d"]:
+            self.assertGreater(list(before.values()).count(node), 500)
+
+        ring = HashRing(["a", "b", "c", "d", "e"])
+        moved = [key for key in keys if ring.get_node(key) != before[key]]
+        self.assertLess(len(moved), len(keys) * 0.3)
+        self.assertTrue(all(ring.get_node(key) == "e" for key in moved))
+
+
+class ShardedStorageTests(RegistryTestMixin, APITransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.repository = "vanessa/sharded"
+        self.tmpdir = tempfile.mkdtemp()
+        self.roots = [os.path.join(self.tmpdir, x) for x in ["a", "b", "c"]]
+        self.start_patches(
+            mock.patch.object(storage, "storage_roots", self.roots[:2]),
+            mock.patch.object(storage, "ring", HashRing(self.roots[:2])),
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_blobs_are_spread_and_rebalanced(self):
+        """
+        Blobs are written under the root their digest hashes to, and move
+        to a new root with rebalance_blobs
+        """
+        blobs = {self.push_blob(os.urandom(1024))["Location"]: None for _ in range(20)}
+        for blob in Blob.objects.all():
+            root = storage.ring.get_node(blob.digest)
+            self.assertEqual(
+                blob.datafile.name, os.path.join(root, self.repository, blob.digest)
+            )
+            self.assertEqual(blob.storage_key, "%s/%s" % (self.repository, blob.digest))
+        self.assertTrue(os.listdir(os.path.join(self.roots[0], self.repository)))
+        self.assertTrue(os.listdir(os.path.join(self.roots[1], self.repository)))
+        for location in blobs:
+            blobs[location] = self.client.get(location).getvalue()
+
+        # A row read before the move still finds the file
+        stale = list(Blob.objects.all())
+        storage.storage_roots = self.roots
+        storage.ring = HashRing(self.roots)
+        out = io.StringIO()
+        call_command("rebalance_blobs", "--dry-run", stdout=out)
+        self.assertIn("Would move", out.getvalue())
+        call_command("rebalance_blobs", stdout=io.StringIO())
+
+        moved = Blob.objects.filter(datafile__startswith=self.roots[2])
+        self.assertTrue(moved.exists())
+        self.assertLess(moved.count(), 20)
+        for blob in Blob.objects.all():
+            self.assertTrue(os.path.exists(blob.datafile.name))
+        for blob in stale:
+            self.assertIsNotNone(storage.locate_blob(blob))
+        for location, data in blobs.items():
+            self.assertEqual(self.client.get(location).getvalue(), data)
+
+        out = io.StringIO()
+        call_command("rebalance_blobs", "--dry-run", stdout=out)
+        self.assertIn("Would move 0 blobs", out.getvalue())
+
+    def test_rebalance_mounted_blobs(self):
+        """
+        A file shared by a mounted blob is moved once, and both rows follow it
+        """
+        # A blob that moves to the root that is added
+        ring = HashRing(self.roots)
+        data = os.urandom(1024)
+        while ring.get_node(calculate_digest(data)) != self.roots[2]:
+            data = os.urandom(1024)
+        digest = calculate_digest(data)
+        self.push_blob(data)
+        url = reverse("django_oci:blob_upload", kwargs={"name": "vanessa/mounted"})
+        response = self.client.post(
+            "%s?mount=%s&from=%s" % (url, digest, self.repository),
+            content_type="application/octet-stream",
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        # Nothing is misplaced until the root is added
+        out = io.StringIO()
+        call_command("rebalance_blobs", "--dry-run", stdout=out)
+        self.assertIn("Would move 0 blobs", out.getvalue())
+
+        storage.storage_roots = self.roots
+        storage.ring = ring
+        out = io.StringIO()
+        call_command("rebalance_blobs", "--dry-run", stdout=out)
+        self.assertIn("Would move 1 blobs (1024 bytes)", out.getvalue())
+        call_command("rebalance_blobs", stdout=io.StringIO())
+
+        paths = set(Blob.objects.values_list("datafile", flat=True))
+        self.assertEqual(paths, {os.path.join(self.roots[2], self.repository, digest)})
+        for name in [self.repository, "vanessa/mounted"]:
+            url = reverse(
+                "django_oci:blob_download", kwargs={"name": name, "digest": digest}
+            )
+            self.assertEqual(self.client.get(url).getvalue(), data)
+
+    def test_monolithic_uploads_are_written_on_their_root(self):
+        """
+        A blob pushed in one request is written beside the root it moves to
+        """
+        move_blob = storage.move_blob
+        moves = []
+
+        def record_move(source, destination):
+            moves.append((source, destination))
+            return move_blob(source, destination)
+
+        with mock.patch.object(storage, "move_blob", record_move):
+            for _ in range(5):
+                self.push_blob(os.urandom(1024))
+        self.assertEqual(len(moves), 5)
+        for source, destination in moves:
+            root = storage.get_storage_root(destination)
+            self.assertEqual(os.path.dirname(source), os.path.join(root, ".sessions"))
@@ -0,0 +1,75 @@
+"""
+test_django-oci singleflight
+----------------------------
+
+Tests for `django-oci` request coalescing.
+"""
+
+import threading
+import time
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from django_oci import settings
+from django_oci.singleflight import SingleFlight
+
+
+class SingleFlightTests(SimpleTestCase):
+    def run_concurrently(self, flight, func, count=10):
+        results = []
+        barrier = threading.Barrier(count)
+
+        def call():
+            barrier.wait()
+            try:
+                results.append(flight.do("key", func))
+            except Exception as exc:
+                results.append(exc)
+
+        threads = [threading.Thread(target=call) for _ in range(count)]
+        [thread.start() for thread in threads]
+        [thread.join() for thread in threads]
+        return results
+
+    def test_concurrent_calls_share_one_result(self):
+        """
+        Concurrent identical calls run the function once
+        """
+        calls = []
+
+        def func():
+            calls.append(1)
+            time.sleep(0.2)
+            return "result"
+
+        results = self.run_concurrently(SingleFlight("test"), func)
+        self.assertEqual(results, ["result"] * 10)
+        self.assertEqual(len(calls), 1)
+
+    def test_errors_are_shared(self):
+        """
+        Followers see the error raised for the leader, and nothing is kept
+        """
+        flight = SingleFlight("test")
+
+        def func():
+            time.sleep(0.2)
+            raise ValueError("upstream failed")
+
+        results = self.run_concurrently(flight, func)
+        self.assertTrue(all(isinstance(x, ValueError) for x in results))
+        self.assertEqual(flight.do("key", lambda: "again"), "again")
+
+    def test_shared_cache(self):
+        """
+        With a shared cache, a result is reused by a later leader
+        """
+        with mock.patch.object(settings, "SINGLEFLIGHT_CACHE", "django_oci_upload"):
+            flight = SingleFlight("test-shared")
+            flight.forget("key")
+            self.assertEqual(flight.do("key", lambda: "first"), "first")
+            self.assertEqual(flight.do("key", lambda: "second"), "first")
+            flight.forget("key")
+            self.assertEqual(flight.do("key", lambda: "third"), "third")
+            flight.forget("key")
@@ -0,0 +1,128 @@
+"""
+test_django-oci stats
+---------------------
+
+Tests for `django-oci` write-behind pull statistics.
+"""
+
+import json
+import os
+import time
+from unittest import mock
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.test import APITestCase, APITransactionTestCase
+
+from django_oci import settings, stats
+from django_oci.models import PullStat, Repository
+from django_oci.stats import PullCounter, pull_counter
+from tests.helpers import MEDIA_TYPE, RegistryTestMixin, calculate_digest
+
+
+class PullStatTests(RegistryTestMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.repository = "vanessa/stats"
+        self.data = os.urandom(1024)
+        self.digest = calculate_digest(self.data)
+        self.manifest = json.dumps(
+            {"schemaVersion": 2, "config": {}, "layers": []}
+        ).encode("utf-8")
+        self.start_patches(
+            mock.patch.object(settings, "PULL_STATS_FLUSH_SECONDS", 3600),
+        )
+        pull_counter.reset()
+
+    def tearDown(self):
+        pull_counter.reset()
+
+    def test_pulls_are_counted_in_memory(self):
+        """
+        Pulls don't write to the database until the counts are flushed
+        """
+        blob_url = reverse(
+            "django_oci:blob_download",
+            kwargs={"name": self.repository, "digest": self.digest},
+        )
+        self.push_image(self.manifest, [self.data], tag="latest")
+        manifest_url = reverse(
+            "django_oci:image_manifest",
+            kwargs={"name": self.repository, "tag": "latest"},
+        )
+        with CaptureQueriesContext(connection) as queries:
+            for _ in range(3):
+                self.client.get(blob_url).getvalue()
+                self.client.get(manifest_url, HTTP_ACCEPT=MEDIA_TYPE)
+        for query in queries.captured_queries:
+            self.assertNotIn("INSERT", query["sql"])
+            self.assertNotIn("UPDATE", query["sql"])
+        self.assertFalse(PullStat.objects.exists())
+
+        pull_counter.flush()
+        self.assertEqual(
+            PullStat.objects.get(digest=self.digest).pulls,
+            3,
+        )
+        self.assertEqual(
+            PullStat.objects.get(digest=calculate_digest(self.manifest)).pulls, 3
+        )
+
+    def test_workers_add_to_counts(self):
+        """
+        Counts flushed from several processes (here, counters) add up
+        """
+        repository = Repository.objects.create(name=self.repository)
+        workers = [PullCounter(), PullCounter()]
+        for worker in workers:
+            for _ in range(5):
+                worker.record(repository.id, self.digest)
+            worker.flush()
+        self.assertEqual(PullStat.objects.get(digest=self.digest).pulls, 10)
+
+        # Databases without an upsert add to rows one at a time
+        worker = PullCounter()
+        worker.record(repository.id, self.digest)
+        worker.record(repository.id, "sha256:other")
+        with mock.patch.dict(stats.UPSERT, clear=True):
+            worker.flush()
+        self.assertEqual(PullStat.objects.get(digest=self.digest).pulls, 11)
+        self.assertEqual(PullStat.objects.get(digest="sha256:other").pulls, 1)
+
+    def test_deleted_repositories_are_skipped(self):
+        """
+        Counts for a repository deleted before the flush don't fail the others
+        """
+        repository = Repository.objects.create(name=self.repository)
+        deleted = Repository.objects.create(name="vanessa/deleted")
+        counter = PullCounter()
+        counter.record(repository.id, self.digest)
+        counter.record(deleted.id, self.digest)
+        deleted.delete()
+        with mock.patch.object(stats.logger, "warning") as warning:
+            counter.flush()
+        self.assertFalse(warning.called)
+        self.assertEqual(PullStat.objects.get().repository_id, repository.id)
+
+
+class PullStatFlushTests(APITransactionTestCase):
+    def test_flush_when_due(self):
+        """
+        The counts are flushed in the background once PULL_STATS_FLUSH_SECONDS pass
+        """
+        repository = Repository.objects.create(name="vanessa/stats")
+        counter = PullCounter()
+        with mock.patch.object(settings, "PULL_STATS_FLUSH_SECONDS", 0.1):
+            counter.record(repository.id, "sha256:flushed")
+            for _ in range(50):
+                if PullStat.objects.exists():
+                    break
+                time.sleep(0.1)
+        self.assertEqual(PullStat.objects.get(digest="sha256:flushed").pulls, 1)
+        self.assertEqual(counter.pending, {})
+
+        with mock.patch.object(settings, "PULL_STATS_FLUSH_SECONDS", None):
+            counter.record(repository.id, "sha256:flushed")
+        counter.flush()
+        self.assertEqual(PullStat.objects.get(digest="sha256:flushed").pulls, 1)
@@ -0,0 +1,111 @@
+"""
+test_django-oci tiers
+---------------------
+
+Tests for `django-oci` hot and cold blob storage tiers.
+"""
+
+import io
+import os
+import shutil
+import tempfile
+import time
+from datetime import timedelta
+from unittest import mock
+
+from django.core.management import call_command
+from django.utils import timezone
+from rest_framework.test import APITransactionTestCase
+
+from django_oci import settings, tiers
+from django_oci.models import HotBlob
+from django_oci.storage import storage
+from tests.helpers import RegistryTestMixin, calculate_digest
+
+
+class TieredStorageTests(RegistryTestMixin, APITransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.repository = "vanessa/tiers"
+        self.tmpdir = tempfile.mkdtemp()
+        self.start_patches(
+            mock.patch.object(settings, "HOT_STORAGE_ROOT", self.tmpdir),
+            mock.patch.object(settings, "HOT_STORAGE_PROMOTE_HITS", 2),
+            mock.patch.object(settings, "HOT_STORAGE_BYTES", 3000),
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        tiers.hot_hits.reset()
+
+    def wait_for_promotions(self):
+        for _ in range(100):
+            if not tiers._promotions:
+                return
+            time.sleep(0.05)
+
+    def test_promotion_on_pull(self):
+        """
+        A blob pulled enough times is copied to the hot tier, and read from it
+        """
+        data = os.urandom(1024)
+        digest = calculate_digest(data)
+        location = self.push_blob(data)["Location"]
+
+        self.assertEqual(self.client.get(location).getvalue(), data)
+        self.assertFalse(os.path.exists(tiers.get_hot_path(digest)))
+        self.assertEqual(self.client.get(location).getvalue(), data)
+        self.wait_for_promotions()
+        self.assertTrue(os.path.exists(tiers.get_hot_path(digest)))
+
+        with mock.patch.object(tiers, "count_pull") as count_pull:
+            response = self.client.get(location, HTTP_RANGE="bytes=0-9")
+        self.assertEqual(response.getvalue(), data[:10])
+        self.assertFalse(count_pull.called)
+
+        # A pull of a hot blob doesn't write, and its hit is saved later
+        self.assertEqual(HotBlob.objects.get(digest=digest).hits, 2)
+        tiers.hot_hits.flush()
+        self.assertEqual(HotBlob.objects.get(digest=digest).hits, 3)
+
+        # A hot copy demoted after the lookup is read from the storage root
+        with mock.patch.object(tiers, "get_read_path", return_value="missing"):
+            self.assertEqual(self.client.get(location).getvalue(), data)
+
+    def test_sweep_evicts_under_budget(self):
+        """
+        The sweep demotes the least recently pulled blobs until under budget
+        """
+        digests = []
+        for _ in range(4):
+            data = os.urandom(1000)
+            self.push_blob(data)
+            digests.append(calculate_digest(data))
+            blob, _ = storage.find_blob(self.repository, digests[-1])
+            tiers.copy_to_hot(digests[-1], blob.datafile.name, len(data))
+
+        now = timezone.now()
+        for i, digest in enumerate(digests):
+            HotBlob.objects.filter(digest=digest).update(
+                last_access=now - timedelta(minutes=10 - i), hits=10 - i
+            )
+
+        out = io.StringIO()
+        call_command("sweep_hot_blobs", "--dry-run", stdout=out)
+        self.assertIn("Would demote 1 blobs (1000 bytes)", out.getvalue())
+        self.assertEqual(HotBlob.objects.count(), 4)
+
+        call_command("sweep_hot_blobs", stdout=io.StringIO())
+        self.assertFalse(os.path.exists(tiers.get_hot_path(digests[0])))
+        self.assertEqual(
+            sorted(HotBlob.objects.values_list("digest", flat=True)),
+            sorted(digests[1:]),
+        )
+
+        # With LFU, the least pulled go first
+        with mock.patch.object(settings, "HOT_STORAGE_EVICTION", "lfu"):
+            demoted = tiers.sweep(budget=1000)
+        self.assertEqual([x.digest for x in demoted], [digests[3], digests[2]])
+        self.assertEqual(
+            list(HotBlob.objects.values_list("digest", flat=True)), [digests[1]]
+        )
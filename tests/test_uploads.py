@@ -0,0 +1,333 @@
+"""
+test_django-oci uploads
+-----------------------
+
+Tests for `django-oci` chunked upload sessions.
+"""
+
+import io
+import os
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
+
+from django.core.management import call_command
+from django.db import connection
+from django.middleware import cache
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.test import APITestCase, APITransactionTestCase
+
+from django_oci import settings
+from django_oci.files import get_session_dir
+from django_oci.models import Blob, Repository, UploadClaim
+from django_oci.storage import storage
+from tests.helpers import RegistryTestMixin, calculate_digest
+
+here = os.path.abspath(os.path.dirname(__file__))
+
+
+class ChunkedUploadTests(RegistryTestMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.repository = "vanessa/uploads"
+        with open(
+            os.path.join(here, "..", "examples", "singularity", "busybox_latest.sif"),
+            "rb",
+        ) as fd:
+            self.data = fd.read()
+        self.digest = calculate_digest(self.data)
+
+    def start_session(self):
+        url = reverse("django_oci:blob_upload", kwargs={"name": self.repository})
+        response = self.client.post(url, content_type="application/octet-stream")
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        return response.headers["Location"]
+
+    def patch(self, location, start, end):
+        return self.client.patch(
+            location,
+            data=self.data[start : end + 1],
+            content_type="application/octet-stream",
+            HTTP_CONTENT_RANGE="%s-%s" % (start, end),
+        )
+
+    def get_chunks(self, count=4):
+        size = len(self.data) // count + 1
+        return [
+            (start, min(start + size, len(self.data)) - 1)
+            for start in range(0, len(self.data), size)
+        ]
+
+    def test_parallel_chunks_out_of_order(self):
+        """
+        Chunks can arrive in any order, and are assembled on PUT
+        """
+        with mock.patch.object(settings, "PARALLEL_CHUNK_UPLOADS", True):
+            location = self.start_session()
+            for start, end in reversed(self.get_chunks()):
+                response = self.patch(location, start, end)
+                self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+
+            # A chunk overlapping one already received is refused
+            response = self.patch(location, 10, 20)
+            self.assertEqual(
+                response.status_code, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE
+            )
+
+            response = self.client.put("%s?digest=%s" % (location, self.digest))
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        response = self.client.get(response.headers["Location"])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.getvalue(), self.data)
+
+    def test_parallel_chunks_missing(self):
+        """
+        A session missing a chunk cannot be finished, but stays open for it
+        """
+        with mock.patch.object(settings, "PARALLEL_CHUNK_UPLOADS", True):
+            location = self.start_session()
+            chunks = self.get_chunks()
+            for start, end in chunks[1:]:
+                self.patch(location, start, end)
+            response = self.client.put("%s?digest=%s" % (location, self.digest))
+            self.assertEqual(
+                response.status_code, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE
+            )
+            self.assertEqual(response.headers["Range"], "0-0")
+
+            response = self.client.get(location)
+            self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+            response = self.patch(location, *chunks[0])
+            self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+            response = self.client.put("%s?digest=%s" % (location, self.digest))
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            response = self.client.get(response.headers["Location"])
+            self.assertEqual(response.getvalue(), self.data)
+
+    def test_parallel_chunks_digest_mismatch(self):
+        """
+        A complete session that doesn't match its digest is removed
+        """
+        with mock.patch.object(settings, "PARALLEL_CHUNK_UPLOADS", True):
+            location = self.start_session()
+            for start, end in self.get_chunks():
+                self.patch(location, start, end)
+            session = Blob.objects.get(digest=location.rstrip("/").rsplit("/", 1)[-1])
+            path = session.datafile.name
+
+            response = self.client.put("%s?digest=sha256:%s" % (location, "0" * 64))
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertFalse(os.path.exists(path))
+            self.assertFalse(Blob.objects.filter(pk=session.pk).exists())
+            self.assertIsNone(
+                cache.caches["django_oci_upload"].get("%s/ranges" % session.session_id)
+            )
+
+    def test_upload_status_and_resume(self):
+        """
+        GET on a session reports the bytes received, and an upload resumes there
+        """
+        location = self.start_session()
+        response = self.client.get(location)
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(response.headers["Range"], "0-0")
+
+        start, end = self.get_chunks()[0]
+        self.patch(location, start, end)
+        response = self.client.get(location)
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(response.headers["Range"], "0-%s" % end)
+        self.assertEqual(response.headers["Location"], location)
+
+        # A PATCH without a range continues from the last byte received
+        response = self.client.patch(
+            location,
+            data=self.data[end + 1 :],
+            content_type="application/octet-stream",
+        )
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.headers["Range"], "0-%s" % (len(self.data) - 1))
+
+        response = self.client.put("%s?digest=%s" % (location, self.digest))
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        response = self.client.get(response.headers["Location"])
+        self.assertEqual(response.getvalue(), self.data)
+
+        # A finished session has no status
+        response = self.client.get(location)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_sequential_chunks_out_of_order(self):
+        """
+        By default, a chunk must start where the last one ended
+        """
+        location = self.start_session()
+        chunks = self.get_chunks()
+        response = self.patch(location, *chunks[0])
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        response = self.patch(location, *chunks[2])
+        self.assertEqual(
+            response.status_code, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE
+        )
+
+    def test_finished_blobs_are_moved_into_place(self):
+        """
+        Finishing a blob moves the session file, leaving nothing behind
+        """
+        with mock.patch.object(settings, "FSYNC_POLICY", "directory"):
+            location = self.start_session()
+            for start, end in self.get_chunks():
+                self.patch(location, start, end)
+            response = self.client.put("%s?digest=%s" % (location, self.digest))
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        session_id = location.rstrip("/").split("/")[-1]
+        leftover = [x for x in os.listdir(get_session_dir()) if session_id in x]
+        self.assertEqual(leftover, [])
+        path = os.path.join(settings.MEDIA_ROOT, "blobs", self.repository, self.digest)
+        with open(path, "rb") as fd:
+            self.assertEqual(fd.read(), self.data)
+
+    def test_blob_metadata(self):
+        """
+        A finished blob records its size, so HEAD can return a Content-Length
+        """
+        location = self.push_blob(self.data)["Location"]
+        blob = Blob.objects.get(repository__name=self.repository, digest=self.digest)
+        self.assertEqual(blob.size, len(self.data))
+        self.assertEqual(blob.algorithm, "sha256")
+        self.assertEqual(blob.storage_key, "%s/%s" % (self.repository, self.digest))
+
+        response = self.client.head(location)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.headers["Content-Length"], str(len(self.data)))
+        self.assertEqual(response.headers["Docker-Content-Digest"], self.digest)
+
+    def test_range_requests(self):
+        """
+        A GET with a Range header returns part of the blob
+        """
+        location = self.push_blob(self.data)["Location"]
+        size = len(self.data)
+        for byte_range, start, end in [
+            ("bytes=0-99", 0, 99),
+            ("bytes=100-", 100, size - 1),
+            ("bytes=-50", size - 50, size - 1),
+        ]:
+            response = self.client.get(location, HTTP_RANGE=byte_range)
+            self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+            self.assertEqual(response.getvalue(), self.data[start : end + 1])
+            self.assertEqual(
+                response.headers["Content-Range"], "bytes %s-%s/%s" % (start, end, size)
+            )
+            self.assertEqual(response.headers["Content-Length"], str(end - start + 1))
+
+        response = self.client.get(location, HTTP_RANGE="bytes=%s-" % size)
+        self.assertEqual(
+            response.status_code, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE
+        )
+        self.assertEqual(response.headers["Content-Range"], "bytes */%s" % size)
+
+    def test_backfill_blob_metadata(self):
+        """
+        The backfill command records the size of blobs finished without one
+        """
+        self.push_blob(self.data)
+        Blob.objects.update(size=None, algorithm=None, storage_key=None)
+        call_command("backfill_blob_metadata", stdout=io.StringIO())
+        blob = Blob.objects.get(repository__name=self.repository, digest=self.digest)
+        self.assertEqual(blob.size, len(self.data))
+        self.assertEqual(blob.algorithm, "sha256")
+
+
+class DuplicateUploadTests(RegistryTestMixin, APITransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.repository = "vanessa/duplicates"
+        self.data = os.urandom(1024 * 64)
+        self.digest = calculate_digest(self.data)
+
+    def push(self, results=None):
+        url = reverse("django_oci:blob_upload", kwargs={"name": self.repository})
+        response = self.client_class().post(
+            "%s?digest=%s" % (url, self.digest),
+            data=self.data,
+            content_type="application/octet-stream",
+        )
+        if results is not None:
+            results.append(response.status_code)
+        connection.close()
+        return response
+
+    def test_existing_blob_short_circuits(self):
+        """
+        A push of a blob that exists doesn't read the body or write the file
+        """
+        response = self.push()
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        blob = Blob.objects.get(repository__name=self.repository, digest=self.digest)
+
+        with mock.patch.object(storage, "create_blob") as create_blob:
+            response = self.push()
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertFalse(create_blob.called)
+
+        # The blob keeps its id (and so the images that link to it)
+        self.assertEqual(
+            Blob.objects.get(repository__name=self.repository, digest=self.digest).id,
+            blob.id,
+        )
+
+    def test_concurrent_pushes_upload_once(self):
+        """
+        Concurrent pushes of the same digest write it once
+        """
+        create_blob = storage.create_blob
+        calls = []
+
+        def slow_create_blob(*args, **kwargs):
+            calls.append(1)
+            time.sleep(0.3)
+            return create_blob(*args, **kwargs)
+
+        results = []
+        with mock.patch.object(storage, "create_blob", slow_create_blob):
+            threads = [
+                threading.Thread(target=self.push, args=(results,)) for _ in range(5)
+            ]
+            [thread.start() for thread in threads]
+            [thread.join() for thread in threads]
+
+        self.assertEqual(results, [status.HTTP_201_CREATED] * 5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(
+            Blob.objects.filter(
+                repository__name=self.repository, digest=self.digest
+            ).count(),
+            1,
+        )
+        self.assertFalse(UploadClaim.objects.exists())
+
+    def test_waiting_on_a_claim_only_reads(self):
+        """
+        Waiting on an upload held by another worker doesn't write, and a claim
+        left behind by a worker that died is taken over
+        """
+        repository = Repository.objects.create(name=self.repository)
+        claim = UploadClaim.objects.create(repository=repository, digest=self.digest)
+        with CaptureQueriesContext(connection) as queries:
+            for _ in range(3):
+                self.assertFalse(storage.claim_upload(repository, self.digest))
+        self.assertEqual(len(queries.captured_queries), 3)
+        for query in queries.captured_queries:
+            self.assertTrue(query["sql"].startswith("SELECT"))
+
+        stale = timezone.now() - timedelta(seconds=settings.UPLOAD_CLAIM_SECONDS + 1)
+        UploadClaim.objects.filter(pk=claim.pk).update(add_date=stale)
+        self.assertTrue(storage.claim_upload(repository, self.digest))
+        self.assertGreater(UploadClaim.objects.get().add_date, stale)
@@ -0,0 +1,163 @@
+"""
+test_django-oci usage
+---------------------
+
+Tests for `django-oci` repository storage accounting and quotas.
+"""
+
+import io
+import json
+import os
+from unittest import mock
+
+from django.core.management import call_command
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITransactionTestCase
+
+from django_oci import settings
+from django_oci.models import Blob, Image, Repository, RepositoryUsage
+from tests.helpers import MEDIA_TYPE, RegistryTestMixin, calculate_digest
+
+
+class RepositoryUsageTests(RegistryTestMixin, APITransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.repository = "vanessa/usage"
+        self.data = os.urandom(1000)
+        self.digest = calculate_digest(self.data)
+
+    def get_usage(self, name=None):
+        return RepositoryUsage.objects.get(repository__name=name or self.repository)
+
+    def test_usage_counters(self):
+        """
+        Usage is counted as blobs are finished, mounted and deleted, and as
+        manifests are pushed and deleted
+        """
+        self.push_blob(self.data)
+        self.push_blob(self.data)
+        usage = self.get_usage()
+        self.assertEqual((usage.blob_count, usage.blob_bytes), (1, 1000))
+
+        manifest = json.dumps(
+            {"schemaVersion": 2, "config": {}, "layers": [{"digest": self.digest}]}
+        ).encode("utf-8")
+        url = reverse(
+            "django_oci:image_manifest", kwargs={"name": self.repository, "tag": "1"}
+        )
+        self.client.put(url, data=manifest, content_type=MEDIA_TYPE)
+        usage = self.get_usage()
+        self.assertEqual(
+            (usage.manifest_count, usage.manifest_bytes), (1, len(manifest))
+        )
+
+        # A mounted blob is shared (stored with the other repository)
+        self.push_blob(os.urandom(10), name="vanessa/other")
+        url = reverse("django_oci:blob_upload", kwargs={"name": "vanessa/other"})
+        response = self.client.post(
+            "%s?mount=%s&from=%s" % (url, self.digest, self.repository),
+            content_type="application/octet-stream",
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        usage = self.get_usage("vanessa/other")
+        self.assertEqual((usage.blob_count, usage.blob_bytes), (2, 1010))
+        self.assertEqual((usage.shared_bytes, usage.unique_bytes), (1000, 10))
+
+        Image.objects.filter(repository__name=self.repository).delete()
+        Blob.objects.filter(repository__name=self.repository).delete()
+        usage = self.get_usage()
+        self.assertEqual((usage.blob_count, usage.blob_bytes), (0, 0))
+        self.assertEqual((usage.manifest_count, usage.manifest_bytes), (0, 0))
+
+        # Deleting a repository doesn't leave (or create) a usage row
+        Repository.objects.filter(name="vanessa/other").delete()
+        self.assertFalse(
+            RepositoryUsage.objects.filter(repository__name="vanessa/other").exists()
+        )
+
+    def test_reconcile(self):
+        """
+        The reconcile command corrects usage that drifted
+        """
+        self.push_blob(self.data)
+        RepositoryUsage.objects.update(blob_count=5, blob_bytes=1)
+        out = io.StringIO()
+        call_command("reconcile_usage", stdout=out)
+        self.assertIn("Corrected the usage of 1 repositories", out.getvalue())
+        usage = self.get_usage()
+        self.assertEqual((usage.blob_count, usage.blob_bytes), (1, 1000))
+
+    def test_quota(self):
+        """
+        A push that would go over quota is refused before it is read
+        """
+        with mock.patch.object(settings, "REPOSITORY_QUOTA_BYTES", 1500):
+            self.assertEqual(self.push_blob(self.data).status_code, 201)
+            response = self.push_blob(os.urandom(1000))
+            self.assertEqual(
+                response.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+            )
+
+            # A push of a blob that exists is not counted again
+            self.assertEqual(self.push_blob(self.data).status_code, 201)
+
+            # Nor is a chunk that would take the blob over quota
+            url = reverse("django_oci:blob_upload", kwargs={"name": self.repository})
+            location = self.client.post(
+                url, content_type="application/octet-stream"
+            ).headers["Location"]
+            response = self.client.patch(
+                location,
+                data=os.urandom(600),
+                content_type="application/octet-stream",
+                HTTP_CONTENT_RANGE="0-599",
+            )
+            self.assertEqual(
+                response.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+            )
+
+            # Nor a final chunk that would, in the PUT that finishes the upload
+            response = self.client.patch(
+                location,
+                data=os.urandom(400),
+                content_type="application/octet-stream",
+                HTTP_CONTENT_RANGE="0-399",
+            )
+            self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+            data = os.urandom(200)
+            response = self.client.put(
+                "%s?digest=%s" % (location, calculate_digest(data)),
+                data=data,
+                content_type="application/octet-stream",
+                HTTP_CONTENT_RANGE="400-599",
+            )
+            self.assertEqual(
+                response.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+            )
+
+        # Chunks under the quota can't be finished over it, if it has changed
+        url = reverse("django_oci:blob_upload", kwargs={"name": self.repository})
+        location = self.client.post(
+            url, content_type="application/octet-stream"
+        ).headers["Location"]
+        data = os.urandom(400)
+        self.client.patch(
+            location,
+            data=data,
+            content_type="application/octet-stream",
+            HTTP_CONTENT_RANGE="0-399",
+        )
+        with mock.patch.object(settings, "REPOSITORY_QUOTA_BYTES", 1200):
+            response = self.client.put(
+                "%s?digest=%s" % (location, calculate_digest(data))
+            )
+            self.assertEqual(
+                response.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+            )
+        self.assertFalse(Blob.objects.filter(digest=calculate_digest(data)).exists())
+
+        # A quota on the repository overrides the default
+        RepositoryUsage.objects.update(quota_bytes=5000)
+        with mock.patch.object(settings, "REPOSITORY_QUOTA_BYTES", 1500):
+            self.assertEqual(self.push_blob(os.urandom(1000)).status_code, 201)